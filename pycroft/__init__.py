@@ -10,16 +10,32 @@
 
     :copyright: (c) 2011 by AG DSN.
 """
+from itertools import chain
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from sqlalchemy.orm.exc import NoResultFound
 from werkzeug.local import LocalProxy
 from pycroft.model.config import Config
+from pycroft.model.session import transaction_cache
 
 
 def _get_config():
-    config = Config.q.get(1)
+    cache = transaction_cache()
+    config = cache.get('config')
     if config is None:
-        raise NoResultFound
+        config = Config.q.get(1)
+        if config is None:
+            raise NoResultFound
+        cache['config'] = config
     return config
 
 
+@event.listens_for(Session, 'after_flush')
+def _invalidate_config(session, flush_context):
+    if any(isinstance(obj, Config)
+           for obj in chain(session.new, session.dirty, session.deleted)):
+        session.info.get('transaction_cache', {}).pop('config', None)
+
+
 config = LocalProxy(_get_config, "config")
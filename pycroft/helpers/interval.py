@@ -29,6 +29,8 @@ NegativeInfinity = _infinity("NegativeInfinity")
 
 
 class Bound(tuple):
+    __slots__ = ()
+
     @property
     def value(self):
         return self[0]
@@ -45,29 +47,35 @@ class Bound(tuple):
     def __hash__(self):
         return hash((self[0], self[1]))
 
+    # The comparisons are called a lot by the IntervalSet operations, so
+    # they use the tuple items instead of the properties.
     def __le__(self, other):
-        if self.value is PositiveInfinity:
-            return other.value is PositiveInfinity
-        if self.value is NegativeInfinity:
+        value = self[0]
+        other_value = other[0]
+        if value is PositiveInfinity:
+            return other_value is PositiveInfinity
+        if value is NegativeInfinity:
             return True
-        if other.value is PositiveInfinity:
+        if other_value is PositiveInfinity:
             return True
-        if other.value is NegativeInfinity:
+        if other_value is NegativeInfinity:
             return False
-        if self.value == other.value:
-            return self.closed and other.closed
-        return self.value <= other.value
+        if value == other_value:
+            return self[1] and other[1]
+        return value <= other_value
 
     def __lt__(self, other):
-        if self.value is PositiveInfinity:
-            return other.value is PositiveInfinity
-        if self.value is NegativeInfinity:
+        value = self[0]
+        other_value = other[0]
+        if value is PositiveInfinity:
+            return other_value is PositiveInfinity
+        if value is NegativeInfinity:
             return True
-        if other.value is PositiveInfinity:
+        if other_value is PositiveInfinity:
             return True
-        if other.value is NegativeInfinity:
+        if other_value is NegativeInfinity:
             return False
-        return self.value < other.value
+        return value < other_value
 
     def __gt__(self, other):
         return other < self
@@ -77,8 +85,8 @@ class Bound(tuple):
 
     def __eq__(self, other):
         return (isinstance(other, Bound) and
-                self.value == other.value and
-                self.closed == other.closed)
+                self[0] == other[0] and
+                self[1] == other[1])
 
     def __sub__(self, other):
         return self.value - other.value
@@ -183,8 +191,9 @@ class Interval(tuple):
         Tests if the interval is empty
         :return:
         """
-        return (self.lower_bound.value == self.upper_bound.value and
-                not (self.lower_bound.closed and self.upper_bound.closed))
+        lower_bound, upper_bound = self
+        return (lower_bound[0] == upper_bound[0] and
+                not (lower_bound[1] and upper_bound[1]))
 
     @property
     def length(self):
@@ -196,22 +205,19 @@ class Interval(tuple):
 
     def __eq__(self, other):
         return (isinstance(other, Interval) and
-                self.lower_bound == other.lower_bound and
-                self.upper_bound == other.upper_bound)
+                self[0] == other[0] and
+                self[1] == other[1])
 
     def __le__(self, other):
-        return (self.lower_bound < other.lower_bound or
-                (self.lower_bound == other.lower_bound and
-                 self.upper_bound <= other.upper_bound))
+        return self == other or self < other
 
     def __lt__(self, other):
-        return (self.lower_bound < other.lower_bound or
-                (self.lower_bound == other.lower_bound and
-                 self.upper_bound < other.upper_bound))
+        return (_begins_before(self[0], other[0]) or
+                (self[0] == other[0] and _ends_before(self[1], other[1])))
 
     def __contains__(self, point):
         bound = Bound(point, True)
-        return self.lower_bound <= bound <= self.upper_bound
+        return self[0] <= bound <= self[1]
 
     def __str__(self):
         return "{0}{1}, {2}{3}".format(
@@ -313,8 +319,8 @@ class Interval(tuple):
         :returns: True if this intervals meets the other else False
         :rtype: bool
         """
-        return (self.upper_bound.value == other.lower_bound.value and
-                (self.upper_bound.closed or self.lower_bound.closed))
+        return (self[1][0] == other[0][0] and
+                (self[1][1] or other[0][1]))
 
     def strictly_overlaps(self, other):
         """
@@ -339,8 +345,7 @@ class Interval(tuple):
         :returns: True if this interval overlaps with the other else False
         :rtype: bool
         """
-        return (self.lower_bound <= other.upper_bound and
-                other.lower_bound <= self.upper_bound)
+        return self[0] <= other[1] and other[0] <= self[1]
 
     def strictly_during(self, other):
         """
@@ -418,9 +423,8 @@ class Interval(tuple):
         if not self.overlaps(other):
             return None
         return Interval(
-            max(self.lower_bound, other.lower_bound),
-            min(self.upper_bound, other.upper_bound),
-        )
+            other[0] if _begins_before(self[0], other[0]) else self[0],
+            other[1] if _ends_before(other[1], self[1]) else self[1])
 
     __and__ = intersect
     __mul__ = intersect
@@ -435,14 +439,45 @@ class Interval(tuple):
         if not self.overlaps(other) and not self.meets(other):
             return None
         return Interval(
-            min(self.lower_bound, other.lower_bound),
-            max(self.upper_bound, other.upper_bound)
-        )
+            other[0] if _begins_before(other[0], self[0]) else self[0],
+            other[1] if _ends_before(self[1], other[1]) else self[1])
 
     __or__ = join
     __add__ = join
 
 
+def _begins_before(bound, other):
+    """
+    Tests if an interval with the lower bound `bound` begins before one with
+    the lower bound `other`.
+
+    Unlike the comparison of the bounds, a closed lower bound begins before
+    an open one of the same value.
+    :param Bound bound:
+    :param Bound other:
+    :rtype: bool
+    """
+    if bound[0] == other[0]:
+        return bound[1] and not other[1]
+    return bound < other
+
+
+def _ends_before(bound, other):
+    """
+    Tests if an interval with the upper bound `bound` ends before one with
+    the upper bound `other`.
+
+    Unlike the comparison of the bounds, an open upper bound ends before a
+    closed one of the same value.
+    :param Bound bound:
+    :param Bound other:
+    :rtype: bool
+    """
+    if bound[0] == other[0]:
+        return other[1] and not bound[1]
+    return bound < other
+
+
 def _convert_begin(begin):
     return NegativeInfinity if begin is None else begin
 
@@ -531,6 +566,15 @@ UnboundedInterval = open(None, None)
 
 
 class IntervalSet(collections.Sequence):
+    """
+    A set of points represented by sorted, disjoint and non-empty
+    intervals.
+
+    The set operations merge the sorted intervals of both operands.  Points
+    and intervals are looked up by binary search.
+    """
+    __slots__ = ('_intervals',)
+
     def __init__(self, intervals=None):
         self._intervals = _mangle_argument(intervals)
 
@@ -565,6 +609,24 @@ class IntervalSet(collections.Sequence):
     def __getitem__(self, item):
         return self._intervals[item]
 
+    def __contains__(self, item):
+        """
+        Tests if a point or an interval is contained in the set.
+
+        :param item: a point or an :class:`Interval`
+        :rtype: bool
+        """
+        intervals = self._intervals
+        if isinstance(item, Interval):
+            # Only the first interval not ending before the item can
+            # contain it, as the intervals are disjoint
+            i = _bisect_upper(intervals, item.lower_bound)
+            if i == len(intervals):
+                return item.empty
+            return not any(_intersect((item,), _complement((intervals[i],))))
+        i = _bisect_upper(intervals, Bound(item, True))
+        return i < len(intervals) and item in intervals[i]
+
     def __eq__(self, other):
         return (isinstance(other, IntervalSet) and
                 self._intervals == other._intervals)
@@ -600,14 +662,23 @@ class IntervalSet(collections.Sequence):
 
     def intersect(self, other):
         other_intervals = _mangle_argument(other)
-        return _create(_intersect(self._intervals, other_intervals))
+        intervals = self._intervals
+        if len(other_intervals) == 1:
+            # Only the intervals overlapping with the single interval
+            # are merged
+            interval, = other_intervals
+            first = _bisect_upper(intervals, interval.lower_bound)
+            last = _bisect_lower(intervals, interval.upper_bound, first)
+            intervals = intervals[first:last]
+        return _create(_intersect(intervals, other_intervals))
 
     __and__ = intersect
     __mul__ = intersect
 
     def difference(self, other):
         other_intervals = _mangle_argument(other)
-        return self.intersect(_complement(other_intervals))
+        return _create(_intersect(self._intervals,
+                                  _complement(other_intervals)))
 
     __sub__ = difference
 
@@ -626,6 +697,44 @@ def _mangle_argument(arg):
                     "Was {0}.".format(type(arg).__name__))
 
 
+def _bisect_upper(intervals, bound, low=0):
+    """
+    Find the first of sorted, disjoint intervals not ending before a bound.
+
+    :param tuple[Interval] intervals:
+    :param Bound bound:
+    :param int low: index to start at
+    :rtype: int
+    """
+    high = len(intervals)
+    while low < high:
+        middle = (low + high) // 2
+        if bound <= intervals[middle][1]:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def _bisect_lower(intervals, bound, low=0):
+    """
+    Find the first of sorted, disjoint intervals beginning after a bound.
+
+    :param tuple[Interval] intervals:
+    :param Bound bound:
+    :param int low: index to start at
+    :rtype: int
+    """
+    high = len(intervals)
+    while low < high:
+        middle = (low + high) // 2
+        if bound < intervals[middle][0]:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
 def _create(intervals):
     """
     Create an IntervalSet directly from a sorted Interval iterable.
@@ -3,34 +3,36 @@
 # This file is part of the Pycroft project and licensed under the terms of
 # the Apache License, Version 2.0. See the LICENSE file for details.
 from abc import ABCMeta, abstractmethod
-from collections import namedtuple
+from collections import Counter, namedtuple
 import csv
 from datetime import datetime, date, timedelta
 from decimal import Decimal
 import difflib
 from functools import partial
-from itertools import chain, islice, starmap, tee, zip_longest
+from itertools import chain, groupby, islice, starmap, tee, zip_longest
 from io import StringIO
 import operator
 import re
 from typing import Optional
 
 from sqlalchemy import or_, and_, literal_column, literal, select, exists, not_, \
-    text
+    text, union_all
 from sqlalchemy.orm import aliased, contains_eager, joinedload
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy import func, between, Integer, cast
+from sqlalchemy import func, between, Integer, cast, Boolean, Date
+from sqlalchemy.dialects.postgresql import insert
 
 from pycroft import config, model
 from pycroft.helpers.i18n import deferred_gettext, gettext, Message
 from pycroft.helpers.date import diff_month, last_day_of_month
-from pycroft.lib.logging import log_user_event
-from pycroft.lib.membership import make_member_of, remove_member_of
+from pycroft.lib.logging import log_user_events
+from pycroft.lib.membership import make_members_of, remove_member_of
 from pycroft.model import session
 from pycroft.model.finance import (
-    Account, BankAccount, BankAccountActivity, Split, Transaction, MembershipFee)
+    Account, AccountBalance, BankAccount, BankAccountActivity, Split,
+    Transaction, MembershipFee)
 from pycroft.helpers.interval import (
-    closed, single, Bound, Interval, IntervalSet, UnboundedInterval, closedopen)
+    single, Bound, Interval, IntervalSet, UnboundedInterval, closedopen)
 from pycroft.model.functions import sign, least
 from pycroft.model.property import CurrentProperty
 from pycroft.model.session import with_transaction
@@ -177,6 +179,57 @@ def transferred_amount(from_account, to_account, when=UnboundedInterval):
     return query.scalar()
 
 
+def get_account_balance_discrepancies():
+    """
+    Compare the cached balances in the `account_balance` table with the
+    actual sums of the splits.
+
+    :return: A list of ``(account_id, cached, actual)`` tuples for every
+        account whose cached balance is wrong
+    :rtype: list[tuple[int, Decimal, Decimal]]
+    """
+    cached = AccountBalance.__table__
+    actual = (
+        select([Split.account_id, func.sum(Split.amount).label('balance')])
+        .group_by(Split.account_id)
+        .alias('actual')
+    )
+    cached_balance = func.coalesce(cached.c.balance, 0)
+    actual_balance = func.coalesce(actual.c.balance, 0)
+    query = (
+        select([func.coalesce(cached.c.account_id, actual.c.account_id),
+                cached_balance, actual_balance])
+        .select_from(cached.join(actual,
+                                 cached.c.account_id == actual.c.account_id,
+                                 full=True))
+        .where(cached_balance != actual_balance)
+    )
+    return [tuple(row) for row in session.session.execute(query)]
+
+
+@with_transaction
+def repair_account_balances():
+    """
+    Overwrite all wrong cached balances in the `account_balance` table with
+    the actual sums of the splits.
+
+    :return: The discrepancies which have been fixed, as returned by
+        :func:`get_account_balance_discrepancies`
+    :rtype: list[tuple[int, Decimal, Decimal]]
+    """
+    discrepancies = get_account_balance_discrepancies()
+    if discrepancies:
+        stmt = insert(AccountBalance.__table__).values([
+            {'account_id': account_id, 'balance': actual}
+            for account_id, _, actual in discrepancies
+        ])
+        session.session.execute(stmt.on_conflict_do_update(
+            index_elements=[AccountBalance.account_id],
+            set_={'balance': stmt.excluded.balance},
+        ))
+    return discrepancies
+
+
 membership_fee_description = deferred_gettext("Mitgliedsbeitrag {fee_name}")
 @with_transaction
 def post_transactions_for_membership_fee(membership_fee, processor,
@@ -195,6 +248,7 @@ def post_transactions_for_membership_fee(membership_fee, processor,
     :param simulate: Do not post any transactions, just return the affected users.
     :return: A list of name of all affected users
     """
+    from pycroft.lib.user import invalidate_status
 
     description = membership_fee_description.format(
         fee_name=membership_fee.name).to_json()
@@ -225,41 +279,42 @@ def post_transactions_for_membership_fee(membership_fee, processor,
             .distinct()
             .cte('membership_fee_users'))
 
-    affected_users_raw = session.session.execute(select([users.c.user_id, users.c.user_name])).fetchall()
-
-    if not simulate:
-        numbered_users = (select([users.c.user_id, users.c.account_id, func.row_number().over().label('index')])
+    if simulate:
+        affected_users_raw = session.session.execute(
+            select([users.c.user_id, users.c.user_name])).fetchall()
+    else:
+        # Everything is done in one statement, so that the users are only
+        # evaluated once.  The ids of the new transactions are drawn
+        # beforehand to associate them with the users' splits.
+        numbered_users = (select([users.c.user_id, users.c.user_name, users.c.account_id,
+                                  func.nextval('transaction_id_seq').label('transaction_id')])
                           .select_from(users)
                           .cte("membership_fee_numbered_users"))
 
         transactions = (Transaction.__table__.insert()
-             .from_select([Transaction.description, Transaction.author_id, Transaction.posted_at, Transaction.valid_on, Transaction.confirmed],
-                          select([literal(description), literal(processor.id), func.current_timestamp(), literal(membership_fee.ends_on), True]).select_from(users))
+             .from_select([Transaction.id, Transaction.description, Transaction.author_id, Transaction.posted_at, Transaction.valid_on, Transaction.confirmed],
+                          select([numbered_users.c.transaction_id, literal(description), literal(processor.id), func.current_timestamp(), literal(membership_fee.ends_on), True])
+                          .select_from(numbered_users))
              .returning(Transaction.id)
              .cte('membership_fee_transactions'))
 
-        numbered_transactions = (select([transactions.c.id, func.row_number().over().label('index')])
-             .select_from(transactions)
-             .cte('membership_fee_numbered_transactions'))
-
-        split_insert_fee_account = (Split.__table__.insert()
-            .from_select([Split.amount, Split.account_id, Split.transaction_id],
-                         select([literal(-membership_fee.regular_fee, type_=Money), literal(config.membership_fee_account_id),transactions.c.id])
-                         .select_from(transactions))
-            .returning(Split.id)
-            .cte('membership_fee_split_fee_account'))
-
-        split_insert_user = (Split.__table__.insert().from_select(
-            [Split.amount, Split.account_id, Split.transaction_id],
-            select([literal(membership_fee.regular_fee, type_=Money), numbered_users.c.account_id, numbered_transactions.c.id])
-            .select_from(numbered_users.join(numbered_transactions,
-                        numbered_transactions.c.index == numbered_users.c.index)))
-            .returning(Split.id)
-            .cte('membership_fee_split_user'))
-
-        # TODO: Unite the following two queries into one (the membership_fee_users is called twice currently.
-        session.session.execute(select([]).select_from(split_insert_fee_account
-                                           .join(split_insert_user, split_insert_user.c.id == split_insert_fee_account.c.id)))
+        splits = (Split.__table__.insert()
+            .from_select([Split.amount, Split.account_id, Split.transaction_id], union_all(
+                select([literal(-membership_fee.regular_fee, type_=Money), literal(config.membership_fee_account_id), transactions.c.id])
+                .select_from(transactions),
+                select([literal(membership_fee.regular_fee, type_=Money), numbered_users.c.account_id, transactions.c.id])
+                .select_from(transactions.join(numbered_users,
+                            numbered_users.c.transaction_id == transactions.c.id))))
+            .returning(Split.account_id, Split.transaction_id)
+            .cte('membership_fee_splits'))
+
+        affected_users_raw = session.session.execute(
+            select([numbered_users.c.user_id, numbered_users.c.user_name])
+            .select_from(numbered_users.join(splits, and_(
+                splits.c.transaction_id == numbered_users.c.transaction_id,
+                splits.c.account_id == numbered_users.c.account_id)))
+        ).fetchall()
+        invalidate_status()
 
     affected_users = []
 
@@ -371,84 +426,141 @@ def is_ordered(iterable, relation=operator.le):
     return all(relation(x, y) for x, y in zip(a, b))
 
 
+def _activity_key(activity):
+    """Key of a processed CSV record to match it with the database.
+
+    The key consists of every field stored in the database except
+    ``posted_on``, by which the activities are grouped anyway, and
+    ``imported_at``.
+    """
+    (amount, bank_account_id, _, reference, other_account_number,
+     other_routing_number, other_name, _, _, valid_on) = activity
+    return (amount, bank_account_id, reference, other_account_number,
+            other_routing_number, other_name, valid_on)
+
+
 @with_transaction
 def import_bank_account_activities_csv(csv_file, expected_balance,
-                                       imported_at=None):
+                                       imported_at=None, batch_size=1000):
     """
     Import bank account activities from a MT940 CSV file into the database.
 
     The new activities are merged with the activities that are already saved to
-    the database.
+    the database.  The file must be sorted by posting date in descending
+    order, so that it can be streamed and aligned day by day with the
+    activities in the database, which are streamed in the same order.  New
+    activities are inserted in batches of `batch_size` rows.  Activities in
+    the database which are missing from the file are kept, unless the file
+    has new activities on the same day, which is reported as a conflict.
+
+    The expected balance is checked against the sum of every activity in the
+    file, whether it is new or already stored, and of the stored activities
+    posted before the first day of the file.  This is the balance after the
+    last day of the file, so overlapping files can be imported again with
+    the balance of their last day.
+
     :param csv_file:
-    :param expected_balance:
+    :param expected_balance: the balance after the last day of the file
     :param imported_at:
+    :param int batch_size:
     :return:
     """
 
     if imported_at is None:
         imported_at = session.utcnow()
 
+    bank_accounts = {}
     # Convert to MT940Record and enumerate
     reader = csv.reader(csv_file, dialect=MT940Dialect)
     records = enumerate((MT940Record._make(r) for r in reader), 1)
+    activities = (process_record(index, record, imported_at=imported_at,
+                                 bank_accounts=bank_accounts)
+                  for index, record in records)
+    file_days = groupby(activities, key=operator.itemgetter(8))
+
+    table = BankAccountActivity.__table__
+    columns = (table.c.amount, table.c.bank_account_id, table.c.reference,
+               table.c.other_account_number, table.c.other_routing_number,
+               table.c.other_name, table.c.valid_on, table.c.posted_on)
+
+    new_rows = []
+    conflicts = []
+    balance = 0
+    first_posted_on = None
+
+    def flush_new_rows():
+        if new_rows:
+            session.session.execute(table.insert(), new_rows)
+            del new_rows[:]
+
     try:
         # Skip first record (header)
         next(records)
-        activities = tuple(
-            process_record(index, record, imported_at=imported_at)
-            for index, record in records)
+        for posted_on, day in file_days:
+            if first_posted_on is None:
+                db_days = groupby(session.session.execute(
+                    select(columns)
+                    .where(table.c.posted_on <= posted_on)
+                    .order_by(table.c.posted_on.desc())
+                    .execution_options(stream_results=True)
+                ), key=operator.itemgetter(7))
+                db_posted_on, db_day = next(db_days, (None, ()))
+            elif posted_on >= first_posted_on:
+                raise CSVImportError(gettext(
+                    u"Transaction are not sorted according to transaction "
+                    u"date in descending order."))
+            first_posted_on = posted_on
+
+            while db_posted_on is not None and db_posted_on > posted_on:
+                db_posted_on, db_day = next(db_days, (None, ()))
+            if db_posted_on == posted_on:
+                existing = Counter(tuple(row)[:7] for row in db_day)
+            else:
+                existing = Counter()
+
+            day = list(day)
+            balance += sum(a[0] for a in day)
+            inserted = []
+            for activity in day:
+                key = _activity_key(activity)
+                if existing[key] > 0:
+                    existing[key] -= 1
+                else:
+                    inserted.append(activity)
+            missing = list(existing.elements())
+            if inserted and missing:
+                conflicts.append((missing, inserted))
+                continue
+            new_rows.extend(dict(
+                amount=e[0], bank_account_id=e[1], reference=e[3],
+                other_account_number=e[4], other_routing_number=e[5],
+                other_name=e[6], imported_at=e[7], posted_on=e[8],
+                valid_on=e[9]
+            ) for e in inserted)
+            if len(new_rows) >= batch_size:
+                flush_new_rows()
     except StopIteration:
         raise CSVImportError(gettext(u"No data present."))
     except csv.Error as e:
         raise CSVImportError(gettext(u"Could not read CSV."), e)
-    if not activities:
+    if first_posted_on is None:
         raise CSVImportError(gettext(u"No data present."))
-    if not is_ordered((a[8] for a in activities), operator.ge):
-        raise CSVImportError(gettext(
-            u"Transaction are not sorted according to transaction date in "
-            u"descending order."))
-    first_posted_on = activities[-1][8]
-    balance = session.session.query(
+    if conflicts:
+        raise CSVImportError(
+            gettext(u"Import conflict:\n"
+                    u"Database bank account activities:\n{0}\n"
+                    u"File bank account activities:\n{1}").format(
+                u'\n'.join(str(x) for missing, _ in conflicts
+                           for x in missing),
+                u'\n'.join(str(x) for _, inserted in conflicts
+                           for x in inserted)))
+    flush_new_rows()
+
+    balance += session.session.query(
         func.coalesce(func.sum(BankAccountActivity.amount), 0)
     ).filter(
         BankAccountActivity.posted_on < first_posted_on
     ).scalar()
-    a = tuple(session.session.query(
-        BankAccountActivity.amount, BankAccountActivity.bank_account_id,
-        BankAccountActivity.reference, BankAccountActivity.reference,
-        BankAccountActivity.other_account_number,
-        BankAccountActivity.other_routing_number,
-        BankAccountActivity.other_name, BankAccountActivity.imported_at,
-        BankAccountActivity.posted_on, BankAccountActivity.valid_on
-    ).filter(
-        BankAccountActivity.posted_on >= first_posted_on)
-    )
-    b = tuple(reversed(activities))
-    matcher = difflib.SequenceMatcher(a=a, b=b)
-    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
-        if 'equal' == tag:
-            continue
-        elif 'insert' == tag:
-            balance += sum(a[0] for a in islice(activities, j1, j2))
-            session.session.add_all(
-                BankAccountActivity(
-                    amount=e[0], bank_account_id=e[1], reference=e[3],
-                    other_account_number=e[4],
-                    other_routing_number=e[5], other_name=e[6],
-                    imported_at=e[7], posted_on=e[8], valid_on=e[9]
-                ) for e in islice(activities, j1, j2)
-            )
-        elif 'delete' == tag:
-            continue
-        elif 'replace' == tag:
-            raise CSVImportError(
-                gettext(u"Import conflict:\n"
-                        u"Database bank account activities:\n{0}\n"
-                        u"File bank account activities:\n{1}").format(
-                    u'\n'.join(str(x) for x in islice(activities, i1, i2)),
-                    u'\n'.join(str(x) for x in islice(activities, j1, j2))))
-        else:
-            raise AssertionError()
     if balance != expected_balance:
         message = gettext(u"Balance after does not equal expected balance: "
                           u"{0} != {1}.")
@@ -493,21 +605,32 @@ def restore_record(record):
     return restored_record
 
 
-def process_record(index, record, imported_at):
+def process_record(index, record, imported_at, bank_accounts=None):
+    """Parse a MT940 CSV record.
+
+    :param dict[str,BankAccount]|None bank_accounts: A cache of the bank
+        accounts by account number, which is filled by this function.
+    """
     if record.currency != u"EUR":
         message = gettext(u"Unsupported currency {0}. Record {1}: {2}")
         raw_record = restore_record(record)
         raise CSVImportError(message.format(record.currency, index, raw_record))
+    if bank_accounts is None:
+        bank_accounts = {}
     try:
-        bank_account = BankAccount.q.filter_by(
-            account_number=record.our_account_number
-        ).one()
-    except NoResultFound as e:
-        message = gettext(u"No bank account with account number {0}. "
-                          u"Record {1}: {2}")
-        raw_record = restore_record(record)
-        raise CSVImportError(
-            message.format(record.our_account_number, index, raw_record), e)
+        bank_account = bank_accounts[record.our_account_number]
+    except KeyError:
+        try:
+            bank_account = BankAccount.q.filter_by(
+                account_number=record.our_account_number
+            ).one()
+        except NoResultFound as e:
+            message = gettext(u"No bank account with account number {0}. "
+                              u"Record {1}: {2}")
+            raw_record = restore_record(record)
+            raise CSVImportError(
+                message.format(record.our_account_number, index, raw_record), e)
+        bank_accounts[record.our_account_number] = bank_account
 
     try:
         valid_on = datetime.strptime(record.valid_on, u"%d.%m.%y").date()
@@ -572,77 +695,238 @@ def end_payment_in_default_memberships():
 
 
 def get_users_with_payment_in_default():
-    # Add memberships and end "member" membership if threshold met
-    users = User.q.join(User.current_properties) \
-        .filter(CurrentProperty.property_name == 'membership_fee') \
-        .join(Account).filter(Account.balance > 0).all()
-
-    users_pid_membership = set()
-    users_membership_terminated = set()
-
+    """
+    Determine the users who are in default with their membership fees.
+
+    This is evaluated by a single query over all users with the
+    ``membership_fee`` property and a positive balance:
+
+    * The days in default are counted from the day on which the running
+      balance of the user's account last turned positive, like
+      :attr:`Account.in_default_days` does.
+    * The deadlines are taken from the membership fee that was due back
+      then, or the last applied membership fee if there is none.
+    * Users whose payment in default membership ended during the last week
+      are skipped.
+
+    :return: The users to be added to the payment in default group and the
+        users whose membership is to be terminated
+    :rtype: tuple[set[User], set[User]]
+    """
     ts_now = session.utcnow()
-    for user in users:
-        in_default_days = user.account.in_default_days
-
-        try:
-            fee_date = ts_now - timedelta(days=in_default_days)
 
-            # datetime not working as datetime type
-            fee = get_membership_fee_for_date(str(fee_date))
-        except NoResultFound:
-            fee = get_last_applied_membership_fee()
-
-        if fee is None:
-            raise ValueError("No fee found")
+    candidates = (
+        session.session.query(User.id.label('user_id'),
+                              User.account_id.label('account_id'))
+        .join(User.current_properties)
+        .filter(CurrentProperty.property_name == 'membership_fee')
+        .join(AccountBalance, AccountBalance.account_id == User.account_id)
+        .filter(AccountBalance.balance > 0)
+        .subquery()
+    )
+    running = (
+        session.session.query(
+            Split.account_id, Split.id.label('split_id'), Transaction.valid_on,
+            func.sum(Split.amount).over(
+                partition_by=Split.account_id,
+                order_by=(Transaction.valid_on, Split.id),
+            ).label('balance'))
+        .join(Split.transaction)
+        .join(candidates, candidates.c.account_id == Split.account_id)
+        .subquery()
+    )
+    # Whether the balance is settled after this or any later split
+    settled = (
+        session.session.query(
+            running.c.account_id, running.c.valid_on,
+            func.bool_or(running.c.balance <= 0, type_=Boolean).over(
+                partition_by=running.c.account_id,
+                order_by=(running.c.valid_on.desc(), running.c.split_id.desc()),
+            ).label('settled'))
+        .subquery()
+    )
+    overdue = (
+        session.session.query(
+            settled.c.account_id,
+            func.min(settled.c.valid_on).label('first_overdue'))
+        .filter(~settled.c.settled)
+        .group_by(settled.c.account_id)
+        .subquery()
+    )
 
-        if in_default_days >= fee.payment_deadline.days:
-            # Skip user if the payment in default group membership was terminated within the last week
-            last_pid_membership = Membership.q.filter(Membership.user_id == user.id).filter(
-                Membership.group_id == config.payment_in_default_group.id).order_by(Membership.ends_at.desc()).first()
+    in_default_days = func.abs(
+        literal(date.today(), Date) - overdue.c.first_overdue)
+    fee_date = literal(ts_now.date(), Date) - in_default_days
+    fee_for_date = (
+        select([MembershipFee.id])
+        .where(between(fee_date, MembershipFee.begins_on,
+                       MembershipFee.ends_on))
+        .as_scalar()
+    )
+    last_applied_fee = (
+        select([MembershipFee.id])
+        .where(MembershipFee.ends_on <= func.current_timestamp())
+        .order_by(MembershipFee.ends_on.desc())
+        .limit(1)
+        .as_scalar()
+    )
+    evaluated = (
+        session.session.query(
+            candidates.c.user_id,
+            in_default_days.label('in_default_days'),
+            func.coalesce(fee_for_date, last_applied_fee).label('fee_id'))
+        .join(overdue, overdue.c.account_id == candidates.c.account_id)
+        .subquery()
+    )
 
-            if last_pid_membership is not None:
-                if last_pid_membership.ends_at is not None and \
-                        last_pid_membership.ends_at >= ts_now - timedelta(days=7):
-                    continue
+    def days(interval):
+        return func.floor(func.extract('epoch', interval) / 86400)
+
+    def pid_membership(*criteria):
+        return exists().where(and_(
+            Membership.user_id == evaluated.c.user_id,
+            Membership.group_id == config.payment_in_default_group_id,
+            *criteria
+        ))
+
+    deadline_reached = (evaluated.c.in_default_days
+                        >= days(MembershipFee.payment_deadline))
+    final_deadline_reached = (evaluated.c.in_default_days
+                              >= days(MembershipFee.payment_deadline_final))
+    # Skip users if the payment in default group membership was terminated
+    # within the last week
+    skipped = and_(
+        deadline_reached,
+        ~pid_membership(Membership.ends_at.is_(None)),
+        pid_membership(Membership.ends_at >= ts_now - timedelta(days=7)),
+    )
+    in_default = (
+        select([CurrentProperty.user_id])
+        .where(and_(CurrentProperty.property_name == 'payment_in_default',
+                    ~CurrentProperty.denied))
+        .alias('in_default')
+    )
+    add_to_pid_group = and_(deadline_reached, ~skipped,
+                            in_default.c.user_id.is_(None))
+    terminate = and_(final_deadline_reached, ~skipped, ~add_to_pid_group)
+
+    rows = (
+        session.session.query(
+            User, evaluated.c.fee_id,
+            add_to_pid_group.label('add_to_pid_group'),
+            terminate.label('terminate'))
+        .join(evaluated, evaluated.c.user_id == User.id)
+        .outerjoin(MembershipFee, MembershipFee.id == evaluated.c.fee_id)
+        .outerjoin(in_default, in_default.c.user_id == User.id)
+        .filter(or_(evaluated.c.fee_id.is_(None), deadline_reached,
+                    final_deadline_reached))
+        .all()
+    )
 
-            if not user.has_property('payment_in_default'):
-                # Add user to new payment in default list
-                users_pid_membership.add(user)
+    users_pid_membership = set()
+    users_membership_terminated = set()
 
-        if in_default_days >= fee.payment_deadline_final.days:
-            # Add user to terminated memberships
+    for user, fee_id, add_to_pid_group, terminate in rows:
+        if fee_id is None:
+            raise ValueError("No fee found")
+        if add_to_pid_group:
+            users_pid_membership.add(user)
+        elif terminate:
             users_membership_terminated.add(user)
 
-    users_membership_terminated.difference_update(users_pid_membership)
-
     return users_pid_membership, users_membership_terminated
 
 
+PaymentInDefaultActions = namedtuple("PaymentInDefaultActions",
+                                     ["added_to_pid_group", "moved_out"])
+
+
 @with_transaction
 def take_actions_for_payment_in_default_users(users_pid_membership,
                                               users_membership_terminated,
                                               processor):
-    ts_now = session.utcnow()
+    """Add users to the payment in default group and move out users whose
+    membership is terminated.
+
+    Users which already are in the payment in default group resp. are not
+    members anymore are skipped.  Memberships, hosts and log entries are
+    handled with multi-row statements for all users at once.
+
+    :param users_pid_membership: Users to add to the payment in default group
+    :param users_membership_terminated: Users to move out
+    :param User processor: The user issuing the actions
+    :return: The ids of the users which were added to the payment in default
+        group resp. moved out
+    :rtype: PaymentInDefaultActions
+    """
+    from pycroft.lib.user import move_out_users
 
-    for user in users_pid_membership:
-        if not user.member_of(config.payment_in_default_group):
-            make_member_of(user, config.payment_in_default_group,
-                           processor, closed(ts_now, None))
+    ts_now = session.utcnow()
+    session.session.flush()
+
+    def active_members(users, group):
+        user_ids = {user.id for user in users}
+        if not user_ids:
+            return set()
+        return {user_id for user_id, in session.session.query(
+            Membership.user_id
+        ).filter(
+            Membership.user_id.in_(user_ids),
+            Membership.group_id == group.id,
+            Membership.active(single(ts_now)),
+        ).distinct()}
+
+    users_pid_membership = list(users_pid_membership)
+    in_pid_group = active_members(users_pid_membership,
+                                  config.payment_in_default_group)
+    new_pid_users = [user for user in users_pid_membership
+                     if user.id not in in_pid_group]
+    make_members_of(new_pid_users, config.payment_in_default_group,
+                    processor, ts_now)
+
+    users_membership_terminated = list(users_membership_terminated)
+    members = active_members(users_membership_terminated,
+                             config.member_group)
+    terminated_users = [user for user in users_membership_terminated
+                        if user.id in members]
+    move_out_users(terminated_users, "Zahlungsrückstand", processor, ts_now,
+                   True)
+    log_user_events(
+        ((user.id, "Mitgliedschaftsende wegen Zahlungsrückstand.")
+         for user in terminated_users),
+        processor
+    )
+    session.session.expire_all()
 
-    from pycroft.lib.user import move_out
+    return PaymentInDefaultActions(
+        added_to_pid_group=[user.id for user in new_pid_users],
+        moved_out=[user.id for user in terminated_users],
+    )
 
-    for user in users_membership_terminated:
-        if user.member_of(config.member_group):
-            move_out(user, "Zahlungsrückstand", processor, ts_now, True)
 
-            log_user_event("Mitgliedschaftsende wegen Zahlungsrückstand.",
-                           processor, user)
+def _activity_identity(activity):
+    """The fields identifying an imported :class:`BankAccountActivity`."""
+    return (activity.amount, activity.reference,
+            activity.other_account_number, activity.other_routing_number,
+            activity.other_name, activity.posted_on, activity.valid_on)
 
 
 def process_transactions(bank_account, statement):
+    """Build the activities of a FinTS statement and sort out those which
+    already have been imported.
+
+    All activities of the bank account in the date range of the statement
+    are fetched with a single query to recognize the already imported ones.
+
+    :param BankAccount bank_account:
+    :param statement: The MT940 transactions of the statement
+    :return: The new activities and the already imported ones
+    :rtype: tuple[list[BankAccountActivity],list[BankAccountActivity]]
+    """
     transactions = []  # new transactions which would be imported
     old_transactions = []  # transactions which are already imported
 
+    activities = []
     for transaction in statement:
         iban = transaction.data.get('applicant_iban', '')
         if iban is None: iban = ''
@@ -655,7 +939,7 @@ def process_transactions(bank_account, statement):
         if 'end_to_end_reference' in transaction.data and \
                 transaction.data['end_to_end_reference'] is not None:
             purpose = purpose + ' EREF+' + transaction.data['end_to_end_reference']
-        new_activity = BankAccountActivity(
+        activities.append(BankAccountActivity(
             bank_account_id=bank_account.id,
             amount=transaction.data['amount'].amount,
             reference=purpose,
@@ -665,23 +949,31 @@ def process_transactions(bank_account, statement):
             imported_at=session.utcnow(),
             posted_on=transaction.data['entry_date'],
             valid_on=transaction.data['date'],
-        )
-        if BankAccountActivity.q.filter(and_(
-                BankAccountActivity.bank_account_id ==
-                new_activity.bank_account_id,
-                BankAccountActivity.amount == new_activity.amount,
-                BankAccountActivity.reference == new_activity.reference,
-                BankAccountActivity.other_account_number ==
-                new_activity.other_account_number,
-                BankAccountActivity.other_routing_number ==
-                new_activity.other_routing_number,
-                BankAccountActivity.other_name == new_activity.other_name,
-                BankAccountActivity.posted_on == new_activity.posted_on,
-                BankAccountActivity.valid_on == new_activity.valid_on
-        )).first() is None:
-            transactions.append(new_activity)
-        else:
+        ))
+
+    if not activities:
+        return (transactions, old_transactions)
+
+    imported = set(session.session.query(
+        BankAccountActivity.amount,
+        BankAccountActivity.reference,
+        BankAccountActivity.other_account_number,
+        BankAccountActivity.other_routing_number,
+        BankAccountActivity.other_name,
+        BankAccountActivity.posted_on,
+        BankAccountActivity.valid_on,
+    ).filter(
+        BankAccountActivity.bank_account_id == bank_account.id,
+        BankAccountActivity.posted_on.between(
+            min(a.posted_on for a in activities),
+            max(a.posted_on for a in activities)),
+    ))
+
+    for new_activity in activities:
+        if _activity_identity(new_activity) in imported:
             old_transactions.append(new_activity)
+        else:
+            transactions.append(new_activity)
 
     return (transactions, old_transactions)
 
@@ -732,50 +1024,122 @@ def build_transactions_query(account, search=None, sort_by='valid_on', sort_orde
 
     return query
 
+ActivityMatch = namedtuple("ActivityMatch", ["user", "confidence"])
+
+#: Confidence of a match by a user id with valid checksum
+MATCH_CONFIDENCE_USER_ID = 1.0
+#: … if the dash of a type 2 user id was missing
+MATCH_CONFIDENCE_USER_ID_WITHOUT_DASH = 0.9
+#: … if the user id could only be found after removing all spaces
+MATCH_CONFIDENCE_USER_ID_WITHOUT_SPACES = 0.8
+#: Confidence of a match by the name in a ``gerok38/<name>`` reference
+MATCH_CONFIDENCE_NAME = 0.6
+#: … if several users have that name
+MATCH_CONFIDENCE_AMBIGUOUS_NAME = 0.3
+
+_match_ignored_text = ('AWV-MELDEPFLICHT BEACHTENHOTLINE BUNDESBANK.'
+                       '(0800) 1234-111')
+_match_reference_pattern = re.compile(
+    r"(([\d]{4,6} ?[-/?:,+.]? ?[\d]{1,2})|(gerok38|GEROK38|Gerok38)/(([a-zA-Z]*\s?)+))")
+_match_user_id_pattern = re.compile(r"(([\d]{4,6} ?[-/?:,+.]? ?[\d]{1,2}))")
+_match_user_id_separators = str.maketrans('/?:,+.', '------', ' ')
+
+
+def _parse_activity_reference(reference):
+    """Find a user id or name in the reference of a bank account activity.
+
+    :param str reference:
+    :return: A tuple of ``'id'`` or ``'name'``, the user id resp. the name,
+        and the confidence, or ``None``.
+    """
+    from pycroft.lib.user import check_user_id
+    confidence = MATCH_CONFIDENCE_USER_ID
+    cleaned_reference = reference.replace(_match_ignored_text, '')
+    search = _match_reference_pattern.search(cleaned_reference)
+    if search is None:
+        search = _match_user_id_pattern.search(
+            cleaned_reference.replace(' ', ''))
+        confidence = MATCH_CONFIDENCE_USER_ID_WITHOUT_SPACES
+    if search is None:
+        return None
+
+    if reference.lower().startswith('gerok38'):
+        if search.re is not _match_reference_pattern or search.group(4) is None:
+            return None
+        return 'name', search.group(4).lower(), MATCH_CONFIDENCE_NAME
+
+    if search.group(2) is None:
+        return None
+    uid = search.group(2).translate(_match_user_id_separators)
+    if uid[-2] != '-' and uid[-3] != '-':
+        # interpret as type 2 UID with missing -
+        uid = uid[:-2] + '-' + uid[-2:]
+        confidence = min(confidence, MATCH_CONFIDENCE_USER_ID_WITHOUT_DASH)
+    if not check_user_id(uid):
+        return None
+    return 'id', int(uid.split("-")[0]), confidence
+
+
+def get_activity_matches(activities=None):
+    """Find the users unmatched bank account activities belong to.
+
+    The references are parsed with precompiled patterns, and the candidate
+    users are fetched with one query by id and one by name for all
+    activities together.
+
+    :param iterable[BankAccountActivity]|None activities: The activities
+        to match.  Defaults to all activities without a transaction.
+    :returns: The matched activities with the user and the confidence of
+        the match, between 0 and 1.
+    :rtype: dict[BankAccountActivity,ActivityMatch]
+    """
+    if activities is None:
+        activities = (BankAccountActivity.q
+                      .options(joinedload(BankAccountActivity.bank_account))
+                      .filter(BankAccountActivity.transaction_id == None)
+                      .all())
+
+    parsed = [(activity, _parse_activity_reference(activity.reference))
+              for activity in activities]
+    parsed = [(activity, result) for activity, result in parsed
+              if result is not None]
+
+    user_ids = {value for _, (kind, value, _) in parsed if kind == 'id'}
+    names = {value for _, (kind, value, _) in parsed if kind == 'name'}
+    users_by_id = {}
+    if user_ids:
+        users_by_id = {user.id: user for user in
+                       User.q.filter(User.id.in_(user_ids))}
+    users_by_name = {}
+    if names:
+        for user in (User.q.filter(func.lower(User.name).in_(names))
+                     .order_by(User.id)):
+            users_by_name.setdefault(user.name.lower(), []).append(user)
+
+    matching = {}
+    for activity, (kind, value, confidence) in parsed:
+        if kind == 'id':
+            user = users_by_id.get(value)
+        else:
+            candidates = users_by_name.get(value, ())
+            user = next(iter(candidates), None)
+            if len(candidates) > 1:
+                confidence = MATCH_CONFIDENCE_AMBIGUOUS_NAME
+        if user is not None:
+            matching[activity] = ActivityMatch(user, confidence)
+    return matching
+
+
 def match_activities():
     """Get a dict of all unmatched transactions and a user they should be matched with
 
-    :param BankAccount bank_account: The BankAccount to get the unmatched transactions from
+    See :func:`get_activity_matches` for the confidence of the matches.
 
     :returns: Dictionary with transaction and user
     :rtype: Dict
     """
-    from pycroft.lib.user import check_user_id
-    matching = {}
-    activity_q = (BankAccountActivity.q
-                  .options(joinedload(BankAccountActivity.bank_account))
-                  .filter(BankAccountActivity.transaction_id == None))
-
-    for activity in activity_q.all():
-        # search for user-ID
-        user = None
-        reference = activity.reference.replace('AWV-MELDEPFLICHT BEACHTENHOTLINE BUNDESBANK.(0800) 1234-111', '')
-        search = re.search(r"(([\d]{4,6} ?[-/?:,+.]? ?[\d]{1,2})|(gerok38|GEROK38|Gerok38)/(([a-zA-Z]*\s?)+))", reference)
-
-        if search is None:
-            search = re.search(r"(([\d]{4,6} ?[-/?:,+.]? ?[\d]{1,2}))", reference.replace(' ', ''))
-
-        if search:
-            if activity.reference.lower().startswith('gerok38'):
-                user = User.q.filter(func.lower(User.name)==func.lower(search.group(4))).first()
-            else:
-                try:
-                    uid = search.group(2).replace(' ', '').replace('/', '-') \
-                        .replace('?', '-').replace(':', '-').replace(',', '-') \
-                        .replace('+', '-').replace('.', '-')
-                    if uid[-2] is not '-' and uid[-3] is not '-':
-                        # interpret as type 2 UID with missing -
-                        uid = uid[:-2] + '-' + uid[-2:]
-
-                    if check_user_id(uid):
-                        uid = uid.split("-")[0]
-                        user = User.q.get(uid)
-                except AttributeError:
-                    user = None
-            if user:
-                matching.update({activity: user})
-
-    return matching
+    return {activity: match.user
+            for activity, match in get_activity_matches().items()}
 
 
 @with_transaction
@@ -855,4 +1219,4 @@ def estimate_balance(user, end_date):
     if not this_month_fee_outstanding:
         months_to_pay -= 1
 
-    return (-user.account.balance) - (months_to_pay * last_fee.regular_fee)
+    return (-user.account.balance) - (months_to_pay * Decimal(last_fee.regular_fee))
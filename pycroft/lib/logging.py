@@ -2,6 +2,9 @@
 # This file is part of the Pycroft project and licensed under the terms of
 # the Apache License, Version 2.0. See the LICENSE file for details.
 from datetime import datetime
+
+from sqlalchemy import func, select
+
 from pycroft.model import session
 from pycroft.model.facilities import Room
 from pycroft.model.logging import UserLogEntry, RoomLogEntry, LogEntry, \
@@ -76,6 +79,39 @@ def log_user_event(message, author, user, created_at=None):
                              user=user)
 
 
+@with_transaction
+def log_user_events(messages, author, created_at=None):
+    """
+    This method will create a new UserLogEntry for every given user with
+    multi-row inserts.
+
+    :param iterable[tuple[int,unicode]] messages: pairs of the id of the user
+        for which the log should be created and the log message text
+    :param User author: user responsible for the entries
+    :param datetime|None created_at: Creation time of the entries. Defaults
+    to current database time if None.
+    :return: the number of created entries.
+    """
+    messages = list(messages)
+    if not messages:
+        return 0
+    ids = [id_ for id_, in session.session.execute(
+        select([func.nextval('log_entry_id_seq')])
+        .select_from(func.generate_series(1, len(messages))))]
+    if created_at is None:
+        created_at = func.current_timestamp()
+    session.session.execute(LogEntry.__table__.insert().values([
+        {'id': id_, 'type': UserLogEntry.__mapper__.polymorphic_identity,
+         'message': message, 'author_id': author.id, 'created_at': created_at}
+        for id_, (_, message) in zip(ids, messages)
+    ]))
+    session.session.execute(UserLogEntry.__table__.insert().values([
+        {'id': id_, 'user_id': user_id}
+        for id_, (user_id, _) in zip(ids, messages)
+    ]))
+    return len(messages)
+
+
 def log_room_event(message, author, room, created_at=None):
     """
     This method will create a new RoomLogEntry.
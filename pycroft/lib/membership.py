@@ -10,12 +10,17 @@ This module contains functions concerning groups, membership, and property
 management.
 
 """
+from sqlalchemy import and_, func, or_, select, tuple_
+
 from pycroft.helpers.i18n import deferred_gettext
-from pycroft.helpers.interval import UnboundedInterval, IntervalSet, closed
-from pycroft.lib.logging import log_user_event, log_event
+from pycroft.helpers.interval import (
+    UnboundedInterval, IntervalSet, closed, closedopen, single)
+from pycroft.lib.logging import log_user_event, log_user_events, log_event
+
 from pycroft.model import session
 from pycroft.model.session import with_transaction
-from pycroft.model.user import Membership
+from pycroft.model.user import Membership, Property, \
+    invalidate_property_index
 
 
 @with_transaction
@@ -133,6 +138,127 @@ def remove_member_of(user, group, processor, during=UnboundedInterval):
                    user=user, author=processor)
 
 
+@with_transaction
+def make_members_of(users, group, processor, begins_at):
+    """
+    Makes users members of a group from a given point in time on.
+
+    This is the bulk variant of :func:`make_member_of` for intervals without
+    an end.  Memberships overlapping with the new one are joined together in
+    the same way, but with a few set-based statements for all users instead
+    of a query and flush per user.
+
+    :param iterable[User] users: the users
+    :param Group group: the group
+    :param User processor: User issuing the addition
+    :param datetime begins_at: begin of the new memberships
+    :return: the number of users made members
+    :rtype: int
+    """
+    from pycroft.lib.user import invalidate_status
+    if group.permission_level > processor.permission_level:
+        raise PermissionError("cannot create a membership for a group with a"
+                              " higher permission level")
+
+    user_ids = {user.id for user in users}
+    if not user_ids:
+        return 0
+    session.session.flush()
+
+    membership = Membership.__table__
+    removed = session.session.execute(
+        membership.delete()
+        .where(and_(membership.c.group_id == group.id,
+                    membership.c.user_id.in_(user_ids),
+                    or_(membership.c.ends_at.is_(None),
+                        membership.c.ends_at >= begins_at)))
+        .returning(membership.c.user_id, membership.c.begins_at)
+    ).fetchall()
+    merged_begin = dict.fromkeys(user_ids, begins_at)
+    for user_id, begin in removed:
+        if merged_begin[user_id] is not None:
+            merged_begin[user_id] = (None if begin is None
+                                     else min(begin, merged_begin[user_id]))
+    session.session.execute(membership.insert().values([
+        {'begins_at': begin, 'ends_at': None, 'group_id': group.id,
+         'user_id': user_id}
+        for user_id, begin in merged_begin.items()
+    ]))
+    invalidate_property_index()
+    invalidate_status()
+
+    message = deferred_gettext(u"Added to group {group} during {during}.")
+    message = message.format(group=group.name,
+                             during=closedopen(begins_at, None)).to_json()
+    log_user_events(((user_id, message) for user_id in user_ids), processor)
+    return len(user_ids)
+
+
+@with_transaction
+def remove_members_of(users, groups, processor, when):
+    """
+    Terminates the memberships of users in groups at a given point in time.
+
+    This is the bulk variant of ``remove_member_of(user, group, processor,
+    closedopen(when, None))`` for every user and group, but only for the
+    pairs of users and groups with a membership active at `when`.
+
+    :param iterable[User] users: the users
+    :param iterable[Group] groups: the groups
+    :param User processor: User issuing the removal
+    :param datetime when: the time at which the memberships end
+    :return: the number of terminated (user, group) memberships
+    :rtype: int
+    """
+    from pycroft.lib.user import invalidate_status
+    groups = {group.id: group for group in groups}
+    for group in groups.values():
+        if group.permission_level > processor.permission_level:
+            raise PermissionError("cannot delete a membership for a group"
+                                  " with a higher permission level")
+
+    user_ids = {user.id for user in users}
+    if not user_ids or not groups:
+        return 0
+    session.session.flush()
+
+    pairs = session.session.query(
+        Membership.user_id, Membership.group_id
+    ).filter(
+        Membership.user_id.in_(user_ids),
+        Membership.group_id.in_(groups),
+        Membership.active(single(when)),
+    ).distinct().all()
+    if not pairs:
+        return 0
+
+    membership = Membership.__table__
+    pair_filter = tuple_(membership.c.user_id,
+                         membership.c.group_id).in_(pairs)
+    # Memberships beginning at or after `when` vanish completely, the
+    # others end at `when`.
+    session.session.execute(membership.delete().where(and_(
+        pair_filter,
+        membership.c.begins_at >= when,
+    )))
+    session.session.execute(membership.update().where(and_(
+        pair_filter,
+        or_(membership.c.ends_at.is_(None), membership.c.ends_at > when),
+    )).values(ends_at=when))
+    invalidate_property_index()
+    invalidate_status()
+
+    message = deferred_gettext(u"Removed from group {group} during {during}.")
+    during = closedopen(when, None)
+    log_user_events(
+        ((user_id, message.format(group=groups[group_id].name,
+                                  during=during).to_json())
+         for user_id, group_id in pairs),
+        processor
+    )
+    return len(pairs)
+
+
 @with_transaction
 def edit_property_group(group, name, permission_level, processor):
     log_event("Edited property group {} -> {}.".format((group.name, group.permission_level),
@@ -148,3 +274,106 @@ def delete_property_group(group, processor):
               processor)
 
     session.session.delete(group)
+
+
+@with_transaction
+def refresh_materialized_properties():
+    """
+    Brings the `materialized_current_property` table up to date.
+
+    Changes to memberships and properties are applied by triggers right
+    away, but memberships beginning or ending as time passes are not.  This
+    function is meant to be run periodically to catch up on those.
+
+    :return: The number of rows that have been inserted, updated or deleted
+    :rtype: int
+    """
+    return session.session.execute(
+        select([func.refresh_materialized_current_property()])
+    ).scalar()
+
+
+def evaluate_properties(user_ids, property_names, when=None):
+    """
+    Evaluate properties for many users at once.
+
+    Like :meth:`User.has_property`, a user has a property if it is granted
+    by at least one of the groups the user is an active member of during
+    `when` and denied by none of them.  All users and properties are
+    evaluated in one query.
+
+    :param user_ids: ids of the users
+    :param property_names: names of the properties to evaluate
+    :param Interval when: the interval to evaluate the memberships in, now
+        by default
+    :return: A mapping of every user id to the set of the properties of
+        `property_names` the user has
+    :rtype: dict[int, frozenset[str]]
+    """
+    user_ids = set(user_ids)
+    property_names = set(property_names)
+    properties = {user_id: set() for user_id in user_ids}
+    if user_ids and property_names:
+        if when is None:
+            when = single(session.utcnow())
+        granted = session.session.execute(
+            select([Membership.user_id, Property.name])
+            .select_from(Membership.__table__.join(
+                Property.__table__,
+                Property.property_group_id == Membership.group_id))
+            .where(Membership.user_id.in_(user_ids))
+            .where(Property.name.in_(property_names))
+            .where(Membership.active(when))
+            .group_by(Membership.user_id, Property.name)
+            .having(func.every(Property.granted))
+        )
+        for user_id, name in granted:
+            properties[user_id].add(name)
+    return {user_id: frozenset(names)
+            for user_id, names in properties.items()}
+
+
+def property_pivot(property_names, when=None, groups=None):
+    """
+    Build a selectable with one row per user and one boolean column per
+    property.
+
+    The properties are evaluated like in :func:`evaluate_properties`, but
+    the selectable can be joined into other queries.  All properties are
+    aggregated in a single grouped join over the memberships instead of
+    two correlated ``EXISTS`` subqueries per property and user.  Users
+    without an active membership during `when` have no row.
+
+    :param property_names: names of the properties, each of which becomes
+        a column of the same name
+    :param Interval when: the interval to evaluate the memberships in, now
+        by default
+    :param dict groups: an optional mapping of column names to groups.  The
+        column is true if the user is an active member of the group.
+    :return: An alias with a ``user_id`` column and the property and group
+        columns
+    """
+    if when is None:
+        when = single(session.utcnow())
+    property_names = set(property_names)
+    groups = groups or {}
+    columns = [Membership.user_id.label('user_id')]
+    columns.extend(
+        func.coalesce(func.every(Property.granted)
+                      .filter(Property.name == name), False).label(name)
+        for name in sorted(property_names)
+    )
+    columns.extend(
+        func.bool_or(Membership.group_id == group.id).label(name)
+        for name, group in groups.items()
+    )
+    return (
+        select(columns)
+        .select_from(Membership.__table__.outerjoin(
+            Property.__table__,
+            and_(Property.property_group_id == Membership.group_id,
+                 Property.name.in_(property_names))))
+        .where(Membership.active(when))
+        .group_by(Membership.user_id)
+        .alias('property_pivot')
+    )
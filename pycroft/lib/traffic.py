@@ -9,22 +9,517 @@ pycroft.lib.traffic
 This module contains functions concerning network traffic
 
 """
-from datetime import timedelta
+import csv
+from collections import namedtuple
+from datetime import datetime, time, timedelta, timezone
+from io import StringIO
+from itertools import islice
 
-from sqlalchemy import func, select, literal_column
+from sqlalchemy import BigInteger, Date, and_, cast, func, or_, select, \
+    literal, literal_column, true, tuple_
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 
+from pycroft import config
+from pycroft.helpers.i18n import deferred_gettext
+from pycroft.helpers.interval import single
+from pycroft.lib.logging import log_user_events
+from pycroft.lib.membership import make_members_of, remove_members_of
 from pycroft.model import session
-from pycroft.model.traffic import TrafficVolume
-from pycroft.model.user import User
+from pycroft.model.session import with_transaction
+from pycroft.model.facilities import Building, Room
+from pycroft.model.host import Host, IP, Interface
+from pycroft.model.net import Subnet
+from pycroft.model.traffic import TrafficDailyUser, TrafficLeaderboard, \
+    TrafficVolume, pmacct_traffic_staging, traffic_volume_default
+from pycroft.model.user import Membership, User
+
+
+#: The windows in days of the traffic leaderboards
+TRAFFIC_LEADERBOARD_WINDOWS = (1, 7, 30)
+#: The number of users kept per leaderboard
+TRAFFIC_LEADERBOARD_SIZE = 100
+#: The age after which a leaderboard is not used anymore.  It is refreshed
+#: every five minutes by the ``refresh_traffic_leaderboard`` task.
+TRAFFIC_LEADERBOARD_MAX_AGE = timedelta(minutes=30)
+
+
+def _users_by_traffic(days):
+    usage = func.sum(TrafficDailyUser.amount)
+    return (
+        select([TrafficDailyUser.user_id, usage.label('amount')])
+        .where(TrafficDailyUser.user_id != 0)
+        .where(TrafficDailyUser.day
+               >= (session.utcnow() - timedelta(days - 1)).date())
+        .group_by(TrafficDailyUser.user_id)
+        .order_by(usage.desc(), TrafficDailyUser.user_id)
+    )
+
+
+@with_transaction
+def refresh_traffic_leaderboards(windows=TRAFFIC_LEADERBOARD_WINDOWS,
+                                 size=TRAFFIC_LEADERBOARD_SIZE):
+    """Rebuild the ``traffic_leaderboard`` of each window from
+    ``traffic_daily_user``.
+
+    Each window is computed by a sequential scan of ``traffic_daily_user``
+    filtered by day, a hash aggregate per user and a top-N heapsort of
+    `size` rows.  The rollup holds one row per user, day and direction, so
+    this does not depend on the size of ``traffic_volume``.
+
+    :param windows: the windows in days to rebuild
+    :param int size: the number of users kept per window
+    :return: The number of rows inserted
+    :rtype: int
+    """
+    session.session.execute(
+        TrafficLeaderboard.__table__.delete()
+        .where(TrafficLeaderboard.days.in_(windows))
+    )
+    inserted = 0
+    for days in windows:
+        top = _users_by_traffic(days).limit(size).alias('top')
+        inserted += session.session.execute(
+            TrafficLeaderboard.__table__.insert().from_select(
+                ['days', 'rank', 'user_id', 'amount', 'refreshed_at'],
+                select([literal(days),
+                        func.row_number().over(
+                            order_by=(top.c.amount.desc(), top.c.user_id)),
+                        top.c.user_id, top.c.amount,
+                        func.current_timestamp()])
+            )
+        ).rowcount
+    return inserted
 
 
 def get_users_with_highest_traffic(days, limit):
-    return session.session.execute(
-        select([User.id, User.name, func.sum(TrafficVolume.amount).label('traffic_for_days')])
-        .select_from(User.__table__.join(TrafficVolume, TrafficVolume.user_id == User.id))
-        .where(User.id != 0)
-        .where(TrafficVolume.timestamp >= (session.utcnow() - timedelta(days - 1)).date())
-        .group_by(User.id, User.name)
-        .order_by(literal_column('traffic_for_days').desc())
+    """Return the `limit` users with the most traffic in the last `days`
+    days as rows of ``id``, ``name`` and ``traffic_for_days``.
+
+    If the window has been refreshed by :func:`refresh_traffic_leaderboards`
+    within :data:`TRAFFIC_LEADERBOARD_MAX_AGE` and `limit` does not exceed
+    its size, the rows are read from ``traffic_leaderboard``, which holds at
+    most :data:`TRAFFIC_LEADERBOARD_SIZE` rows per window, joined to the
+    users by primary key.  This does not depend on the amount of traffic.
+    Otherwise the users are ranked from ``traffic_daily_user`` right away.
+    """
+    leaderboard = (
+        select([User.id, User.name,
+                TrafficLeaderboard.amount.label('traffic_for_days')])
+        .select_from(TrafficLeaderboard.__table__.join(
+            User.__table__, User.id == TrafficLeaderboard.user_id))
+        .where(TrafficLeaderboard.days == days)
+        .where(TrafficLeaderboard.refreshed_at
+               >= session.utcnow() - TRAFFIC_LEADERBOARD_MAX_AGE)
+        .order_by(TrafficLeaderboard.rank)
         .limit(limit)
+    )
+    if limit <= TRAFFIC_LEADERBOARD_SIZE:
+        rows = session.session.execute(leaderboard).fetchall()
+        if rows:
+            return rows
+
+    top = _users_by_traffic(days).limit(limit).alias('top')
+    return session.session.execute(
+        select([User.id, User.name, top.c.amount.label('traffic_for_days')])
+        .select_from(top.join(User.__table__, User.id == top.c.user_id))
+        .order_by(top.c.amount.desc(), top.c.user_id)
     ).fetchall()
+
+
+TrafficLimitActions = namedtuple('TrafficLimitActions',
+                                 ['blocked', 'unblocked'])
+
+
+@with_transaction
+def apply_traffic_limit(limit, days=7, processor=None):
+    """Apply the traffic limit exceeded group to the users with more than
+    `limit` bytes of traffic in the last `days` days, and remove it from
+    everyone else.
+
+    The usage of all users is computed from ``traffic_daily_user`` in one
+    query together with the current members of the group.  Every active
+    membership in the group is ended as soon as the user is back under the
+    limit, including memberships which were not created by this function,
+    e.g. ones assigned by hand.  The reason of every change is written to
+    the user log.
+
+    :param int limit: the traffic limit in bytes
+    :param int days: the number of days of the rolling window, including
+        today
+    :param User processor: The user issuing the changes, the root user by
+        default
+    :return: the ids of the users which were added to resp. removed from the
+        group
+    :rtype: TrafficLimitActions
+    """
+    if processor is None:
+        processor = User.q.get(0)
+    group = config.traffic_limit_exceeded_group
+    now = session.utcnow()
+
+    usage = (select([TrafficDailyUser.user_id,
+                     func.sum(TrafficDailyUser.amount).label('amount')])
+             .where(TrafficDailyUser.day >= now.date() - timedelta(days - 1))
+             .group_by(TrafficDailyUser.user_id)
+             .alias('usage'))
+    members = (select([Membership.user_id])
+               .where(and_(Membership.group_id == group.id,
+                           Membership.active(single(now)),
+                           # memberships ended by a previous call at the
+                           # same time do not count
+                           or_(Membership.ends_at.is_(None),
+                               Membership.ends_at > now)))
+               .distinct()
+               .alias('members'))
+    exceeded = func.coalesce(usage.c.amount, 0) > limit
+    rows = session.session.execute(
+        select([User.id, exceeded, members.c.user_id.isnot(None)])
+        .select_from(User.__table__
+                     .outerjoin(usage, usage.c.user_id == User.id)
+                     .outerjoin(members, members.c.user_id == User.id))
+        .where(or_(exceeded, members.c.user_id.isnot(None)))
+    ).fetchall()
+
+    to_block = [user_id for user_id, over, member in rows if over and not member]
+    to_unblock = [user_id for user_id, over, member in rows
+                  if member and not over]
+    if to_block:
+        make_members_of(User.q.filter(User.id.in_(to_block)), group,
+                        processor, now)
+        message = deferred_gettext(
+            u"Traffic limit of {limit} bytes in {days} days exceeded."
+        ).format(limit=limit, days=days).to_json()
+        log_user_events(((user_id, message) for user_id in to_block),
+                        processor)
+    if to_unblock:
+        remove_members_of(User.q.filter(User.id.in_(to_unblock)), [group],
+                          processor, now)
+        message = deferred_gettext(
+            u"Traffic limit of {limit} bytes in {days} days no longer "
+            u"exceeded, membership in {group} ended."
+        ).format(limit=limit, days=days, group=group.name).to_json()
+        log_user_events(((user_id, message) for user_id in to_unblock),
+                        processor)
+
+    return TrafficLimitActions(blocked=to_block, unblocked=to_unblock)
+
+
+#: The traffic of consecutive days as columns, i.e. equally long lists of the
+#: days, the ingress and the egress bytes.
+TrafficSeries = namedtuple('TrafficSeries', ['timestamps', 'ingress', 'egress'])
+
+
+def _daily_traffic(key, day, amount, type_, *criteria):
+    return (select([key.label('key'), day.label('day'),
+                    func.sum(amount).filter(type_ == 'Ingress').label('ingress'),
+                    func.sum(amount).filter(type_ == 'Egress').label('egress')])
+            .where(and_(*criteria))
+            .group_by(key, day)
+            .alias('traffic'))
+
+
+def _traffic_series(keys, traffic, start, end):
+    """Yield the traffic per key as :class:`TrafficSeries`.
+
+    :param keys: a selectable with a ``key`` column.
+    :param traffic: a selectable with the columns ``key``, ``day``,
+        ``ingress`` and ``egress``.
+    """
+    days = func.generate_series(
+        func.date_trunc('day', start), func.date_trunc('day', end),
+        literal_column("interval '1 day'")
+    ).alias('day')
+    day = literal_column('day.day')
+
+    def column(value):
+        return func.array_agg(aggregate_order_by(value, day))
+
+    rows = session.session.execute(
+        select([keys.c.key,
+                column(day),
+                column(cast(func.coalesce(traffic.c.ingress, 0), BigInteger)),
+                column(cast(func.coalesce(traffic.c.egress, 0), BigInteger))])
+        .select_from(
+            keys.join(days, true())
+            .outerjoin(traffic, and_(traffic.c.key == keys.c.key,
+                                     traffic.c.day == cast(day, Date))))
+        .group_by(keys.c.key)
+        .execution_options(stream_results=True)
+    )
+    try:
+        for key, timestamps, ingress, egress in rows:
+            yield key, TrafficSeries(timestamps, ingress, egress)
+    finally:
+        rows.close()
+
+
+def _rollup_traffic(key, start, end, *criteria):
+    return _daily_traffic(
+        key, TrafficDailyUser.day, TrafficDailyUser.amount,
+        TrafficDailyUser.type,
+        TrafficDailyUser.day.between(cast(start, Date), cast(end, Date)),
+        *criteria)
+
+
+def users_traffic_series(user_ids, start, end):
+    """Yield the daily traffic of each of the given users.
+
+    :param user_ids:
+    :param datetime start:
+    :param datetime end:
+    :return: an iterator of ``(user_id, series)`` tuples, where series is a
+        :class:`TrafficSeries`.  Days without traffic count as 0.
+    """
+    keys = select([User.id.label('key')]).where(User.id.in_(user_ids)) \
+        .alias('users')
+    traffic = _rollup_traffic(TrafficDailyUser.user_id, start, end,
+                              TrafficDailyUser.user_id.in_(user_ids))
+    return _traffic_series(keys, traffic, start, end)
+
+
+def user_traffic_series(user_id, start, end):
+    """Return the daily traffic of a user as :class:`TrafficSeries`.
+
+    See :func:`users_traffic_series`.  The series is empty if the user does
+    not exist or `end` is before `start`.
+    """
+    series = dict(users_traffic_series([user_id], start, end))
+    return series.get(user_id, TrafficSeries([], [], []))
+
+
+def buildings_traffic_series(building_ids, start, end):
+    """Yield the daily traffic of the current inhabitants of each of the given
+    buildings.
+
+    :return: an iterator of ``(building_id, series)`` tuples, see
+        :func:`users_traffic_series`.
+    """
+    keys = select([Building.id.label('key')]) \
+        .where(Building.id.in_(building_ids)).alias('buildings')
+    traffic = _rollup_traffic(
+        Room.building_id, start, end,
+        TrafficDailyUser.user_id == User.id, User.room_id == Room.id,
+        Room.building_id.in_(building_ids))
+    return _traffic_series(keys, traffic, start, end)
+
+
+def subnets_traffic_series(subnet_ids, start, end):
+    """Yield the daily traffic of the IPs of each of the given subnets.
+
+    :return: an iterator of ``(subnet_id, series)`` tuples, see
+        :func:`users_traffic_series`.
+    """
+    keys = select([Subnet.id.label('key')]) \
+        .where(Subnet.id.in_(subnet_ids)).alias('subnets')
+    traffic = _daily_traffic(
+        IP.subnet_id, cast(TrafficVolume.timestamp, Date),
+        TrafficVolume.amount, TrafficVolume.type,
+        _traffic_volume_between(start, end),
+        TrafficVolume.ip_id == IP.id, IP.subnet_id.in_(subnet_ids))
+    return _traffic_series(keys, traffic, start, end)
+
+
+def _traffic_volume_between(start, end):
+    """The ``traffic_volume`` rows of the days from `start` to `end` as a
+    range condition on the timestamp."""
+    return and_(
+        TrafficVolume.timestamp >= func.date_trunc('day', start),
+        TrafficVolume.timestamp
+        < func.date_trunc('day', end) + literal_column("interval '1 day'"))
+
+
+def get_ip_traffic(user_id, start, end):
+    """Return the traffic of every IP of the hosts of a user from `start` to
+    `end`.
+
+    The traffic is summed up in SQL with range scans over the
+    ``(ip_id, timestamp)`` index of ``traffic_volume``.
+
+    :param int user_id:
+    :param datetime start:
+    :param datetime end:
+    :return: rows of ``host_id``, ``host_name``, ``interface_id``, ``mac``,
+        ``ip_id``, ``address``, ``ingress`` and ``egress``, ordered by host,
+        interface and IP.  IPs without traffic have 0 ingress and egress.
+    """
+    def amount(type_):
+        return cast(func.coalesce(
+            func.sum(TrafficVolume.amount).filter(TrafficVolume.type == type_),
+            0
+        ), BigInteger)
+
+    return session.session.execute(
+        select([Host.id.label('host_id'), Host.name.label('host_name'),
+                Interface.id.label('interface_id'), Interface.mac,
+                IP.id.label('ip_id'), IP.address,
+                amount('Ingress').label('ingress'),
+                amount('Egress').label('egress')])
+        .select_from(
+            Host.__table__
+            .join(Interface.__table__, Interface.host_id == Host.id)
+            .join(IP.__table__, IP.interface_id == Interface.id)
+            .outerjoin(TrafficVolume.__table__,
+                       and_(TrafficVolume.ip_id == IP.id,
+                            _traffic_volume_between(start, end))))
+        .where(Host.owner_id == user_id)
+        .group_by(Host.id, Interface.id, IP.id)
+        .order_by(Host.id, Interface.id, IP.id)
+    ).fetchall()
+
+
+def traffic_volume_export_query(day):
+    """Select the ``traffic_volume`` rows of the UTC `day` for exporting.
+
+    The bounds are constants, so only the partition of the day is scanned.
+
+    :param date day:
+    :return: a select of ``timestamp``, ``type``, ``address``, ``user_id``,
+        ``amount`` and ``packets``, ordered by timestamp
+    """
+    start = datetime.combine(day, time(), tzinfo=timezone.utc)
+    return (
+        select([TrafficVolume.timestamp, TrafficVolume.type, IP.address,
+                TrafficVolume.user_id, TrafficVolume.amount,
+                TrafficVolume.packets])
+        .select_from(TrafficVolume.__table__.join(
+            IP.__table__, IP.id == TrafficVolume.ip_id))
+        .where(TrafficVolume.timestamp >= start)
+        .where(TrafficVolume.timestamp < start + timedelta(days=1))
+        .order_by(TrafficVolume.timestamp, TrafficVolume.ip_id,
+                  TrafficVolume.type)
+    )
+
+
+def stage_pmacct_traffic(records, batch_size=10000):
+    """Copy traffic records into the pmacct staging table.
+
+    The records are written with ``COPY`` in batches of `batch_size` rows.
+    They are accounted for in ``traffic_volume`` by
+    :func:`merge_pmacct_traffic`.
+
+    :param records: Tuples of the direction (``'Ingress'`` or ``'Egress'``),
+        the IP address, the time, the number of bytes and the number of
+        packets.
+    :param int batch_size:
+    :return: the number of staged records.
+    """
+    columns = ('packets', 'bytes', 'stamp_inserted', 'ip_src', 'ip_dst')
+    copy = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+        pmacct_traffic_staging.name, ', '.join(columns))
+    records = iter(records)
+    count = 0
+    with session.session.connection().connection.cursor() as cursor:
+        while True:
+            buffer = StringIO()
+            writer = csv.writer(buffer)
+            for type_, address, stamp, bytes_, packets in islice(records,
+                                                                 batch_size):
+                if type_ == 'Egress':
+                    ip_src, ip_dst = address, None
+                elif type_ == 'Ingress':
+                    ip_src, ip_dst = None, address
+                else:
+                    raise ValueError("type must be one of 'Ingress', 'Egress'")
+                writer.writerow((packets, bytes_, stamp.isoformat(),
+                                 ip_src, ip_dst))
+                count += 1
+            if not buffer.tell():
+                return count
+            buffer.seek(0)
+            cursor.copy_expert(copy, buffer)
+
+
+@with_transaction
+def merge_pmacct_traffic():
+    """Account the staged pmacct traffic per IP, day and direction.
+
+    :return: the number of inserted or updated ``traffic_volume`` rows.
+    """
+    return session.session.execute(
+        select([func.pmacct_traffic_merge_staging()])).scalar()
+
+
+@with_transaction
+def ingest_pmacct_traffic(records):
+    """Stage traffic records and merge them into ``traffic_volume``.
+
+    See :func:`stage_pmacct_traffic` for the format of the records.
+
+    :return: the number of inserted or updated ``traffic_volume`` rows.
+    """
+    stage_pmacct_traffic(records)
+    return merge_pmacct_traffic()
+
+
+@with_transaction
+def create_traffic_partitions(days_ahead=7):
+    """Create the ``traffic_volume`` partitions up to `days_ahead` days ahead.
+
+    :param int days_ahead:
+    :return: the number of created partitions.
+    """
+    today = session.utcnow().date()
+    return session.session.execute(
+        select([func.traffic_volume_create_partitions(
+            today, today + timedelta(days_ahead))])).scalar()
+
+
+def traffic_retention_limit(keep_days=7):
+    """Return the first day of traffic data to keep.
+
+    :param int keep_days: the number of days to keep, including today.
+    :rtype: date
+    """
+    return session.utcnow().date() - timedelta(keep_days - 1)
+
+
+@with_transaction
+def drop_old_traffic_partitions(before):
+    """Drop the ``traffic_volume`` partitions of the days before `before`.
+
+    Dropping a partition neither fires the rollup triggers nor touches the
+    default partition, see :func:`delete_old_traffic_data`.
+
+    :param date before:
+    :return: the number of dropped partitions.
+    """
+    return session.session.execute(
+        select([func.traffic_volume_drop_partitions(before)])).scalar()
+
+
+def _delete_batch(table, key, condition, batch_size):
+    return session.session.execute(
+        table.delete().where(tuple_(*key).in_(
+            select(key).where(condition).order_by(*key).limit(batch_size)
+        ))
+    ).rowcount
+
+
+@with_transaction
+def delete_old_traffic_data(before, rollup_before=None, batch_size=10000):
+    """Delete a batch of the traffic data before `before` which is left over
+    by :func:`drop_old_traffic_partitions`.
+
+    The rows are deleted in key order from the default partition of
+    ``traffic_volume`` first.  The rollup in ``traffic_daily_user`` is kept
+    much longer than the raw data, so its rows are only deleted if
+    `rollup_before` is given.  Call this until it returns 0, committing in
+    between, to keep the transactions short.
+
+    :param date before:
+    :param date rollup_before: the first day of the rollup to keep.
+    :param int batch_size: the maximum number of rows to delete.
+    :return: the number of deleted rows.
+    """
+    default = traffic_volume_default
+    deleted = _delete_batch(
+        default, [default.c.ip_id, default.c.type, default.c.timestamp],
+        default.c.timestamp < datetime.combine(before, time(),
+                                               tzinfo=timezone.utc),
+        batch_size)
+    if deleted or rollup_before is None:
+        return deleted
+    return _delete_batch(
+        TrafficDailyUser.__table__,
+        [TrafficDailyUser.user_id, TrafficDailyUser.day, TrafficDailyUser.type],
+        TrafficDailyUser.day < rollup_before, batch_size)
@@ -13,31 +13,35 @@ This module contains.
 
 import re
 from base64 import b64encode, b64decode
+from collections import namedtuple
 from datetime import datetime, timedelta
+from itertools import chain
 
-from sqlalchemy import or_, func, select, Boolean, String
+from sqlalchemy import event, or_, func, select, Boolean, String
+from sqlalchemy.orm import Session, joinedload
 
 from pycroft import config, property
-from pycroft.helpers import user as user_helper, AttrDict
+from pycroft.helpers import user as user_helper
 from pycroft.helpers.errorcode import Type1Code, Type2Code
 from pycroft.helpers.i18n import deferred_gettext
-from pycroft.helpers.interval import closed, closedopen, single
+from pycroft.helpers.interval import closed, closedopen
 from pycroft.helpers.printing import generate_user_sheet as generate_pdf
 from pycroft.helpers.printing import generate_wifi_user_sheet as generate_wifi_pdf
-from pycroft.lib.finance import user_has_paid
-from pycroft.lib.logging import log_user_event
-from pycroft.lib.membership import make_member_of, remove_member_of
+from pycroft.lib.logging import log_user_event, log_user_events
+from pycroft.lib.membership import make_member_of, property_pivot, \
+    remove_member_of, remove_members_of
 from pycroft.lib.net import get_free_ip, MacExistsException, \
     get_subnets_for_room
 from pycroft.lib.task import schedule_user_task
 from pycroft.model import session
 from pycroft.model.facilities import Room
-from pycroft.model.finance import Account
-from pycroft.model.host import IP, Host, Interface
+from pycroft.model.finance import Account, Split
+from pycroft.model.host import IP, Host, Interface, Switch
 from pycroft.model.session import with_transaction
 from pycroft.model.task import TaskType, UserTask, TaskStatus
 from pycroft.model.traffic import TrafficHistoryEntry
-from pycroft.model.user import User, UnixAccount
+from pycroft.model.user import User, UnixAccount, Membership, Property, \
+    PropertyGroup
 from pycroft.model.webstorage import WebStorage
 
 
@@ -668,38 +672,173 @@ def move_out(user, comment, processor, when, end_membership=True):
         return user
 
 
+@with_transaction
+def move_out_users(users, comment, processor, when, end_membership=True):
+    """Move out several users at once.
+
+    This does the same as calling :py:func:`move_out` for every user, but
+    ends the memberships, deletes the hosts and writes the log messages
+    with a fixed number of statements.  Move-outs in the future are still
+    scheduled as one task per user.
+
+    :param list[User] users: The users to move out.
+    :param unicode|None comment: An optional comment
+    :param User processor: The admin who is going to move out the
+        users.
+    :param datetime when: The time the users are going to move out.
+    :param bool end_membership: Ends memberships if true
+
+    :return: The number of users moved out or scheduled to be moved out.
+    :rtype: int
+    """
+    users = list(users)
+    if when > session.utcnow():
+        for user in users:
+            move_out(user, comment, processor, when, end_membership)
+        return len(users)
+    if not users:
+        return 0
+
+    user_ids = [user.id for user in users]
+    if end_membership:
+        remove_members_of(users, {config.member_group,
+                                  config.external_group,
+                                  config.cache_group,
+                                  config.network_access_group},
+                          processor, when)
+        User.q.filter(User.id.in_(user_ids)).update(
+            {User.birthdate: None}, synchronize_session=False)
+    session.session.flush()
+
+    hosts = session.session.query(
+        Host.owner_id, Host.id, Host.room_id, Switch.host_id.isnot(None),
+        Interface.mac
+    ).outerjoin(Switch).outerjoin(Interface).filter(
+        Host.owner_id.in_(user_ids)
+    ).order_by(Host.id, Interface.id).all()
+
+    room_ids = {user.id: user.room_id for user in users}
+    # Populate the identity map, so that `user.room` needs no extra queries
+    Room.q.options(joinedload(Room.building)).filter(
+        Room.id.in_(set(room_ids.values()))).all()
+    host_ids = {user_id: set() for user_id in user_ids}
+    deleted_host_ids = set()
+    deleted_interfaces = {user_id: [] for user_id in user_ids}
+    for owner_id, host_id, room_id, is_switch, mac in hosts:
+        host_ids[owner_id].add(host_id)
+        if not is_switch and (room_id == room_ids[owner_id] or end_membership):
+            deleted_host_ids.add(host_id)
+            if mac is not None:
+                deleted_interfaces[owner_id].append(mac)
+
+    messages = []
+    for user in users:
+        num_hosts = len(host_ids[user.id])
+        interfaces = ', '.join(deleted_interfaces[user.id])
+        if user.room is not None:
+            message = u"Moved out of {room}: Deleted interfaces {interfaces} of {num_hosts} hosts."\
+                .format(room=user.room.short_name,
+                        num_hosts=num_hosts,
+                        interfaces=interfaces)
+        elif num_hosts:
+            message = u"Deleted interfaces {interfaces} of {num_hosts} hosts." \
+                .format(num_hosts=num_hosts, interfaces=interfaces)
+        else:
+            continue
+        if comment:
+            message += u"\nComment: {}".format(comment)
+        messages.append((user.id, deferred_gettext(message).to_json()))
+
+    # Interfaces, IPs and traffic are removed by the database cascades
+    if deleted_host_ids:
+        Host.q.filter(Host.id.in_(deleted_host_ids)).delete(
+            synchronize_session=False)
+    User.q.filter(User.id.in_(user_ids)).update(
+        {User.room_id: None}, synchronize_session=False)
+    log_user_events(messages, processor)
+    session.session.expire_all()
+
+    return len(users)
+
+
 admin_properties = property.property_categories[u"Nutzerverwaltung"].keys()
 
 
+UserStatus = namedtuple('UserStatus', [
+    'member', 'traffic_exceeded', 'network_access', 'wifi_access',
+    'account_balanced', 'violation', 'ldap', 'admin',
+])
+
+
 def status(user):
     """
+    Get the status of a user.
+
+    The status is fetched with a single :func:`status_query` and cached
+    until the end of the transaction, i.e. the request or task, or until
+    memberships, properties, splits or the user change.
+
     :param user: User whose status we want to look at
-    :return: dict of boolean status codes
-    """
-    return AttrDict({
-        'member': user.member_of(config.member_group),
-        'traffic_exceeded': user.member_of(config.traffic_limit_exceeded_group),
-        'network_access': user.has_property('network_access'),
-        'wifi_access': user.has_wifi_access,
-        'account_balanced': user_has_paid(user),
-        'violation': user.has_property('violation'),
-        'ldap': user.has_property('ldap'),
-        'admin': any(user.has_property(prop) for prop in admin_properties),
-    })
+    :rtype: UserStatus
+    """
+    # Pending changes have to be flushed first, as only the flush
+    # invalidates the cached status
+    if session.session.autoflush:
+        session.session.flush()
+    cache = session.transaction_cache().setdefault('user_status', {})
+    try:
+        return cache[user.id]
+    except KeyError:
+        pass
+    row = status_query().filter(User.id == user.id).one()
+    user_status = cache[user.id] = UserStatus(
+        *(getattr(row, field) for field in UserStatus._fields))
+    return user_status
 
 
 def status_query():
-    now = single(session.utcnow())
+    """
+    Query every user along with the columns of :class:`UserStatus`.
+
+    The properties and the memberships in the member and traffic limit
+    groups are evaluated in one grouped join, see :func:`property_pivot`.
+    """
+    pivot = property_pivot(
+        {'network_access', 'violation', 'ldap'} | set(admin_properties),
+        groups={'member': config.member_group,
+                'traffic_exceeded': config.traffic_limit_exceeded_group},
+    )
+
+    def flag(name):
+        return func.coalesce(pivot.c[name], False)
+
     return session.session.query(
         User,
-        User.member_of(config.member_group, now).label('member'),
+        flag('member').label('member'),
+        flag('traffic_exceeded').label('traffic_exceeded'),
+        flag('network_access').label('network_access'),
+        User.wifi_passwd_hash.isnot(None).label('wifi_access'),
         (Account.balance <= 0).label('account_balanced'),
-        # a User.properties hybrid attribute would be preferrable
-        (User.has_property('network_access', now)).label('network_access'),
-        (User.has_property('violation', now)).label('violation'),
-        (User.has_property('ldap', now)).label('ldap'),
-        or_(*(User.has_property(prop, now) for prop in admin_properties)).label('admin')
-    ).join(Account)
+        flag('violation').label('violation'),
+        flag('ldap').label('ldap'),
+        or_(*(flag(prop) for prop in admin_properties)).label('admin')
+    ).join(Account).outerjoin(pivot, pivot.c.user_id == User.id)
+
+
+def invalidate_status():
+    """Discard the cached :class:`UserStatus` of all users.
+
+    This has to be called after changing memberships or properties with
+    statements instead of through the ORM.
+    """
+    session.transaction_cache().pop('user_status', None)
+
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_status(session_, flush_context):
+    if any(isinstance(obj, (User, Membership, Property, PropertyGroup, Split))
+           for obj in chain(session_.new, session_.dirty, session_.deleted)):
+        session_.info.get('transaction_cache', {}).pop('user_status', None)
 
 
 def generate_user_sheet(user, plain_password, generation_purpose=''):
@@ -0,0 +1,29 @@
+"""index traffic_volume on (ip_id, timestamp)
+
+Revision ID: 1f2d5d62f0a3
+Revises: b0e1e6aa280a
+Create Date: 2019-10-20 14:21:09.517283
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1f2d5d62f0a3'
+down_revision = 'b0e1e6aa280a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_traffic_volume_ip_id_timestamp', 'traffic_volume',
+                    ['ip_id', 'timestamp'], unique=False)
+    op.drop_index('ix_traffic_volume_ip_id', table_name='traffic_volume')
+
+
+def downgrade():
+    op.create_index('ix_traffic_volume_ip_id', 'traffic_volume', ['ip_id'],
+                    unique=False)
+    op.drop_index('ix_traffic_volume_ip_id_timestamp',
+                  table_name='traffic_volume')
@@ -0,0 +1,226 @@
+"""partition traffic_volume by day
+
+Revision ID: 4338eac69aac
+Revises: 4c77c443086b
+Create Date: 2019-10-18 17:26:03.948117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+import pycroft
+
+
+# revision identifiers, used by Alembic.
+revision = '4338eac69aac'
+down_revision = '4c77c443086b'
+branch_labels = None
+depends_on = None
+
+
+def create_traffic_volume_table(name, **kw):
+    op.create_table(
+        name,
+        sa.Column('timestamp', pycroft.model.types.DateTimeTz(),
+                  server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+        sa.Column('amount', sa.BigInteger(), nullable=False),
+        sa.Column('type', postgresql.ENUM('Ingress', 'Egress',
+                                          name='traffic_direction',
+                                          create_type=False),
+                  nullable=False),
+        sa.Column('ip_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('packets', sa.Integer(), nullable=False),
+        sa.CheckConstraint('amount >= 0'),
+        sa.CheckConstraint('packets >= 0'),
+        sa.ForeignKeyConstraint(['ip_id'], ['ip.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('ip_id', 'type', 'timestamp'),
+        **kw
+    )
+
+
+def drop_dependent_objects():
+    # the views are dropped along with their triggers
+    op.execute("DROP VIEW IF EXISTS pmacct_traffic_egress")
+    op.execute("DROP VIEW IF EXISTS pmacct_traffic_ingress")
+    op.execute("DROP TRIGGER IF EXISTS traffic_volume_update_daily_user_insert_trigger ON traffic_volume")
+    op.execute("DROP TRIGGER IF EXISTS traffic_volume_update_daily_user_update_trigger ON traffic_volume")
+    op.execute("DROP TRIGGER IF EXISTS traffic_volume_update_daily_user_delete_trigger ON traffic_volume")
+
+
+def create_dependent_objects():
+    op.execute("""
+        CREATE OR REPLACE VIEW pmacct_traffic_egress AS SELECT traffic_volume.packets AS packets, traffic_volume.amount AS bytes, traffic_volume.timestamp AS stamp_inserted, traffic_volume.timestamp AS stamp_updated, ip.address AS ip_src
+        FROM traffic_volume JOIN ip ON ip.id = traffic_volume.ip_id
+        WHERE traffic_volume.type = 'Egress'
+    """)
+    op.execute("""
+        CREATE TRIGGER pmacct_traffic_egress_insert_trigger
+        INSTEAD OF INSERT ON pmacct_traffic_egress
+        FOR EACH ROW EXECUTE PROCEDURE pmacct_traffic_egress_insert()
+    """)
+    op.execute("""
+        CREATE OR REPLACE VIEW pmacct_traffic_ingress AS SELECT traffic_volume.packets AS packets, traffic_volume.amount AS bytes, traffic_volume.timestamp AS stamp_inserted, traffic_volume.timestamp AS stamp_updated, ip.address AS ip_dst
+        FROM traffic_volume JOIN ip ON ip.id = traffic_volume.ip_id
+        WHERE traffic_volume.type = 'Ingress'
+    """)
+    op.execute("""
+        CREATE TRIGGER pmacct_traffic_ingress_insert_trigger
+        INSTEAD OF INSERT ON pmacct_traffic_ingress
+        FOR EACH ROW EXECUTE PROCEDURE pmacct_traffic_ingress_insert()
+    """)
+    op.execute("""
+        CREATE TRIGGER traffic_volume_update_daily_user_insert_trigger
+        AFTER INSERT ON traffic_volume REFERENCING NEW TABLE AS new_volume
+        FOR EACH STATEMENT EXECUTE PROCEDURE traffic_volume_update_daily_user()
+    """)
+    op.execute("""
+        CREATE TRIGGER traffic_volume_update_daily_user_update_trigger
+        AFTER UPDATE ON traffic_volume
+        REFERENCING OLD TABLE AS old_volume NEW TABLE AS new_volume
+        FOR EACH STATEMENT EXECUTE PROCEDURE traffic_volume_update_daily_user()
+    """)
+    op.execute("""
+        CREATE TRIGGER traffic_volume_update_daily_user_delete_trigger
+        AFTER DELETE ON traffic_volume REFERENCING OLD TABLE AS old_volume
+        FOR EACH STATEMENT EXECUTE PROCEDURE traffic_volume_update_daily_user()
+    """)
+
+
+def upgrade():
+    drop_dependent_objects()
+    op.execute("ALTER TABLE traffic_volume RENAME TO traffic_volume_unpartitioned")
+    op.execute("ALTER INDEX traffic_volume_pkey RENAME TO traffic_volume_unpartitioned_pkey")
+    op.execute("ALTER INDEX ix_traffic_volume_ip_id RENAME TO ix_traffic_volume_unpartitioned_ip_id")
+    op.execute("ALTER INDEX ix_traffic_volume_user_id RENAME TO ix_traffic_volume_unpartitioned_user_id")
+
+    create_traffic_volume_table('traffic_volume',
+                                postgresql_partition_by='RANGE ("timestamp")')
+    op.create_index('ix_traffic_volume_ip_id', 'traffic_volume', ['ip_id'],
+                    unique=False)
+    op.create_index('ix_traffic_volume_user_id', 'traffic_volume', ['user_id'],
+                    unique=False)
+    op.execute("CREATE TABLE traffic_volume_default PARTITION OF traffic_volume DEFAULT")
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION traffic_volume_create_partition(arg_day date)
+         RETURNS boolean
+         LANGUAGE plpgsql
+         STRICT
+        AS $function$
+        DECLARE
+          v_name text := 'traffic_volume_' || to_char(arg_day, 'YYYYMMDD');
+          v_start timestamptz := arg_day::timestamp AT TIME ZONE 'UTC';
+          v_end timestamptz := (arg_day + 1)::timestamp AT TIME ZONE 'UTC';
+        BEGIN
+          IF to_regclass(v_name) IS NOT NULL THEN
+            RETURN false;
+          END IF;
+          EXECUTE format('CREATE TABLE %I (LIKE traffic_volume'
+                         ' INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', v_name);
+          EXECUTE format('WITH moved AS ('
+                         '  DELETE FROM traffic_volume_default'
+                         '  WHERE "timestamp" >= $1 AND "timestamp" < $2'
+                         '  RETURNING *'
+                         ') INSERT INTO %I SELECT * FROM moved', v_name)
+            USING v_start, v_end;
+          EXECUTE format('ALTER TABLE traffic_volume ATTACH PARTITION %I'
+                         ' FOR VALUES FROM (%L) TO (%L)',
+                         v_name, v_start, v_end);
+          RETURN true;
+        END;
+        $function$
+    """)
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION traffic_volume_create_partitions(arg_start date, arg_end date)
+         RETURNS integer
+         LANGUAGE plpgsql
+         STRICT
+        AS $function$
+        DECLARE
+          v_count integer := 0;
+          v_day date;
+        BEGIN
+          FOR v_day IN
+            SELECT generate_series(arg_start, arg_end, '1 day')::date
+          LOOP
+            IF traffic_volume_create_partition(v_day) THEN
+              v_count := v_count + 1;
+            END IF;
+          END LOOP;
+          RETURN v_count;
+        END;
+        $function$
+    """)
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION traffic_volume_drop_partitions(arg_before date)
+         RETURNS integer
+         LANGUAGE plpgsql
+         STRICT
+        AS $function$
+        DECLARE
+          v_count integer := 0;
+          v_partition regclass;
+        BEGIN
+          FOR v_partition IN
+            SELECT c.oid::regclass
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'traffic_volume'::regclass
+            AND c.relname ~ '^traffic_volume_[0-9]{8}$'
+            AND to_date(right(c.relname, 8), 'YYYYMMDD') < arg_before
+          LOOP
+            EXECUTE format('DROP TABLE %s', v_partition);
+            v_count := v_count + 1;
+          END LOOP;
+          DELETE FROM traffic_volume_default
+            WHERE "timestamp" < arg_before::timestamp AT TIME ZONE 'UTC';
+          DELETE FROM traffic_daily_user WHERE day < arg_before;
+          RETURN v_count;
+        END;
+        $function$
+    """)
+
+    # Only the recent days get partitions, older rows are left to the
+    # default partition until they are removed.
+    op.execute("""
+        SELECT traffic_volume_create_partitions(
+            (now() AT TIME ZONE 'UTC')::date - 7,
+            (now() AT TIME ZONE 'UTC')::date + 7)
+    """)
+    op.execute("""
+        INSERT INTO traffic_volume ("timestamp", amount, type, ip_id, user_id, packets)
+        SELECT "timestamp", amount, type, ip_id, user_id, packets
+        FROM traffic_volume_unpartitioned
+    """)
+    op.drop_table('traffic_volume_unpartitioned')
+
+    create_dependent_objects()
+
+
+def downgrade():
+    drop_dependent_objects()
+    op.execute("ALTER TABLE traffic_volume RENAME TO traffic_volume_partitioned")
+    op.execute("ALTER INDEX traffic_volume_pkey RENAME TO traffic_volume_partitioned_pkey")
+    op.execute("ALTER INDEX ix_traffic_volume_ip_id RENAME TO ix_traffic_volume_partitioned_ip_id")
+    op.execute("ALTER INDEX ix_traffic_volume_user_id RENAME TO ix_traffic_volume_partitioned_user_id")
+
+    create_traffic_volume_table('traffic_volume')
+    op.create_index('ix_traffic_volume_ip_id', 'traffic_volume', ['ip_id'],
+                    unique=False)
+    op.create_index('ix_traffic_volume_user_id', 'traffic_volume', ['user_id'],
+                    unique=False)
+    op.execute("""
+        INSERT INTO traffic_volume ("timestamp", amount, type, ip_id, user_id, packets)
+        SELECT "timestamp", amount, type, ip_id, user_id, packets
+        FROM traffic_volume_partitioned
+    """)
+    op.drop_table('traffic_volume_partitioned')
+
+    op.execute("DROP FUNCTION IF EXISTS traffic_volume_drop_partitions(date)")
+    op.execute("DROP FUNCTION IF EXISTS traffic_volume_create_partitions(date, date)")
+    op.execute("DROP FUNCTION IF EXISTS traffic_volume_create_partition(date)")
+
+    create_dependent_objects()
@@ -0,0 +1,68 @@
+"""add account_balance table
+
+Revision ID: 440057399a92
+Revises: b14b7fe00298
+Create Date: 2019-10-13 11:02:47.190338
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import pycroft
+
+
+# revision identifiers, used by Alembic.
+revision = '440057399a92'
+down_revision = 'b14b7fe00298'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'account_balance',
+        sa.Column('account_id', sa.Integer(), nullable=False),
+        sa.Column('balance', pycroft.model.types.Money(), server_default='0',
+                  nullable=False),
+        sa.ForeignKeyConstraint(['account_id'], ['account.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('account_id')
+    )
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION split_update_account_balance()
+         RETURNS trigger
+         LANGUAGE plpgsql
+         STRICT
+        AS $function$
+        BEGIN
+          IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+            UPDATE account_balance SET balance = balance - OLD.amount
+              WHERE account_id = OLD.account_id;
+          END IF;
+          IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+            INSERT INTO account_balance (account_id, balance)
+              VALUES (NEW.account_id, NEW.amount)
+            ON CONFLICT (account_id) DO UPDATE
+              SET balance = account_balance.balance + EXCLUDED.balance;
+          END IF;
+          RETURN NULL;
+        END;
+        $function$
+    """)
+
+    op.execute("""
+        CREATE TRIGGER split_update_account_balance_trigger
+        AFTER INSERT OR UPDATE OR DELETE ON split
+        FOR EACH ROW EXECUTE PROCEDURE split_update_account_balance()
+    """)
+
+    op.execute("""
+        INSERT INTO account_balance (account_id, balance)
+        SELECT account_id, sum(amount) FROM split GROUP BY account_id
+    """)
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS split_update_account_balance_trigger ON split")
+    op.execute("DROP FUNCTION IF EXISTS split_update_account_balance()")
+    op.drop_table('account_balance')
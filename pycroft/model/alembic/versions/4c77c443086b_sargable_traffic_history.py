@@ -0,0 +1,61 @@
+"""range scan traffic_daily_user in traffic_history()
+
+Revision ID: 4c77c443086b
+Revises: c6372c166bf4
+Create Date: 2019-10-17 19:12:40.583260
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c77c443086b'
+down_revision = 'c6372c166bf4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_traffic_daily_user_user_id_day', 'traffic_daily_user',
+                    ['user_id', 'day', 'type', 'amount'], unique=False)
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION traffic_history(arg_user_id integer, arg_start timestamp with time zone, arg_end timestamp with time zone)
+         RETURNS TABLE("timestamp" timestamp with time zone, ingress numeric, egress numeric)
+         LANGUAGE sql
+         STABLE
+        AS $function$
+        SELECT day.day AS timestamp, traffic.ingress, traffic.egress
+        FROM generate_series(date_trunc('day', arg_start), date_trunc('day', arg_end), '1 day') AS day LEFT OUTER JOIN (SELECT traffic_daily_user.day AS day, sum(traffic_daily_user.amount) FILTER (WHERE traffic_daily_user.type = 'Ingress') AS ingress, sum(traffic_daily_user.amount) FILTER (WHERE traffic_daily_user.type = 'Egress') AS egress
+        FROM traffic_daily_user
+        WHERE traffic_daily_user.user_id = arg_user_id AND traffic_daily_user.day BETWEEN CAST(arg_start AS DATE) AND CAST(arg_end AS DATE) GROUP BY traffic_daily_user.day) AS traffic ON traffic.day = CAST(day.day AS DATE) ORDER BY day.day
+        $function$
+    """)
+
+
+def downgrade():
+    op.execute("""
+        CREATE OR REPLACE FUNCTION traffic_history(arg_user_id integer, arg_start timestamp with time zone, arg_end timestamp with time zone)
+         RETURNS TABLE("timestamp" timestamp with time zone, ingress numeric, egress numeric)
+         LANGUAGE sql
+         STABLE
+        AS $function$
+        WITH anon_3 AS
+        (SELECT sum(traffic_daily_user.amount) AS amount, day.day AS day, CAST(traffic_daily_user.type AS TEXT) AS type
+        FROM generate_series(date_trunc('day', arg_start), date_trunc('day', arg_end), '1 day') AS day LEFT OUTER JOIN traffic_daily_user ON traffic_daily_user.day = CAST(day.day AS DATE) AND traffic_daily_user.user_id = arg_user_id GROUP BY day.day, type),
+        anon_1 AS
+        (SELECT anon_3.amount AS amount, anon_3.day AS day, anon_3.type AS type
+        FROM anon_3
+        WHERE anon_3.type = 'Ingress' OR anon_3.type IS NULL),
+        anon_2 AS
+        (SELECT anon_3.amount AS amount, anon_3.day AS day, anon_3.type AS type
+        FROM anon_3
+        WHERE anon_3.type = 'Egress' OR anon_3.type IS NULL)
+         SELECT coalesce(anon_1.day, anon_2.day) AS timestamp, anon_1.amount AS ingress, anon_2.amount AS egress
+        FROM anon_1 FULL OUTER JOIN anon_2 ON anon_1.day = anon_2.day ORDER BY timestamp
+        $function$
+    """)
+
+    op.drop_index('ix_traffic_daily_user_user_id_day',
+                  table_name='traffic_daily_user')
@@ -0,0 +1,105 @@
+"""update account_balance once per statement
+
+Revision ID: 782fc0e2f15e
+Revises: 440057399a92
+Create Date: 2019-10-14 19:23:11.402158
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '782fc0e2f15e'
+down_revision = '440057399a92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("DROP TRIGGER IF EXISTS split_update_account_balance_trigger ON split")
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION split_update_account_balance()
+         RETURNS trigger
+         LANGUAGE plpgsql
+         STRICT
+        AS $function$
+        BEGIN
+          IF TG_OP = 'INSERT' THEN
+            INSERT INTO account_balance (account_id, balance)
+              SELECT account_id, sum(amount) FROM new_split
+              GROUP BY account_id
+            ON CONFLICT (account_id) DO UPDATE
+              SET balance = account_balance.balance + EXCLUDED.balance;
+          ELSIF TG_OP = 'DELETE' THEN
+            UPDATE account_balance SET balance = balance - deleted.amount
+              FROM (SELECT account_id, sum(amount) AS amount FROM old_split
+                    GROUP BY account_id) AS deleted
+              WHERE account_balance.account_id = deleted.account_id;
+          ELSE
+            INSERT INTO account_balance (account_id, balance)
+              SELECT account_id, sum(amount) FROM (
+                SELECT account_id, amount FROM new_split
+                UNION ALL
+                SELECT account_id, -amount FROM old_split
+              ) AS delta
+              GROUP BY account_id
+            ON CONFLICT (account_id) DO UPDATE
+              SET balance = account_balance.balance + EXCLUDED.balance;
+          END IF;
+          RETURN NULL;
+        END;
+        $function$
+    """)
+
+    op.execute("""
+        CREATE TRIGGER split_update_account_balance_insert_trigger
+        AFTER INSERT ON split REFERENCING NEW TABLE AS new_split
+        FOR EACH STATEMENT EXECUTE PROCEDURE split_update_account_balance()
+    """)
+    op.execute("""
+        CREATE TRIGGER split_update_account_balance_update_trigger
+        AFTER UPDATE ON split
+        REFERENCING OLD TABLE AS old_split NEW TABLE AS new_split
+        FOR EACH STATEMENT EXECUTE PROCEDURE split_update_account_balance()
+    """)
+    op.execute("""
+        CREATE TRIGGER split_update_account_balance_delete_trigger
+        AFTER DELETE ON split REFERENCING OLD TABLE AS old_split
+        FOR EACH STATEMENT EXECUTE PROCEDURE split_update_account_balance()
+    """)
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS split_update_account_balance_insert_trigger ON split")
+    op.execute("DROP TRIGGER IF EXISTS split_update_account_balance_update_trigger ON split")
+    op.execute("DROP TRIGGER IF EXISTS split_update_account_balance_delete_trigger ON split")
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION split_update_account_balance()
+         RETURNS trigger
+         LANGUAGE plpgsql
+         STRICT
+        AS $function$
+        BEGIN
+          IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+            UPDATE account_balance SET balance = balance - OLD.amount
+              WHERE account_id = OLD.account_id;
+          END IF;
+          IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+            INSERT INTO account_balance (account_id, balance)
+              VALUES (NEW.account_id, NEW.amount)
+            ON CONFLICT (account_id) DO UPDATE
+              SET balance = account_balance.balance + EXCLUDED.balance;
+          END IF;
+          RETURN NULL;
+        END;
+        $function$
+    """)
+
+    op.execute("""
+        CREATE TRIGGER split_update_account_balance_trigger
+        AFTER INSERT OR UPDATE OR DELETE ON split
+        FOR EACH ROW EXECUTE PROCEDURE split_update_account_balance()
+    """)
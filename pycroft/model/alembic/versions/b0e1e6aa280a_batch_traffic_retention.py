@@ -0,0 +1,73 @@
+"""only drop partitions in traffic_volume_drop_partitions()
+
+Revision ID: b0e1e6aa280a
+Revises: 4338eac69aac
+Create Date: 2019-10-19 11:48:27.306915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b0e1e6aa280a'
+down_revision = '4338eac69aac'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("""
+        CREATE OR REPLACE FUNCTION traffic_volume_drop_partitions(arg_before date)
+         RETURNS integer
+         LANGUAGE plpgsql
+         STRICT
+        AS $function$
+        DECLARE
+          v_count integer := 0;
+          v_partition regclass;
+        BEGIN
+          FOR v_partition IN
+            SELECT c.oid::regclass
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'traffic_volume'::regclass
+            AND c.relname ~ '^traffic_volume_[0-9]{8}$'
+            AND to_date(right(c.relname, 8), 'YYYYMMDD') < arg_before
+          LOOP
+            EXECUTE format('DROP TABLE %s', v_partition);
+            v_count := v_count + 1;
+          END LOOP;
+          RETURN v_count;
+        END;
+        $function$
+    """)
+
+
+def downgrade():
+    op.execute("""
+        CREATE OR REPLACE FUNCTION traffic_volume_drop_partitions(arg_before date)
+         RETURNS integer
+         LANGUAGE plpgsql
+         STRICT
+        AS $function$
+        DECLARE
+          v_count integer := 0;
+          v_partition regclass;
+        BEGIN
+          FOR v_partition IN
+            SELECT c.oid::regclass
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'traffic_volume'::regclass
+            AND c.relname ~ '^traffic_volume_[0-9]{8}$'
+            AND to_date(right(c.relname, 8), 'YYYYMMDD') < arg_before
+          LOOP
+            EXECUTE format('DROP TABLE %s', v_partition);
+            v_count := v_count + 1;
+          END LOOP;
+          DELETE FROM traffic_volume_default
+            WHERE "timestamp" < arg_before::timestamp AT TIME ZONE 'UTC';
+          DELETE FROM traffic_daily_user WHERE day < arg_before;
+          RETURN v_count;
+        END;
+        $function$
+    """)
@@ -0,0 +1,168 @@
+"""add materialized current_property table
+
+Revision ID: b14b7fe00298
+Revises: f85ef1ef556c
+Create Date: 2019-10-12 16:41:03.528107
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import pycroft
+
+
+# revision identifiers, used by Alembic.
+revision = 'b14b7fe00298'
+down_revision = 'f85ef1ef556c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'materialized_current_property',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('property_name', sa.String(length=255), nullable=False),
+        sa.Column('denied', sa.Boolean(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id', 'property_name')
+    )
+    op.create_index(op.f('ix_materialized_current_property_property_name'),
+                    'materialized_current_property', ['property_name'],
+                    unique=False)
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION refresh_materialized_current_property(arg_user_ids integer[])
+         RETURNS integer
+         LANGUAGE plpgsql
+         STRICT
+        AS $function$
+        DECLARE
+          v_deleted integer;
+          v_upserted integer;
+        BEGIN
+          DELETE FROM materialized_current_property m
+            WHERE m.user_id = ANY(arg_user_ids)
+            AND NOT EXISTS (
+              SELECT 1 FROM evaluate_properties(current_timestamp) e
+              WHERE e.user_id = m.user_id
+              AND e.property_name = m.property_name
+            );
+          GET DIAGNOSTICS v_deleted = ROW_COUNT;
+
+          INSERT INTO materialized_current_property (user_id, property_name, denied)
+            SELECT e.user_id, e.property_name, e.denied
+            FROM evaluate_properties(current_timestamp) e
+            WHERE e.user_id = ANY(arg_user_ids)
+          ON CONFLICT (user_id, property_name) DO UPDATE
+            SET denied = EXCLUDED.denied
+            WHERE materialized_current_property.denied <> EXCLUDED.denied;
+          GET DIAGNOSTICS v_upserted = ROW_COUNT;
+
+          RETURN v_deleted + v_upserted;
+        END;
+        $function$
+    """)
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION refresh_materialized_current_property()
+         RETURNS integer
+         LANGUAGE plpgsql
+        AS $function$
+        DECLARE
+          v_deleted integer;
+          v_upserted integer;
+        BEGIN
+          DELETE FROM materialized_current_property m
+            WHERE NOT EXISTS (
+              SELECT 1 FROM evaluate_properties(current_timestamp) e
+              WHERE e.user_id = m.user_id
+              AND e.property_name = m.property_name
+            );
+          GET DIAGNOSTICS v_deleted = ROW_COUNT;
+
+          INSERT INTO materialized_current_property (user_id, property_name, denied)
+            SELECT e.user_id, e.property_name, e.denied
+            FROM evaluate_properties(current_timestamp) e
+          ON CONFLICT (user_id, property_name) DO UPDATE
+            SET denied = EXCLUDED.denied
+            WHERE materialized_current_property.denied <> EXCLUDED.denied;
+          GET DIAGNOSTICS v_upserted = ROW_COUNT;
+
+          RETURN v_deleted + v_upserted;
+        END;
+        $function$
+    """)
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION membership_materialize_current_property()
+         RETURNS trigger
+         LANGUAGE plpgsql
+         STRICT
+        AS $function$
+        BEGIN
+          IF TG_OP = 'INSERT' THEN
+            PERFORM refresh_materialized_current_property(ARRAY[NEW.user_id]);
+          ELSIF TG_OP = 'DELETE' THEN
+            PERFORM refresh_materialized_current_property(ARRAY[OLD.user_id]);
+          ELSIF NEW.user_id <> OLD.user_id THEN
+            PERFORM refresh_materialized_current_property(
+              ARRAY[OLD.user_id, NEW.user_id]);
+          ELSIF (NEW.group_id, NEW.begins_at, NEW.ends_at)
+              IS DISTINCT FROM (OLD.group_id, OLD.begins_at, OLD.ends_at) THEN
+            PERFORM refresh_materialized_current_property(ARRAY[NEW.user_id]);
+          END IF;
+          RETURN NULL;
+        END;
+        $function$
+    """)
+
+    op.execute("""
+        CREATE TRIGGER membership_materialize_current_property_trigger
+        AFTER INSERT OR UPDATE OR DELETE ON membership
+        FOR EACH ROW EXECUTE PROCEDURE membership_materialize_current_property()
+    """)
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION property_materialize_current_property()
+         RETURNS trigger
+         LANGUAGE plpgsql
+         STRICT
+        AS $function$
+        DECLARE
+          v_group_ids integer[];
+        BEGIN
+          IF TG_OP = 'INSERT' THEN
+            v_group_ids := ARRAY[NEW.property_group_id];
+          ELSIF TG_OP = 'DELETE' THEN
+            v_group_ids := ARRAY[OLD.property_group_id];
+          ELSE
+            v_group_ids := ARRAY[OLD.property_group_id, NEW.property_group_id];
+          END IF;
+          PERFORM refresh_materialized_current_property(ARRAY(
+            SELECT DISTINCT user_id FROM membership
+            WHERE group_id = ANY(v_group_ids)
+          ));
+          RETURN NULL;
+        END;
+        $function$
+    """)
+
+    op.execute("""
+        CREATE TRIGGER property_materialize_current_property_trigger
+        AFTER INSERT OR UPDATE OR DELETE ON property
+        FOR EACH ROW EXECUTE PROCEDURE property_materialize_current_property()
+    """)
+
+    op.execute("SELECT refresh_materialized_current_property()")
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS property_materialize_current_property_trigger ON property")
+    op.execute("DROP FUNCTION IF EXISTS property_materialize_current_property()")
+    op.execute("DROP TRIGGER IF EXISTS membership_materialize_current_property_trigger ON membership")
+    op.execute("DROP FUNCTION IF EXISTS membership_materialize_current_property()")
+    op.execute("DROP FUNCTION IF EXISTS refresh_materialized_current_property()")
+    op.execute("DROP FUNCTION IF EXISTS refresh_materialized_current_property(integer[])")
+    op.drop_index(op.f('ix_materialized_current_property_property_name'),
+                  table_name='materialized_current_property')
+    op.drop_table('materialized_current_property')
@@ -0,0 +1,158 @@
+"""add traffic_daily_user rollup
+
+Revision ID: c6372c166bf4
+Revises: ffd77dcd7582
+Create Date: 2019-10-16 18:02:51.730154
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6372c166bf4'
+down_revision = 'ffd77dcd7582'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'traffic_daily_user',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('type', postgresql.ENUM('Ingress', 'Egress',
+                                          name='traffic_direction',
+                                          create_type=False),
+                  nullable=False),
+        sa.Column('amount', sa.BigInteger(), nullable=False),
+        sa.Column('packets', sa.BigInteger(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id', 'day', 'type')
+    )
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION traffic_volume_update_daily_user()
+         RETURNS trigger
+         LANGUAGE plpgsql
+         STRICT
+        AS $function$
+        BEGIN
+          IF TG_OP = 'INSERT' THEN
+            INSERT INTO traffic_daily_user (user_id, day, type, amount, packets)
+            SELECT user_id, "timestamp"::date, type, sum(amount), sum(packets)
+            FROM (SELECT user_id, "timestamp", type, amount, packets FROM new_volume) AS delta
+            WHERE user_id IS NOT NULL
+            GROUP BY 1, 2, 3
+            ON CONFLICT (user_id, day, type) DO UPDATE
+              SET (amount, packets) = (traffic_daily_user.amount + EXCLUDED.amount,
+                                       traffic_daily_user.packets + EXCLUDED.packets);
+          ELSIF TG_OP = 'UPDATE' THEN
+            INSERT INTO traffic_daily_user (user_id, day, type, amount, packets)
+            SELECT user_id, "timestamp"::date, type, sum(amount), sum(packets)
+            FROM (SELECT user_id, "timestamp", type, amount, packets FROM new_volume
+                  UNION ALL
+                  SELECT user_id, "timestamp", type, -amount AS amount, -packets AS packets FROM old_volume) AS delta
+            WHERE user_id IS NOT NULL
+            GROUP BY 1, 2, 3
+            ON CONFLICT (user_id, day, type) DO UPDATE
+              SET (amount, packets) = (traffic_daily_user.amount + EXCLUDED.amount,
+                                       traffic_daily_user.packets + EXCLUDED.packets);
+          ELSE
+            INSERT INTO traffic_daily_user (user_id, day, type, amount, packets)
+            SELECT user_id, "timestamp"::date, type, sum(amount), sum(packets)
+            FROM (SELECT user_id, "timestamp", type, -amount AS amount, -packets AS packets FROM old_volume) AS delta
+            WHERE user_id IS NOT NULL
+            GROUP BY 1, 2, 3
+            ON CONFLICT (user_id, day, type) DO UPDATE
+              SET (amount, packets) = (traffic_daily_user.amount + EXCLUDED.amount,
+                                       traffic_daily_user.packets + EXCLUDED.packets);
+          END IF;
+          IF TG_OP <> 'INSERT' THEN
+            DELETE FROM traffic_daily_user
+              WHERE amount = 0 AND packets = 0
+              AND (user_id, day, type) IN (
+                SELECT user_id, "timestamp"::date, type FROM old_volume);
+          END IF;
+          RETURN NULL;
+        END;
+        $function$
+    """)
+
+    op.execute("""
+        CREATE TRIGGER traffic_volume_update_daily_user_insert_trigger
+        AFTER INSERT ON traffic_volume REFERENCING NEW TABLE AS new_volume
+        FOR EACH STATEMENT EXECUTE PROCEDURE traffic_volume_update_daily_user()
+    """)
+    op.execute("""
+        CREATE TRIGGER traffic_volume_update_daily_user_update_trigger
+        AFTER UPDATE ON traffic_volume
+        REFERENCING OLD TABLE AS old_volume NEW TABLE AS new_volume
+        FOR EACH STATEMENT EXECUTE PROCEDURE traffic_volume_update_daily_user()
+    """)
+    op.execute("""
+        CREATE TRIGGER traffic_volume_update_daily_user_delete_trigger
+        AFTER DELETE ON traffic_volume REFERENCING OLD TABLE AS old_volume
+        FOR EACH STATEMENT EXECUTE PROCEDURE traffic_volume_update_daily_user()
+    """)
+
+    op.execute("""
+        INSERT INTO traffic_daily_user (user_id, day, type, amount, packets)
+        SELECT user_id, "timestamp"::date, type, sum(amount), sum(packets)
+        FROM traffic_volume
+        WHERE user_id IS NOT NULL
+        GROUP BY 1, 2, 3
+    """)
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION traffic_history(arg_user_id integer, arg_start timestamp with time zone, arg_end timestamp with time zone)
+         RETURNS TABLE("timestamp" timestamp with time zone, ingress numeric, egress numeric)
+         LANGUAGE sql
+         STABLE
+        AS $function$
+        WITH anon_3 AS
+        (SELECT sum(traffic_daily_user.amount) AS amount, day.day AS day, CAST(traffic_daily_user.type AS TEXT) AS type
+        FROM generate_series(date_trunc('day', arg_start), date_trunc('day', arg_end), '1 day') AS day LEFT OUTER JOIN traffic_daily_user ON traffic_daily_user.day = CAST(day.day AS DATE) AND traffic_daily_user.user_id = arg_user_id GROUP BY day.day, type),
+        anon_1 AS
+        (SELECT anon_3.amount AS amount, anon_3.day AS day, anon_3.type AS type
+        FROM anon_3
+        WHERE anon_3.type = 'Ingress' OR anon_3.type IS NULL),
+        anon_2 AS
+        (SELECT anon_3.amount AS amount, anon_3.day AS day, anon_3.type AS type
+        FROM anon_3
+        WHERE anon_3.type = 'Egress' OR anon_3.type IS NULL)
+         SELECT coalesce(anon_1.day, anon_2.day) AS timestamp, anon_1.amount AS ingress, anon_2.amount AS egress
+        FROM anon_1 FULL OUTER JOIN anon_2 ON anon_1.day = anon_2.day ORDER BY timestamp
+        $function$
+    """)
+
+
+def downgrade():
+    op.execute("""
+        CREATE OR REPLACE FUNCTION traffic_history(arg_user_id integer, arg_start timestamp with time zone, arg_end timestamp with time zone)
+         RETURNS TABLE("timestamp" timestamp with time zone, ingress numeric, egress numeric)
+         LANGUAGE sql
+         STABLE
+        AS $function$
+        WITH anon_3 AS
+        (SELECT sum(traffic_volume.amount) AS amount, day, CAST(traffic_volume.type AS TEXT) AS type
+        FROM generate_series(date_trunc('day', arg_start), date_trunc('day', arg_end), '1 day') AS day LEFT OUTER JOIN traffic_volume ON date_trunc('day', traffic_volume.timestamp) = day AND traffic_volume.user_id = arg_user_id GROUP BY day, type),
+        anon_1 AS
+        (SELECT anon_3.amount AS amount, anon_3.day, anon_3.type AS type
+        FROM anon_3
+        WHERE anon_3.type = 'Ingress' OR anon_3.type IS NULL),
+        anon_2 AS
+        (SELECT anon_3.amount AS amount, anon_3.day, anon_3.type AS type
+        FROM anon_3
+        WHERE anon_3.type = 'Egress' OR anon_3.type IS NULL)
+         SELECT coalesce(anon_1.day, anon_2.day) AS timestamp, anon_1.amount AS ingress, anon_2.amount AS egress
+        FROM anon_1 FULL OUTER JOIN anon_2 ON anon_1.day = anon_2.day ORDER BY timestamp
+        $function$
+    """)
+
+    op.execute("DROP TRIGGER IF EXISTS traffic_volume_update_daily_user_insert_trigger ON traffic_volume")
+    op.execute("DROP TRIGGER IF EXISTS traffic_volume_update_daily_user_update_trigger ON traffic_volume")
+    op.execute("DROP TRIGGER IF EXISTS traffic_volume_update_daily_user_delete_trigger ON traffic_volume")
+    op.execute("DROP FUNCTION IF EXISTS traffic_volume_update_daily_user()")
+    op.drop_table('traffic_daily_user')
@@ -0,0 +1,35 @@
+"""add traffic_leaderboard
+
+Revision ID: cb19d04a73d9
+Revises: 1f2d5d62f0a3
+Create Date: 2019-10-20 17:03:44.182406
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import pycroft
+
+
+# revision identifiers, used by Alembic.
+revision = 'cb19d04a73d9'
+down_revision = '1f2d5d62f0a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'traffic_leaderboard',
+        sa.Column('days', sa.Integer(), nullable=False),
+        sa.Column('rank', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('amount', sa.BigInteger(), nullable=False),
+        sa.Column('refreshed_at', pycroft.model.types.DateTimeTz(),
+                  nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('days', 'rank')
+    )
+
+
+def downgrade():
+    op.drop_table('traffic_leaderboard')
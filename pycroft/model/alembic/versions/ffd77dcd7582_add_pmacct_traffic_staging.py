@@ -0,0 +1,80 @@
+"""add pmacct traffic staging table
+
+Revision ID: ffd77dcd7582
+Revises: 782fc0e2f15e
+Create Date: 2019-10-15 20:41:36.118024
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import pycroft
+
+
+# revision identifiers, used by Alembic.
+revision = 'ffd77dcd7582'
+down_revision = '782fc0e2f15e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'pmacct_traffic_staging',
+        sa.Column('packets', sa.BigInteger(), nullable=False),
+        sa.Column('bytes', sa.BigInteger(), nullable=False),
+        sa.Column('stamp_inserted', pycroft.model.types.DateTimeTz(),
+                  nullable=False),
+        sa.Column('stamp_updated', pycroft.model.types.DateTimeTz(),
+                  nullable=True),
+        sa.Column('ip_src', pycroft.model.types.IPAddress(), nullable=True),
+        sa.Column('ip_dst', pycroft.model.types.IPAddress(), nullable=True),
+        sa.CheckConstraint('(ip_src IS NULL) <> (ip_dst IS NULL)'),
+        prefixes=['UNLOGGED'],
+    )
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION pmacct_traffic_merge_staging()
+         RETURNS integer
+         LANGUAGE plpgsql
+        AS $function$
+        DECLARE
+            v_count integer;
+        BEGIN
+            WITH staged AS (
+                DELETE FROM pmacct_traffic_staging RETURNING *
+            ), aggregated AS (
+                SELECT
+                    CASE WHEN ip_src IS NOT NULL THEN 'Egress' ELSE 'Ingress' END
+                        ::traffic_direction AS type,
+                    coalesce(ip_src, ip_dst) AS address,
+                    date_trunc('day', stamp_inserted) AS day,
+                    sum(bytes) AS bytes,
+                    sum(packets) AS packets
+                FROM staged
+                GROUP BY 1, 2, 3
+            )
+            INSERT INTO traffic_volume (type, ip_id, "timestamp", amount, packets, user_id)
+            SELECT
+                aggregated.type,
+                ip.id,
+                aggregated.day,
+                aggregated.bytes,
+                aggregated.packets,
+                host.owner_id
+            FROM aggregated
+            JOIN ip ON aggregated.address = ip.address
+            JOIN interface ON ip.interface_id = interface.id
+            JOIN host ON interface.host_id = host.id
+            ON CONFLICT (ip_id, type, "timestamp")
+            DO UPDATE SET (amount, packets) = (traffic_volume.amount + EXCLUDED.amount,
+                                               traffic_volume.packets + EXCLUDED.packets);
+            GET DIAGNOSTICS v_count = ROW_COUNT;
+            RETURN v_count;
+        END;
+        $function$
+    """)
+
+
+def downgrade():
+    op.execute("DROP FUNCTION IF EXISTS pmacct_traffic_merge_staging()")
+    op.drop_table('pmacct_traffic_staging')
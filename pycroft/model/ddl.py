@@ -246,7 +246,8 @@ def visit_drop_rule(element, compiler, **kw):
 
 
 class Trigger(schema.DDLElement):
-    def __init__(self, name, table, events, function_call, when="AFTER"):
+    def __init__(self, name, table, events, function_call, when="AFTER",
+                 for_each="ROW", referencing=None):
         """Construct a trigger
 
         :param str name: Name of the trigger
@@ -254,6 +255,9 @@ class Trigger(schema.DDLElement):
         :param iterable[str] events: list of events (INSERT, UPDATE, DELETE)
         :param str function_call: call of the trigger function
         :param str when: Mode of execution. Must be one of ``BEFORE``, ``AFTER``, ``INSTEAD OF``
+        :param str for_each: Must be one of ``ROW``, ``STATEMENT``
+        :param dict[str,str] referencing: Names of the transition tables,
+            keyed by ``OLD`` or ``NEW``.
         """
         self.name = name
         self.table = table
@@ -262,6 +266,15 @@ class Trigger(schema.DDLElement):
         if when not in {"BEFORE", "AFTER", "INSTEAD OF"}:
             raise ValueError("`when` must be one of BEFORE, AFTER, INSTEAD OF")
         self.when = when
+        if for_each not in {"ROW", "STATEMENT"}:
+            raise ValueError("`for_each` must be one of ROW, STATEMENT")
+        self.for_each = for_each
+        if referencing is None:
+            referencing = OrderedDict()
+        if not set(referencing) <= {"OLD", "NEW"}:
+            raise ValueError("`referencing` keys must be OLD or NEW")
+        self.referencing = OrderedDict(sorted(referencing.items(),
+                                              key=lambda item: item[0] != "OLD"))
 
 
 class ConstraintTrigger(Trigger):
@@ -337,9 +350,16 @@ def create_add_trigger(element, compiler, **kw):
     events = ' OR '.join(trigger.events)
     trigger_name = compiler.preparer.quote(trigger.name)
     table_name = compiler.preparer.format_table(trigger.table)
+    opt_referencing = None
+    if trigger.referencing:
+        opt_referencing = _join_tokens("REFERENCING", *(
+            "{} TABLE AS {}".format(kind, compiler.preparer.quote(name))
+            for kind, name in trigger.referencing.items()
+        ))
     return _join_tokens(
         "CREATE TRIGGER", trigger_name, trigger.when, events, 'ON', table_name,
-        "FOR EACH ROW EXECUTE PROCEDURE", trigger.function_call)
+        opt_referencing, "FOR EACH", trigger.for_each, "EXECUTE PROCEDURE",
+        trigger.function_call)
 
 
 # noinspection PyUnusedLocal
@@ -461,6 +481,55 @@ def visit_drop_view(element, compiler, **kw):
     )
 
 
+class Partition(schema.DDLElement):
+    def __init__(self, name, table, bound=None):
+        """DDL Element representing a partition of a partitioned table
+
+        :param name: The name of the partition
+        :param table: The partitioned table
+        :param bound: The partition bound specification, e.g.
+            ``"FOR VALUES FROM ('2019-10-01') TO ('2019-10-02')"``.  If
+            ``None``, the partition is the default partition.
+        """
+        self.name = name
+        self.table = table
+        self.bound = bound
+
+
+class CreatePartition(schema.DDLElement):
+    def __init__(self, partition):
+        self.partition = partition
+
+
+class DropPartition(schema.DDLElement):
+    def __init__(self, partition, if_exists=False, cascade=False):
+        self.partition = partition
+        self.if_exists = if_exists
+        self.cascade = cascade
+
+
+# noinspection PyUnusedLocal
+@compiles(CreatePartition, 'postgresql')
+def visit_create_partition(element, compiler, **kw):
+    partition = element.partition
+    partition_name = compiler.preparer.quote(partition.name)
+    table_name = compiler.preparer.format_table(partition.table)
+    bound = partition.bound if partition.bound is not None else "DEFAULT"
+    return _join_tokens(
+        "CREATE TABLE", partition_name, "PARTITION OF", table_name, bound)
+
+
+# noinspection PyUnusedLocal
+@compiles(DropPartition, 'postgresql')
+def visit_drop_partition(element, compiler, **kw):
+    partition = element.partition
+    opt_if_exists = "IF EXISTS" if element.if_exists else None
+    opt_drop_behavior = "CASCADE" if element.cascade else None
+    partition_name = compiler.preparer.quote(partition.name)
+    return _join_tokens(
+        "DROP TABLE", opt_if_exists, partition_name, opt_drop_behavior)
+
+
 class DDLManager(object):
     """
     Ensures that create DDL statements are registered with SQLAlchemy in the
@@ -500,6 +569,10 @@ class DDLManager(object):
         self.add(table, CreateView(view, or_replace=True),
                  DropView(view, if_exists=True), dialect=dialect)
 
+    def add_partition(self, table, partition, dialect=None):
+        self.add(table, CreatePartition(partition),
+                 DropPartition(partition, if_exists=True), dialect=dialect)
+
     def register(self):
         for target, create_ddl, drop_ddl in self.objects:
             sqla_event.listen(target, 'after_create', create_ddl)
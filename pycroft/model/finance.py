@@ -10,6 +10,7 @@ from math import fabs
 from sqlalchemy import Column, ForeignKey, event, func, select, Boolean
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship, backref, object_session
+from sqlalchemy.orm.util import has_identity
 from sqlalchemy.schema import (
     CheckConstraint, ForeignKeyConstraint, UniqueConstraint)
 from sqlalchemy.types import (
@@ -19,7 +20,7 @@ from pycroft.helpers.i18n import gettext
 from pycroft.helpers.interval import closed
 from pycroft.model import ddl
 from pycroft.model.types import Money, DateTimeTz
-from .base import IntegerIdModel
+from .base import IntegerIdModel, ModelBase
 
 
 manager = ddl.DDLManager()
@@ -105,14 +106,20 @@ class Account(IntegerIdModel):
 
     @hybrid_property
     def balance(self):
-        return sum(s.amount for s in self.splits)
+        session = object_session(self)
+        if session is None or not has_identity(self):
+            return sum(s.amount for s in self.splits)
+        balance = session.query(AccountBalance.balance).filter(
+            AccountBalance.account_id == self.id).scalar()
+        return balance if balance is not None else 0
 
     @balance.expression
     def balance(cls):
-        return select(
-            [func.coalesce(func.sum(Split.amount), 0)]
-        ).where(
-            Split.account_id == cls.id
+        return func.coalesce(
+            select([AccountBalance.balance])
+            .where(AccountBalance.account_id == cls.id)
+            .as_scalar(),
+            0
         ).label("balance")
 
     @hybrid_property
@@ -246,6 +253,87 @@ manager.add_constraint_trigger(
 )
 
 
+class AccountBalance(ModelBase):
+    """The balance of an account, i.e. the sum of all its splits.
+
+    This table is a cache maintained by a trigger on `split`.  Accounts
+    without any splits do not necessarily have a row.
+    """
+    account_id = Column(Integer, ForeignKey(Account.id, ondelete='CASCADE'),
+                        primary_key=True)
+    balance = Column(Money, nullable=False, server_default='0')
+
+
+manager.add_function(
+    Split.__table__,
+    ddl.Function(
+        'split_update_account_balance', [], 'trigger',
+        """
+        BEGIN
+          IF TG_OP = 'INSERT' THEN
+            INSERT INTO account_balance (account_id, balance)
+              SELECT account_id, sum(amount) FROM new_split
+              GROUP BY account_id
+            ON CONFLICT (account_id) DO UPDATE
+              SET balance = account_balance.balance + EXCLUDED.balance;
+          ELSIF TG_OP = 'DELETE' THEN
+            UPDATE account_balance SET balance = balance - deleted.amount
+              FROM (SELECT account_id, sum(amount) AS amount FROM old_split
+                    GROUP BY account_id) AS deleted
+              WHERE account_balance.account_id = deleted.account_id;
+          ELSE
+            INSERT INTO account_balance (account_id, balance)
+              SELECT account_id, sum(amount) FROM (
+                SELECT account_id, amount FROM new_split
+                UNION ALL
+                SELECT account_id, -amount FROM old_split
+              ) AS delta
+              GROUP BY account_id
+            ON CONFLICT (account_id) DO UPDATE
+              SET balance = account_balance.balance + EXCLUDED.balance;
+          END IF;
+          RETURN NULL;
+        END;
+        """,
+        volatility='volatile', strict=True, language='plpgsql'
+    )
+)
+
+# Statement level triggers, so that bulk inserts of splits update every
+# affected balance only once.  PostgreSQL does not allow transition tables
+# on triggers for more than one event.
+manager.add_trigger(
+    Split.__table__,
+    ddl.Trigger(
+        'split_update_account_balance_insert_trigger',
+        Split.__table__, ('INSERT',),
+        'split_update_account_balance()',
+        for_each='STATEMENT', referencing={'NEW': 'new_split'},
+    )
+)
+
+manager.add_trigger(
+    Split.__table__,
+    ddl.Trigger(
+        'split_update_account_balance_update_trigger',
+        Split.__table__, ('UPDATE',),
+        'split_update_account_balance()',
+        for_each='STATEMENT',
+        referencing={'OLD': 'old_split', 'NEW': 'new_split'},
+    )
+)
+
+manager.add_trigger(
+    Split.__table__,
+    ddl.Trigger(
+        'split_update_account_balance_delete_trigger',
+        Split.__table__, ('DELETE',),
+        'split_update_account_balance()',
+        for_each='STATEMENT', referencing={'OLD': 'old_split'},
+    )
+)
+
+
 class IllegalTransactionError(Exception):
     """Indicates an attempt to persist an illegal Transaction."""
     pass
@@ -13,7 +13,7 @@ from sqlalchemy.dialects import postgresql
 
 from pycroft.model import ddl
 from sqlalchemy import null, and_, or_, func, Column, Integer, String, union, \
-    literal, literal_column, select
+    literal, literal_column, select, Boolean, ForeignKey
 from sqlalchemy.orm import Query
 
 from .base import ModelBase
@@ -90,4 +90,154 @@ class CurrentProperty(ModelBase):
     }
 
 
+class MaterializedCurrentProperty(ModelBase):
+    """Materialized copy of the `current_property` view.
+
+    The rows are kept up to date by triggers on `membership` and `property`
+    as far as changes of these tables are concerned.  Memberships beginning
+    or ending on their own as time passes are picked up by
+    ``refresh_materialized_current_property()``, which is run periodically.
+    """
+    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'),
+                     primary_key=True)
+    property_name = Column(String(255), primary_key=True, index=True)
+    denied = Column(Boolean, nullable=False)
+
+
+manager.add_function(
+    Membership.__table__,
+    ddl.Function(
+        'refresh_materialized_current_property', ['arg_user_ids integer[]'],
+        'integer',
+        """
+        DECLARE
+          v_deleted integer;
+          v_upserted integer;
+        BEGIN
+          DELETE FROM materialized_current_property m
+            WHERE m.user_id = ANY(arg_user_ids)
+            AND NOT EXISTS (
+              SELECT 1 FROM evaluate_properties(current_timestamp) e
+              WHERE e.user_id = m.user_id
+              AND e.property_name = m.property_name
+            );
+          GET DIAGNOSTICS v_deleted = ROW_COUNT;
+
+          INSERT INTO materialized_current_property (user_id, property_name, denied)
+            SELECT e.user_id, e.property_name, e.denied
+            FROM evaluate_properties(current_timestamp) e
+            WHERE e.user_id = ANY(arg_user_ids)
+          ON CONFLICT (user_id, property_name) DO UPDATE
+            SET denied = EXCLUDED.denied
+            WHERE materialized_current_property.denied <> EXCLUDED.denied;
+          GET DIAGNOSTICS v_upserted = ROW_COUNT;
+
+          RETURN v_deleted + v_upserted;
+        END;
+        """,
+        volatility='volatile', strict=True, language='plpgsql'
+    )
+)
+
+manager.add_function(
+    Membership.__table__,
+    ddl.Function(
+        'refresh_materialized_current_property', [], 'integer',
+        """
+        DECLARE
+          v_deleted integer;
+          v_upserted integer;
+        BEGIN
+          DELETE FROM materialized_current_property m
+            WHERE NOT EXISTS (
+              SELECT 1 FROM evaluate_properties(current_timestamp) e
+              WHERE e.user_id = m.user_id
+              AND e.property_name = m.property_name
+            );
+          GET DIAGNOSTICS v_deleted = ROW_COUNT;
+
+          INSERT INTO materialized_current_property (user_id, property_name, denied)
+            SELECT e.user_id, e.property_name, e.denied
+            FROM evaluate_properties(current_timestamp) e
+          ON CONFLICT (user_id, property_name) DO UPDATE
+            SET denied = EXCLUDED.denied
+            WHERE materialized_current_property.denied <> EXCLUDED.denied;
+          GET DIAGNOSTICS v_upserted = ROW_COUNT;
+
+          RETURN v_deleted + v_upserted;
+        END;
+        """,
+        volatility='volatile', language='plpgsql'
+    )
+)
+
+manager.add_function(
+    Membership.__table__,
+    ddl.Function(
+        'membership_materialize_current_property', [], 'trigger',
+        """
+        BEGIN
+          IF TG_OP = 'INSERT' THEN
+            PERFORM refresh_materialized_current_property(ARRAY[NEW.user_id]);
+          ELSIF TG_OP = 'DELETE' THEN
+            PERFORM refresh_materialized_current_property(ARRAY[OLD.user_id]);
+          ELSIF NEW.user_id <> OLD.user_id THEN
+            PERFORM refresh_materialized_current_property(
+              ARRAY[OLD.user_id, NEW.user_id]);
+          ELSIF (NEW.group_id, NEW.begins_at, NEW.ends_at)
+              IS DISTINCT FROM (OLD.group_id, OLD.begins_at, OLD.ends_at) THEN
+            PERFORM refresh_materialized_current_property(ARRAY[NEW.user_id]);
+          END IF;
+          RETURN NULL;
+        END;
+        """,
+        volatility='volatile', strict=True, language='plpgsql'
+    )
+)
+
+manager.add_trigger(
+    Membership.__table__,
+    ddl.Trigger(
+        'membership_materialize_current_property_trigger',
+        Membership.__table__, ('INSERT', 'UPDATE', 'DELETE'),
+        'membership_materialize_current_property()',
+    )
+)
+
+manager.add_function(
+    Property.__table__,
+    ddl.Function(
+        'property_materialize_current_property', [], 'trigger',
+        """
+        DECLARE
+          v_group_ids integer[];
+        BEGIN
+          IF TG_OP = 'INSERT' THEN
+            v_group_ids := ARRAY[NEW.property_group_id];
+          ELSIF TG_OP = 'DELETE' THEN
+            v_group_ids := ARRAY[OLD.property_group_id];
+          ELSE
+            v_group_ids := ARRAY[OLD.property_group_id, NEW.property_group_id];
+          END IF;
+          PERFORM refresh_materialized_current_property(ARRAY(
+            SELECT DISTINCT user_id FROM membership
+            WHERE group_id = ANY(v_group_ids)
+          ));
+          RETURN NULL;
+        END;
+        """,
+        volatility='volatile', strict=True, language='plpgsql'
+    )
+)
+
+manager.add_trigger(
+    Property.__table__,
+    ddl.Trigger(
+        'property_materialize_current_property_trigger',
+        Property.__table__, ('INSERT', 'UPDATE', 'DELETE'),
+        'property_materialize_current_property()',
+    )
+)
+
+
 manager.register()
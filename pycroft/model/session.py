@@ -11,10 +11,13 @@
     :copyright: (c) 2011 by AG DSN.
 """
 
+from collections import Counter, namedtuple
+
 from werkzeug.local import LocalProxy
 import wrapt
 
-from sqlalchemy import func
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session as _Session
 
 
 class NullScopedSession(object):
@@ -50,5 +53,59 @@ def with_transaction(wrapped, instance, args, kwargs):
         raise
 
 
+def transaction_cache():
+    """Get a dict for caching values during the current transaction.
+
+    The dict lives in the :attr:`info` of the current session and is
+    discarded when the outermost transaction of the session ends or any
+    rollback happens.  Values that may change within a transaction have to
+    be invalidated by the caller.
+
+    :rtype: dict
+    """
+    return session.info.setdefault('transaction_cache', {})
+
+
+@event.listens_for(_Session, 'after_transaction_end')
+def _reset_transaction_cache(session_, transaction):
+    if transaction.parent is None:
+        session_.info.pop('transaction_cache', None)
+
+
+@event.listens_for(_Session, 'after_soft_rollback')
+def _reset_transaction_cache_on_rollback(session_, previous_transaction):
+    session_.info.pop('transaction_cache', None)
+
+
+UtcnowCacheInfo = namedtuple('UtcnowCacheInfo', ['hits', 'misses'])
+
+_utcnow_cache_stats = Counter()
+
+
 def utcnow():
-    return session.query(func.current_timestamp()).scalar()
+    """Get the current timestamp of the database transaction.
+
+    As ``current_timestamp`` does not change within a transaction, the
+    value is only queried once per transaction.
+    """
+    cache = transaction_cache()
+    try:
+        now = cache['utcnow']
+    except KeyError:
+        _utcnow_cache_stats['misses'] += 1
+        now = cache['utcnow'] = (session.query(func.current_timestamp())
+                                 .scalar())
+    else:
+        _utcnow_cache_stats['hits'] += 1
+    return now
+
+
+def utcnow_cache_info():
+    """Get statistics about :func:`utcnow` since the process started.
+
+    Every hit is a database round trip which has been saved.
+
+    :rtype: UtcnowCacheInfo
+    """
+    return UtcnowCacheInfo(_utcnow_cache_stats['hits'],
+                           _utcnow_cache_stats['misses'])
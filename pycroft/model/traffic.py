@@ -3,16 +3,16 @@
 # This file is part of the Pycroft project and licensed under the terms of
 # the Apache License, Version 2.0. See the LICENSE file for details.
 
-from sqlalchemy import Column, ForeignKey, CheckConstraint, \
-    PrimaryKeyConstraint, func, or_, and_, true, literal_column, \
-    select, cast, TEXT
+from sqlalchemy import Column, ForeignKey, CheckConstraint, Index, \
+    PrimaryKeyConstraint, Table, func, literal_column, select, cast, table, \
+    column
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import relationship, backref, Query
-from sqlalchemy.types import BigInteger, Enum, Integer
+from sqlalchemy.types import BigInteger, Date, Enum, Integer
 
 from pycroft.model.base import ModelBase
-from pycroft.model.ddl import DDLManager, Function, Trigger, View
-from pycroft.model.types import DateTimeTz
+from pycroft.model.ddl import DDLManager, Function, Partition, Trigger, View
+from pycroft.model.types import DateTimeTz, IPAddress
 from pycroft.model.user import User
 from pycroft.model.host import IP, Host, Interface
 
@@ -25,14 +25,24 @@ class TrafficEvent(object):
                     nullable=False)
 
 
+traffic_direction = Enum("Ingress", "Egress", name="traffic_direction")
+
+
 class TrafficVolume(TrafficEvent, ModelBase):
+    """The traffic of an IP per day and direction.
+
+    The table is partitioned by day, see
+    `traffic_volume_create_partitions()`.  Rows without a partition of
+    their own end up in ``traffic_volume_default``.
+    """
     __table_args__ = (
         PrimaryKeyConstraint('ip_id', 'type', 'timestamp'),
+        Index('ix_traffic_volume_ip_id_timestamp', 'ip_id', 'timestamp'),
+        {'postgresql_partition_by': 'RANGE ("timestamp")'},
     )
-    type = Column(Enum("Ingress", "Egress", name="traffic_direction"),
-                  nullable=False)
+    type = Column(traffic_direction, nullable=False)
     ip_id = Column(Integer, ForeignKey(IP.id, ondelete="CASCADE"),
-                   nullable=False, index=True)
+                   nullable=False)
     ip = relationship(IP, backref=backref("traffic_volumes",
                                           cascade="all, delete-orphan"))
     user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'),
@@ -47,6 +57,102 @@ class TrafficVolume(TrafficEvent, ModelBase):
 
 TrafficVolume.__table__.add_is_dependent_on(IP.__table__)
 
+traffic_volume_default_partition = Partition('traffic_volume_default',
+                                             TrafficVolume.__table__)
+ddl.add_partition(TrafficVolume.__table__, traffic_volume_default_partition)
+
+traffic_volume_default = table(
+    traffic_volume_default_partition.name,
+    *(column(c.name, c.type) for c in TrafficVolume.__table__.c)
+)
+
+# The partitions cover a day in UTC each and are named after it, e.g.
+# ``traffic_volume_20191015``.  A partition for a day which already has rows
+# in the default partition is filled with them before it is attached.
+ddl.add_function(
+    TrafficVolume.__table__,
+    Function(
+        'traffic_volume_create_partition', ['arg_day date'], 'boolean',
+        """
+        DECLARE
+          v_name text := 'traffic_volume_' || to_char(arg_day, 'YYYYMMDD');
+          v_start timestamptz := arg_day::timestamp AT TIME ZONE 'UTC';
+          v_end timestamptz := (arg_day + 1)::timestamp AT TIME ZONE 'UTC';
+        BEGIN
+          IF to_regclass(v_name) IS NOT NULL THEN
+            RETURN false;
+          END IF;
+          EXECUTE format('CREATE TABLE %%I (LIKE traffic_volume'
+                         ' INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', v_name);
+          EXECUTE format('WITH moved AS ('
+                         '  DELETE FROM traffic_volume_default'
+                         '  WHERE "timestamp" >= $1 AND "timestamp" < $2'
+                         '  RETURNING *'
+                         ') INSERT INTO %%I SELECT * FROM moved', v_name)
+            USING v_start, v_end;
+          EXECUTE format('ALTER TABLE traffic_volume ATTACH PARTITION %%I'
+                         ' FOR VALUES FROM (%%L) TO (%%L)',
+                         v_name, v_start, v_end);
+          RETURN true;
+        END;
+        """,
+        volatility='volatile', strict=True, language='plpgsql'
+    )
+)
+
+ddl.add_function(
+    TrafficVolume.__table__,
+    Function(
+        'traffic_volume_create_partitions', ['arg_start date', 'arg_end date'],
+        'integer',
+        """
+        DECLARE
+          v_count integer := 0;
+          v_day date;
+        BEGIN
+          FOR v_day IN
+            SELECT generate_series(arg_start, arg_end, '1 day')::date
+          LOOP
+            IF traffic_volume_create_partition(v_day) THEN
+              v_count := v_count + 1;
+            END IF;
+          END LOOP;
+          RETURN v_count;
+        END;
+        """,
+        volatility='volatile', strict=True, language='plpgsql'
+    )
+)
+
+# Dropping partitions does not fire the delete triggers of `traffic_volume`,
+# the rollup and the default partition are pruned separately, see
+# `pycroft.lib.traffic.delete_old_traffic_data`.
+ddl.add_function(
+    TrafficVolume.__table__,
+    Function(
+        'traffic_volume_drop_partitions', ['arg_before date'], 'integer',
+        """
+        DECLARE
+          v_count integer := 0;
+          v_partition regclass;
+        BEGIN
+          FOR v_partition IN
+            SELECT c.oid::regclass
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'traffic_volume'::regclass
+            AND c.relname ~ '^traffic_volume_[0-9]{8}$'
+            AND to_date(right(c.relname, 8), 'YYYYMMDD') < arg_before
+          LOOP
+            EXECUTE format('DROP TABLE %%s', v_partition);
+            v_count := v_count + 1;
+          END LOOP;
+          RETURN v_count;
+        END;
+        """,
+        volatility='volatile', strict=True, language='plpgsql'
+    )
+)
+
 
 pmacct_traffic_egress = View(
     name='pmacct_traffic_egress',
@@ -162,35 +268,207 @@ ddl.add_function(TrafficVolume.__table__, pmacct_ingress_upsert)
 ddl.add_trigger(TrafficVolume.__table__, pmacct_ingress_upsert_trigger)
 
 
+class TrafficDailyUser(ModelBase):
+    """The traffic of a user per day and direction.
+
+    This is a rollup of :class:`TrafficVolume` maintained by triggers, which
+    the traffic statistics are read from.
+    """
+    __table_args__ = (
+        # covers the range scans of `traffic_history()`
+        Index('ix_traffic_daily_user_user_id_day', 'user_id', 'day', 'type',
+              'amount'),
+    )
+    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'),
+                     primary_key=True)
+    day = Column(Date, primary_key=True)
+    type = Column(traffic_direction, primary_key=True)
+    amount = Column(BigInteger, nullable=False)
+    packets = Column(BigInteger, nullable=False)
+
+
+TrafficDailyUser.__table__.add_is_dependent_on(TrafficVolume.__table__)
+
+_traffic_daily_user_upsert = """
+            INSERT INTO traffic_daily_user (user_id, day, type, amount, packets)
+            SELECT user_id, "timestamp"::date, type, sum(amount), sum(packets)
+            FROM ({}) AS delta
+            WHERE user_id IS NOT NULL
+            GROUP BY 1, 2, 3
+            ON CONFLICT (user_id, day, type) DO UPDATE
+              SET (amount, packets) = (traffic_daily_user.amount + EXCLUDED.amount,
+                                       traffic_daily_user.packets + EXCLUDED.packets);"""
+
+ddl.add_function(
+    TrafficDailyUser.__table__,
+    Function(
+        'traffic_volume_update_daily_user', [], 'trigger',
+        """
+        BEGIN
+          IF TG_OP = 'INSERT' THEN{insert}
+          ELSIF TG_OP = 'UPDATE' THEN{update}
+          ELSE{delete}
+          END IF;
+          IF TG_OP <> 'INSERT' THEN
+            DELETE FROM traffic_daily_user
+              WHERE amount = 0 AND packets = 0
+              AND (user_id, day, type) IN (
+                SELECT user_id, "timestamp"::date, type FROM old_volume);
+          END IF;
+          RETURN NULL;
+        END;
+        """.format(
+            insert=_traffic_daily_user_upsert.format(
+                "SELECT user_id, \"timestamp\", type, amount, packets"
+                " FROM new_volume"),
+            update=_traffic_daily_user_upsert.format(
+                "SELECT user_id, \"timestamp\", type, amount, packets"
+                " FROM new_volume"
+                " UNION ALL"
+                " SELECT user_id, \"timestamp\", type, -amount AS amount, -packets AS packets"
+                " FROM old_volume"),
+            delete=_traffic_daily_user_upsert.format(
+                "SELECT user_id, \"timestamp\", type, -amount AS amount, -packets AS packets"
+                " FROM old_volume"),
+        ),
+        volatility='volatile', strict=True, language='plpgsql'
+    )
+)
+
+ddl.add_trigger(
+    TrafficDailyUser.__table__,
+    Trigger(
+        'traffic_volume_update_daily_user_insert_trigger',
+        TrafficVolume.__table__, ('INSERT',),
+        'traffic_volume_update_daily_user()',
+        for_each='STATEMENT', referencing={'NEW': 'new_volume'},
+    )
+)
+
+ddl.add_trigger(
+    TrafficDailyUser.__table__,
+    Trigger(
+        'traffic_volume_update_daily_user_update_trigger',
+        TrafficVolume.__table__, ('UPDATE',),
+        'traffic_volume_update_daily_user()',
+        for_each='STATEMENT',
+        referencing={'OLD': 'old_volume', 'NEW': 'new_volume'},
+    )
+)
+
+ddl.add_trigger(
+    TrafficDailyUser.__table__,
+    Trigger(
+        'traffic_volume_update_daily_user_delete_trigger',
+        TrafficVolume.__table__, ('DELETE',),
+        'traffic_volume_update_daily_user()',
+        for_each='STATEMENT', referencing={'OLD': 'old_volume'},
+    )
+)
+
+
+class TrafficLeaderboard(ModelBase):
+    """The users with the most traffic in a window of the last `days` days,
+    ranked from 1.
+
+    This is a cache of the top users of :class:`TrafficDailyUser`, which is
+    rebuilt periodically by
+    :func:`pycroft.lib.traffic.refresh_traffic_leaderboards`.
+    """
+    days = Column(Integer, primary_key=True)
+    rank = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'),
+                     nullable=False)
+    user = relationship(User)
+    amount = Column(BigInteger, nullable=False)
+    refreshed_at = Column(DateTimeTz, nullable=False)
+
+
+# pmacct can write into this table instead of the views above, which is
+# merged into `traffic_volume` periodically by
+# `pmacct_traffic_merge_staging()` in one statement per batch instead of a
+# trigger call per row.  Egress traffic has `ip_src` set, ingress traffic
+# `ip_dst`.  The table is unlogged, because the data is short-lived.
+pmacct_traffic_staging = Table(
+    'pmacct_traffic_staging', ModelBase.metadata,
+    Column('packets', BigInteger, nullable=False),
+    Column('bytes', BigInteger, nullable=False),
+    Column('stamp_inserted', DateTimeTz, nullable=False),
+    Column('stamp_updated', DateTimeTz, nullable=True),
+    Column('ip_src', IPAddress, nullable=True),
+    Column('ip_dst', IPAddress, nullable=True),
+    CheckConstraint('(ip_src IS NULL) <> (ip_dst IS NULL)'),
+    prefixes=['UNLOGGED'],
+)
+
+pmacct_merge_staging = Function(
+    name="pmacct_traffic_merge_staging", arguments=[], language="plpgsql",
+    rtype="integer",
+    definition="""DECLARE
+        v_count integer;
+    BEGIN
+        WITH staged AS (
+            DELETE FROM pmacct_traffic_staging RETURNING *
+        ), aggregated AS (
+            SELECT
+                CASE WHEN ip_src IS NOT NULL THEN 'Egress' ELSE 'Ingress' END
+                    ::traffic_direction AS type,
+                coalesce(ip_src, ip_dst) AS address,
+                date_trunc('day', stamp_inserted) AS day,
+                sum(bytes) AS bytes,
+                sum(packets) AS packets
+            FROM staged
+            GROUP BY 1, 2, 3
+        )
+        INSERT INTO traffic_volume ({tv_type}, {tv_ip_id}, "{tv_timestamp}", {tv_amount}, {tv_packets}, {tv_user_id})
+        SELECT
+            aggregated.type,
+            {ip_id},
+            aggregated.day,
+            aggregated.bytes,
+            aggregated.packets,
+            {host_owner_id}
+        FROM aggregated
+        JOIN {ip_tname} ON aggregated.address = {ip_address}
+        JOIN {interface_tname} ON {ip_interface_id} = {interface_id}
+        JOIN {host_tname} ON {interface_host_id} = {host_id}
+        ON CONFLICT ({tv_ip_id}, {tv_type}, "{tv_timestamp}")
+        DO UPDATE SET ({tv_amount}, {tv_packets}) = ({tv_tname}.{tv_amount} + EXCLUDED.{tv_amount},
+                                                     {tv_tname}.{tv_packets} + EXCLUDED.{tv_packets});
+        GET DIAGNOSTICS v_count = ROW_COUNT;
+        RETURN v_count;
+    END;""".format(**pmacct_expression_replacements),
+)
+
+ddl.add_function(TrafficVolume.__table__, pmacct_merge_staging)
+
+
 def traffic_history_query():
-    events = (select([func.sum(TrafficVolume.amount).label('amount'),
-                      literal_column('day'),
-                      cast(TrafficVolume.type, TEXT).label('type')]
-                     )
-              .select_from(
-                    func.generate_series(
-                        func.date_trunc('day', literal_column('arg_start')),
-                        func.date_trunc('day', literal_column('arg_end')),
-                        '1 day'
-                    ).alias('day')
-                    .outerjoin(TrafficVolume.__table__, and_(
-                        func.date_trunc('day', TrafficVolume.timestamp) == literal_column('day'),
-                        TrafficVolume.user_id == literal_column('arg_user_id'))
-                    )
-              )
-              .group_by(literal_column('day'), literal_column('type'))
-              ).cte()
-
-    events_ingress = select([events]).where(or_(events.c.type == 'Ingress', events.c.type == None)).cte()
-    events_egress = select([events]).where(or_(events.c.type == 'Egress', events.c.type == None)).cte()
-
-    hist = (select([func.coalesce(events_ingress.c.day, events_egress.c.day).label('timestamp'),
-                    events_ingress.c.amount.label('ingress'),
-                    events_egress.c.amount.label('egress')])
-            .select_from(events_ingress.join(events_egress,
-                                             events_ingress.c.day == events_egress.c.day,
-                                             full=true))
-            .order_by(literal_column('timestamp'))
+    day = literal_column('day.day')
+    traffic = (select([TrafficDailyUser.day,
+                       func.sum(TrafficDailyUser.amount)
+                           .filter(TrafficDailyUser.type == 'Ingress')
+                           .label('ingress'),
+                       func.sum(TrafficDailyUser.amount)
+                           .filter(TrafficDailyUser.type == 'Egress')
+                           .label('egress')])
+               .where(TrafficDailyUser.user_id == literal_column('arg_user_id'))
+               .where(TrafficDailyUser.day.between(
+                   cast(literal_column('arg_start'), Date),
+                   cast(literal_column('arg_end'), Date)))
+               .group_by(TrafficDailyUser.day)
+               ).alias('traffic')
+
+    hist = (select([day.label('timestamp'), traffic.c.ingress, traffic.c.egress])
+            .select_from(
+                func.generate_series(
+                    func.date_trunc('day', literal_column('arg_start')),
+                    func.date_trunc('day', literal_column('arg_end')),
+                    '1 day'
+                ).alias('day')
+                .outerjoin(traffic, traffic.c.day == cast(day, Date))
+            )
+            .order_by(day)
             )
 
     return hist
@@ -209,7 +487,7 @@ traffic_history_function = Function(
 )
 
 ddl.add_function(
-    TrafficVolume.__table__,
+    TrafficDailyUser.__table__,
     traffic_history_function
 )
 
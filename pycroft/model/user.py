@@ -11,16 +11,18 @@
     :copyright: (c) 2011 by AG DSN.
 """
 import re
-from datetime import timedelta
+from datetime import datetime, time, timedelta, timezone
+from itertools import chain
 
 from flask_login import UserMixin
 from sqlalchemy import (
     Boolean, BigInteger, CheckConstraint, Column, ForeignKey, Integer,
-    String, and_, exists, join, literal, not_, null, or_, select, Sequence,
-    Interval, Date, func)
+    String, and_, event, exists, join, literal, not_, null, or_, select,
+    Sequence, Interval, Date, func)
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
-from sqlalchemy.orm import backref, object_session, relationship, validates
+from sqlalchemy.orm import Session as _Session, backref, object_session, \
+    relationship, validates
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm.util import has_identity
@@ -71,19 +73,24 @@ class User(IntegerIdModel, UserMixin):
 
     @hybrid_method
     def traffic_for_days(self, days):
-        from pycroft.model.traffic import TrafficVolume
+        from pycroft.model.traffic import TrafficDailyUser
 
-        return sum(v.amount for v in TrafficVolume.q.filter_by(user_id=self.id)
-                   .filter(TrafficVolume.timestamp >= (session.utcnow() - timedelta(days-1)).date()))
+        return int(session.session.query(
+            func.coalesce(func.sum(TrafficDailyUser.amount), 0)
+        ).filter(
+            TrafficDailyUser.user_id == self.id,
+            TrafficDailyUser.day >= (session.utcnow() - timedelta(days-1)).date()
+        ).scalar())
 
     @traffic_for_days.expression
     def traffic_for_days(self, days):
-        from pycroft.model.traffic import TrafficVolume
+        from pycroft.model.traffic import TrafficDailyUser
 
-        return select([func.sum(TrafficVolume.amount).label('amount')]) \
-            .where(
-            TrafficVolume.timestamp >= (session.utcnow() - timedelta(days-1)).date()
-            .where(TrafficVolume.user_id == self.id))
+        return select([func.coalesce(func.sum(TrafficDailyUser.amount), 0)]) \
+            .where(TrafficDailyUser.user_id == self.id) \
+            .where(TrafficDailyUser.day
+                   >= (session.utcnow() - timedelta(days-1)).date()) \
+            .label('traffic_for_days')
 
     #: This is a relationship to the `current_property` view filtering out
     #: the entries with `denied=True`.
@@ -100,6 +107,16 @@ class User(IntegerIdModel, UserMixin):
         primaryjoin='User.id == foreign(CurrentProperty.user_id)',
         viewonly=True
     )
+    #: This is a relationship to the `materialized_current_property` table
+    #: filtering out the entries with `denied=True`.  It reads the same
+    #: data as :attr:`current_properties` from indexed rows instead of
+    #: evaluating all memberships.
+    materialized_properties = relationship(
+        'MaterializedCurrentProperty',
+        primaryjoin='and_(User.id == MaterializedCurrentProperty.user_id,'
+                    '~MaterializedCurrentProperty.denied)',
+        viewonly=True
+    )
 
     login_regex = re.compile(r"""
         ^
@@ -284,6 +301,14 @@ class User(IntegerIdModel, UserMixin):
             now = session.utcnow()
             when = single(now)
 
+        if (when.begin is not None and when.begin == when.end
+                and not when.empty):
+            point = when.begin
+            if not isinstance(point, datetime):
+                # like the database, take dates as midnight UTC
+                point = datetime.combine(point, time(), tzinfo=timezone.utc)
+            return self.property_index().has_property(property_name, point)
+
         prop_granted_flags = [
             group.property_grants[property_name]
             for group in self.active_property_groups(when)
@@ -335,6 +360,35 @@ class User(IntegerIdModel, UserMixin):
         return max((membership.group.permission_level for membership in self.active_memberships()),
                    default=0)
 
+    def property_index(self):
+        """
+        Get the index of the intervals in which the user has each property.
+
+        The index is built from all memberships of the user with one query
+        and cached until the end of the transaction or until memberships,
+        properties or property groups change.
+
+        :rtype: PropertyIntervalIndex
+        """
+        session_ = object_session(self)
+        if session_.autoflush:
+            session_.flush()
+        indexes = session.transaction_cache().setdefault('property_index', {})
+        index = indexes.get(self.id)
+        if index is None:
+            index = indexes[self.id] = PropertyIntervalIndex(
+                session_.query(
+                    Property.name,
+                    Property.granted,
+                    Membership.begins_at,
+                    Membership.ends_at
+                ).filter(
+                    Property.property_group_id == Membership.group_id,
+                    Membership.user_id == self.id
+                ).all()
+            )
+        return index
+
     def property_intervals(self, name, when=UnboundedInterval):
         """
         Get the set of intervals in which the user was granted a given property
@@ -344,27 +398,7 @@ class User(IntegerIdModel, UserMixin):
         property
         :rtype: IntervalSet
         """
-        property_assignments = object_session(self).query(
-            Property.granted,
-            Membership.begins_at,
-            Membership.ends_at
-        ).filter(
-            Property.name == name,
-            Property.property_group_id == PropertyGroup.id,
-            PropertyGroup.id == Membership.group_id,
-            Membership.user_id == self.id
-        ).all()
-        granted_intervals = IntervalSet(
-            closed(begins_at, ends_at)
-            for granted, begins_at, ends_at in property_assignments
-            if granted
-        )
-        denied_intervals = IntervalSet(
-            closed(begins_at, ends_at)
-            for granted, begins_at, ends_at in property_assignments
-            if not granted
-        )
-        return (granted_intervals - denied_intervals).intersect(when)
+        return self.property_index().intervals(name, when)
 
 
 class Group(IntegerIdModel):
@@ -510,6 +544,64 @@ class Property(IntegerIdModel):
     )
 
 
+class PropertyIntervalIndex(object):
+    """
+    The intervals in which a user has each property.
+
+    A property is had while it is granted by a membership and not denied by
+    another one.  Lookups of a point in time and of the intervals within a
+    window are binary searches in the :class:`IntervalSet` of the property.
+    """
+    def __init__(self, assignments):
+        """
+        :param assignments: tuples of property name, granted flag, and begin
+            and end of the membership
+        """
+        granted = {}
+        denied = {}
+        for name, is_granted, begins_at, ends_at in assignments:
+            (granted if is_granted else denied).setdefault(name, []).append(
+                closed(begins_at, ends_at))
+        self._intervals = {
+            name: IntervalSet(intervals) - IntervalSet(denied.get(name))
+            for name, intervals in granted.items()
+        }
+
+    def has_property(self, name, when):
+        """
+        :param str name: name of a property
+        :param datetime when: point in time
+        :rtype: bool
+        """
+        return when in self._intervals.get(name, IntervalSet())
+
+    def intervals(self, name, when=UnboundedInterval):
+        """
+        :param str name: name of a property
+        :param Interval when: window
+        :returns: The set of intervals in which the property is had within
+            `when`
+        :rtype: IntervalSet
+        """
+        return self._intervals.get(name, IntervalSet()).intersect(when)
+
+
+def invalidate_property_index():
+    """Discard the cached :class:`PropertyIntervalIndex` of all users.
+
+    This has to be called after changing memberships or properties with
+    statements instead of through the ORM.
+    """
+    session.transaction_cache().pop('property_index', None)
+
+
+@event.listens_for(_Session, 'after_flush')
+def _invalidate_property_index(session_, flush_context):
+    if any(isinstance(obj, (Membership, Property, PropertyGroup))
+           for obj in chain(session_.new, session_.dirty, session_.deleted)):
+        session_.info.get('transaction_cache', {}).pop('property_index', None)
+
+
 unix_account_uid_seq = Sequence('unix_account_uid_seq', start=1000,
                                 metadata=ModelBase.metadata)
 
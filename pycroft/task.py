@@ -1,4 +1,5 @@
 import os
+import time
 
 from datetime import timedelta
 
@@ -6,12 +7,17 @@ from celery import Celery
 from sqlalchemy.orm import with_polymorphic
 
 from pycroft.helpers.task import DBTask
+from pycroft.lib.finance import repair_account_balances
 from pycroft.lib.logging import log_task_event
+from pycroft.lib.membership import refresh_materialized_properties
 from pycroft.lib.task import task_type_to_impl
+from pycroft.lib.traffic import apply_traffic_limit, \
+    create_traffic_partitions, delete_old_traffic_data, \
+    drop_old_traffic_partitions, merge_pmacct_traffic, \
+    refresh_traffic_leaderboards, traffic_retention_limit
 from pycroft.model import session
 from pycroft.model.session import with_transaction
 from pycroft.model.task import Task, TaskStatus
-from pycroft.model.traffic import TrafficVolume
 
 app = Celery('tasks', backend=os.environ['PYCROFT_CELERY_RESULT_BACKEND_URI'],
              broker=os.environ['PYCROFT_CELERY_BROKER_URI'])
@@ -70,13 +76,89 @@ def execute_scheduled_tasks():
 
 
 @app.task(base=DBTask)
-def remove_old_traffic_data():
-    TrafficVolume.q.filter(
-        TrafficVolume.timestamp < (session.utcnow() - timedelta(7))).delete()
+def enforce_traffic_limit(limit, days=7):
+    actions = apply_traffic_limit(limit, days)
 
     session.session.commit()
 
-    print("Deleted old traffic data")
+    print("Enforced traffic limit ({} users blocked, {} users unblocked)"
+          .format(len(actions.blocked), len(actions.unblocked)))
+
+
+@app.task(base=DBTask)
+def remove_old_traffic_data(keep_days=7, keep_rollup_days=365,
+                            batch_size=10000):
+    start = time.monotonic()
+    before = traffic_retention_limit(keep_days)
+    rollup_before = traffic_retention_limit(keep_rollup_days)
+
+    dropped = drop_old_traffic_partitions(before)
+    session.session.commit()
+    print("Dropped {} traffic volume partitions".format(dropped))
+
+    removed = 0
+    while True:
+        deleted = delete_old_traffic_data(before, rollup_before, batch_size)
+        session.session.commit()
+        if not deleted:
+            break
+        removed += deleted
+        print("Deleted {} old traffic rows so far".format(removed))
+
+    duration = time.monotonic() - start
+    print("Deleted old traffic data ({} partitions dropped, {} rows removed) "
+          "in {:.1f}s".format(dropped, removed, duration))
+
+    return {'partitions_dropped': dropped, 'rows_removed': removed,
+            'duration': duration}
+
+
+@app.task(base=DBTask)
+def create_traffic_volume_partitions():
+    created = create_traffic_partitions()
+
+    session.session.commit()
+
+    print("Created {} traffic volume partitions".format(created))
+
+
+@app.task(base=DBTask)
+def merge_pmacct_traffic_data():
+    merged = merge_pmacct_traffic()
+
+    session.session.commit()
+
+    print("Merged staged traffic data ({} rows changed)".format(merged))
+
+
+@app.task(base=DBTask)
+def refresh_traffic_leaderboard():
+    ranked = refresh_traffic_leaderboards()
+
+    session.session.commit()
+
+    print("Refreshed traffic leaderboards ({} users ranked)".format(ranked))
+
+
+@app.task(base=DBTask)
+def refresh_current_property():
+    changed = refresh_materialized_properties()
+
+    session.session.commit()
+
+    print("Refreshed materialized properties ({} rows changed)".format(changed))
+
+
+@app.task(base=DBTask)
+def check_account_balances():
+    discrepancies = repair_account_balances()
+
+    session.session.commit()
+
+    for account_id, cached, actual in discrepancies:
+        print("Repaired balance of account {}: {} -> {}".format(
+            account_id, cached, actual))
+    print("Checked account balances ({} repaired)".format(len(discrepancies)))
 
 
 app.conf.update(
@@ -89,5 +171,35 @@ app.conf.update(
             'task': 'pycroft.task.remove_old_traffic_data',
             'schedule': timedelta(days=1)
         },
+        'create-traffic-volume-partitions': {
+            'task': 'pycroft.task.create_traffic_volume_partitions',
+            'schedule': timedelta(days=1)
+        },
+        'merge-pmacct-traffic-data': {
+            'task': 'pycroft.task.merge_pmacct_traffic_data',
+            'schedule': timedelta(minutes=1)
+        },
+        'refresh-traffic-leaderboard': {
+            'task': 'pycroft.task.refresh_traffic_leaderboard',
+            'schedule': timedelta(minutes=5)
+        },
+        'refresh-current-property': {
+            'task': 'pycroft.task.refresh_current_property',
+            'schedule': timedelta(minutes=5)
+        },
+        'check-account-balances': {
+            'task': 'pycroft.task.check_account_balances',
+            'schedule': timedelta(days=1)
+        },
     },
     CELERY_TIMEZONE='UTC')
+
+# The traffic limit is only enforced if it is configured: at most
+# PYCROFT_TRAFFIC_LIMIT bytes within the last PYCROFT_TRAFFIC_LIMIT_DAYS days
+if os.environ.get('PYCROFT_TRAFFIC_LIMIT'):
+    app.conf.CELERYBEAT_SCHEDULE['enforce-traffic-limit'] = {
+        'task': 'pycroft.task.enforce_traffic_limit',
+        'schedule': timedelta(hours=1),
+        'args': (int(os.environ['PYCROFT_TRAFFIC_LIMIT']),
+                 int(os.environ.get('PYCROFT_TRAFFIC_LIMIT_DAYS', 7))),
+    }
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Pycroft Authors. See the AUTHORS file.
+# This file is part of the Pycroft project and licensed under the terms of
+# the Apache License, Version 2.0. See the LICENSE file for details.
+"""
+Export the traffic volume of a range of days to CSV or Parquet.
+
+The rows are streamed from a server-side cursor in batches, so a month of
+traffic can be exported without holding it in memory.  If the output is a
+directory, one file is written per day, and the days can be exported in
+parallel with one database connection each.
+"""
+import argparse
+import csv
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from pycroft.lib.traffic import traffic_volume_export_query
+from pycroft.model import create_engine
+
+COLUMNS = ('timestamp', 'type', 'address', 'user_id', 'amount', 'packets')
+
+
+class CSVWriter:
+    def __init__(self, file):
+        self.file = file
+        self.writer = csv.writer(file)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows(
+            (row.timestamp.isoformat(), row.type, str(row.address),
+             row.user_id, row.amount, row.packets)
+            for row in rows
+        )
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    def __init__(self, path):
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            ('timestamp', pyarrow.timestamp('us', tz='UTC')),
+            ('type', pyarrow.string()),
+            ('address', pyarrow.string()),
+            ('user_id', pyarrow.int32()),
+            ('amount', pyarrow.int64()),
+            ('packets', pyarrow.int64()),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        columns = [
+            [row.timestamp for row in rows],
+            [row.type for row in rows],
+            [str(row.address) for row in rows],
+            [row.user_id for row in rows],
+            [row.amount for row in rows],
+            [row.packets for row in rows],
+        ]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(
+            [self.pyarrow.array(values, type=field.type)
+             for values, field in zip(columns, self.schema)],
+            schema=self.schema,
+        ))
+
+    def close(self):
+        self.writer.close()
+
+
+def open_writer(fmt, path):
+    if fmt == 'parquet':
+        return ParquetWriter(path)
+    if path == '-':
+        return CSVWriter(sys.stdout)
+    return CSVWriter(open(path, 'w', newline=''))
+
+
+def days_between(start, end):
+    return [start + timedelta(days=n) for n in range((end - start).days + 1)]
+
+
+def export_days(connection, days, writer, batch_size=10000):
+    """Write the traffic volume of `days` to `writer` in batches of
+    `batch_size` rows.
+
+    :return: The number of rows written
+    :rtype: int
+    """
+    count = 0
+    for day in days:
+        result = connection.execution_options(stream_results=True).execute(
+            traffic_volume_export_query(day))
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            writer.write(rows)
+            count += len(rows)
+    return count
+
+
+def export_to_file(engine, days, fmt, path, batch_size):
+    writer = open_writer(fmt, path)
+    try:
+        with engine.connect() as connection:
+            return export_days(connection, days, writer, batch_size)
+    finally:
+        writer.close()
+
+
+def traffic_export(args):
+    try:
+        connection_string = os.environ['PYCROFT_DB_URI']
+    except KeyError:
+        raise RuntimeError("Environment variable PYCROFT_DB_URI must be "
+                           "set to an SQLAlchemy connection string.")
+    engine = create_engine(connection_string, pool_size=args.jobs)
+    days = days_between(args.start, args.end)
+
+    if not os.path.isdir(args.output):
+        count = export_to_file(engine, days, args.format, args.output,
+                               args.batch_size)
+        print("Exported {} rows".format(count), file=sys.stderr)
+        return
+
+    def export_day(day):
+        path = os.path.join(args.output, 'traffic_volume_{:%Y%m%d}.{}'
+                            .format(day, args.format))
+        return export_to_file(engine, [day], args.format, path,
+                              args.batch_size)
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for day, count in zip(days, executor.map(export_day, days)):
+            print("Exported {} rows of {}".format(count, day),
+                  file=sys.stderr)
+
+
+def date(string):
+    return datetime.strptime(string, '%Y-%m-%d').date()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pycroft traffic export")
+    parser.add_argument("start", type=date,
+                        help="first day to export (YYYY-MM-DD, UTC)")
+    parser.add_argument("end", type=date,
+                        help="last day to export (YYYY-MM-DD, UTC)")
+    parser.add_argument("-o", "--output", default='-',
+                        help="file to write to, or a directory to write one "
+                             "file per day to. Defaults to stdout.")
+    parser.add_argument("-f", "--format", choices=('csv', 'parquet'),
+                        default='csv', help="output format")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of days to export in parallel if the "
+                             "output is a directory")
+    parser.add_argument("-b", "--batch-size", type=int, default=10000,
+                        help="number of rows fetched at once")
+
+    args = parser.parse_args()
+    if args.format == 'parquet':
+        if args.output == '-':
+            parser.error("Parquet cannot be written to stdout")
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error("Parquet output requires pyarrow, "
+                         "install pycroft[Parquet]")
+    if args.jobs > 1 and not os.path.isdir(args.output):
+        parser.error("--jobs requires the output to be a directory")
+    traffic_export(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -54,7 +54,10 @@ setup(
     extras_require={
         'SchemaDisplay': [
             'sqlalchemy-schemadisplay',
-        ]
+        ],
+        'Parquet': [
+            'pyarrow',
+        ],
     },
     tests_require=[
         'factory-boy',
@@ -67,6 +70,7 @@ setup(
         'console_scripts': [
             'pycroft = scripts.server_run:main',
             'pycroft_ldap_sync = ldap_sync.__main__:main',
+            'pycroft_traffic_export = scripts.traffic_export:main',
         ]
     },
     license="Apache Software License",
@@ -61,3 +61,15 @@ class Test_010_Building(FrontendDataTestBase, FixtureDataTestBase):
         self.assert_template_get_request(
             "/facilities/overcrowded/{}".format(self.building.id),
             "facilities/room_overcrowded.html")
+
+    def test_building_traffic_json(self):
+        response = self.assert_response_code(
+            "/facilities/building/{}/traffic/json/3".format(self.building.id),
+            200)
+        items = response.json['items']
+        self.assertEqual(len(items['timestamps']), 3)
+        self.assertEqual(items['ingress'], [0, 0, 0])
+        self.assertEqual(items['egress'], [0, 0, 0])
+        self.assert_response_code(
+            "/facilities/building/{}/traffic/json/0".format(self.building.id),
+            404)
@@ -21,6 +21,39 @@ class UserViewingPagesTestCase(UserFrontendTestBase):
     def test_user_search_access(self):
         self.assert200(self.client.get(url_for('user.search')))
 
+    def test_user_hosts_traffic_json(self):
+        user = UserWithHostFactory()
+        session.session.commit()
+        host_id = user.hosts[0].id
+        addresses = [str(ip.address) for ip in user.hosts[0].ips]
+        response = self.client.get(url_for('host.user_hosts_traffic_json',
+                                           user_id=user.id, days=3))
+        self.assert200(response)
+        host, = response.json['items']
+        interface, = host['interfaces']
+        self.assertEqual(host['id'], host_id)
+        self.assertEqual((host['ingress'], host['egress']), (0, 0))
+        self.assertEqual([ip['address'] for ip in interface['ips']], addresses)
+        self.assert404(self.client.get(url_for('host.user_hosts_traffic_json',
+                                               user_id=user.id, days=0)))
+
+    def test_user_traffic_json(self):
+        user_id = self.admin.id
+        response = self.client.get(url_for('user.json_trafficdata',
+                                           user_id=user_id, days=3))
+        self.assert200(response)
+        traffic = response.json['items']['traffic']
+        self.assertEqual(len(traffic), 3)
+        self.assertEqual([(t['ingress'], t['egress']) for t in traffic],
+                         [(0, 0)] * 3)
+
+    def test_user_traffic_json_invalid(self):
+        user_id = self.admin.id
+        self.assert404(self.client.get(url_for('user.json_trafficdata',
+                                               user_id=user_id, days=0)))
+        self.assert404(self.client.get(url_for('user.json_trafficdata',
+                                               user_id=user_id + 1000)))
+
 
 class UserBlockingTestCase(LegacyUserFrontendTestBase):
     def setUp(self):
@@ -1,8 +1,11 @@
 # Copyright (c) 2015 The Pycroft Authors. See the AUTHORS file.
 # This file is part of the Pycroft project and licensed under the terms of
 # the Apache License, Version 2.0. See the LICENSE file for details.
-import unittest
 import operator
+import os
+import random
+import time
+import unittest
 from pycroft.helpers.interval import (
     Interval, IntervalSet, closed, closedopen, openclosed, open, empty, single)
 
@@ -158,8 +161,11 @@ class Test_Interval(IntervalTestCase):
             (closed(0, 0), closed(0, 0)),
             (closed(0, 1), closed(1, 2)),
             (closed(None, 0), closed(0, None)),
+            (open(0, 1), closedopen(1, 2)),
+            (openclosed(0, 1), open(1, 2)),
         ])
         self.assertCallFalse(Interval.meets, [
+            (closedopen(0, 1), open(1, 2)),
             (closed(0, 0), closed(1, 1)),
             (closed(0, 1), closed(2, 3)),
             (closed(None, 0), closed(1, None)),
@@ -310,6 +316,18 @@ class Test_0200_IntervalSet(unittest.TestCase):
             IntervalSet([empty(6), closedopen(1, 2), empty(0), closedopen(2, 3), open(4, 5)]),
             IntervalSet([closedopen(1, 3), open(4, 5)]),
         )
+        self.assertEqual(
+            IntervalSet([open(0, 4), closedopen(4, None)]),
+            IntervalSet([open(0, None)]),
+        )
+        self.assertEqual(
+            IntervalSet([closed(1, 3), open(4, 6), closed(4, 4)]),
+            IntervalSet([closed(1, 3), closedopen(4, 6)]),
+        )
+        self.assertEqual(
+            IntervalSet([closed(0, 1), open(0, 1), closedopen(0, 1)])[0],
+            closed(0, 1),
+        )
 
     def test_complement(self):
         self.assertIntervalSetOperationEquals(IntervalSet.complement, [
@@ -332,6 +350,62 @@ class Test_0200_IntervalSet(unittest.TestCase):
             ([[open(None, None)], [openclosed(None, 0), closed(1, 2), closedopen(3, None)]], [openclosed(None, 0), closed(1, 2), closedopen(3, None)]),
         ])
 
+    def test_intersect_single_interval(self):
+        intervals = IntervalSet([closed(0, 1), open(2, 3), closedopen(4, 5),
+                                 closed(6, None)])
+        self.assertEqual(intervals & open(1, 4), IntervalSet(open(2, 3)))
+        self.assertEqual(intervals & closed(1, 4),
+                         IntervalSet([single(1), open(2, 3), single(4)]))
+        self.assertEqual(intervals & closed(5, 6), IntervalSet(single(6)))
+        self.assertEqual(intervals & open(None, 0), IntervalSet())
+        self.assertEqual(intervals & open(None, None), intervals)
+
+    def test_contains(self):
+        intervals = IntervalSet([closed(None, 0), open(2, 3), closedopen(4, 5)])
+        self.assertIn(-100, intervals)
+        self.assertIn(0, intervals)
+        self.assertNotIn(1, intervals)
+        self.assertNotIn(2, intervals)
+        self.assertIn(2.5, intervals)
+        self.assertIn(4, intervals)
+        self.assertNotIn(5, intervals)
+        self.assertIn(closed(-2, -1), intervals)
+        self.assertIn(open(2, 3), intervals)
+        self.assertNotIn(closed(2, 3), intervals)
+        self.assertNotIn(closed(3, 4), intervals)
+        self.assertNotIn(0, IntervalSet())
+
+    def test_contains_random(self):
+        # Endpoints are integers, so the set only changes at integers and
+        # halves suffice to compare it with the intervals point by point.
+        rng = random.Random(0)
+        points = [p / 2 for p in range(-2, 23)]
+
+        def random_interval():
+            begin, end = sorted(rng.randint(0, 10) for _ in range(2))
+            return rng.choice([closed, closedopen, openclosed, open])(
+                None if rng.random() < 0.1 else begin,
+                None if rng.random() < 0.1 else end)
+
+        for _ in range(500):
+            intervals = [random_interval() for _ in range(rng.randint(0, 5))]
+            interval_set = IntervalSet(intervals)
+            contained = {p for p in points
+                         if any(p in i for i in intervals)}
+            for point in points:
+                self.assertEqual(point in interval_set, point in contained,
+                                 (intervals, point))
+            for interval in interval_set:
+                self.assertFalse(interval.empty)
+            for a, b in zip(interval_set, interval_set[1:]):
+                self.assertLess(a, b)
+                self.assertFalse(a.overlaps(b) or a.meets(b), (a, b))
+            item = random_interval()
+            self.assertEqual(
+                item in interval_set,
+                all(p in contained for p in points if p in item),
+                (intervals, item))
+
     def test_difference(self):
         self.assertIntervalSetOperationEquals(IntervalSet.difference, [
             ([[open(None, None)], [closed(0, 1), closedopen(2, 3), openclosed(4, 5), open(6, 7)]], [open(None, 0), open(1, 2), closed(3, 4), openclosed(5, 6), closedopen(7, None)]),
@@ -360,10 +434,58 @@ class Test_0200_IntervalSet(unittest.TestCase):
         self.assertEqual(target, base | [closed(0, 1)])
         # Intersection
         base = target | closed(1, 2)
-        self.assertEqual(target, base & IntervalSet(openclosed(0, 1)))
-        self.assertEqual(target, base & openclosed(0, 1))
-        self.assertEqual(target, base & [openclosed(0, 1)])
+        self.assertEqual(target, base & IntervalSet(closed(0, 1)))
+        self.assertEqual(target, base & closed(0, 1))
+        self.assertEqual(target, base & [closed(0, 1)])
         # Difference
         self.assertEqual(target, base - IntervalSet(openclosed(1, 2)))
         self.assertEqual(target, base - openclosed(1, 2))
         self.assertEqual(target, base - [openclosed(1, 2)])
+
+
+@unittest.skipUnless(os.environ.get('PYCROFT_BENCHMARK'),
+                     "set PYCROFT_BENCHMARK to run benchmarks")
+class IntervalSetBenchmark(unittest.TestCase):
+    size = int(os.environ.get('PYCROFT_BENCHMARK_INTERVALS', 10000))
+
+    def setUp(self):
+        self.even = IntervalSet(closedopen(4 * n, 4 * n + 2)
+                                for n in range(self.size))
+        self.odd = IntervalSet(closedopen(4 * n + 1, 4 * n + 4)
+                               for n in range(self.size))
+
+    def measure(self, description, function, repeat=10):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            result = function()
+        print("{} on {} intervals: {:.2f}ms".format(
+            description, self.size,
+            (time.perf_counter() - start) / repeat * 1000))
+        return result
+
+    def test_set_operations(self):
+        union = self.measure("union", lambda: self.even | self.odd)
+        self.assertEqual(len(union), 1)
+        intersection = self.measure("intersect", lambda: self.even & self.odd)
+        self.assertEqual(len(intersection), self.size)
+        difference = self.measure("difference", lambda: self.even - self.odd)
+        self.assertEqual(len(difference), self.size)
+
+    def test_lookups(self):
+        points = range(0, 4 * self.size, 7)
+        contained = self.measure(
+            "{} point lookups".format(len(points)),
+            lambda: [point in self.even for point in points], repeat=1)
+        # Scanning all intervals is far too slow for every point
+        sample = points[::len(points) // 100 or 1]
+        linear = self.measure(
+            "{} linear point lookups".format(len(sample)),
+            lambda: [any(point in i for i in self.even) for point in sample],
+            repeat=1)
+        self.assertEqual(contained[::len(points) // 100 or 1], linear)
+
+        window = closed(2 * self.size, 2 * self.size + 100)
+        windowed = self.measure("window intersect",
+                                lambda: self.even & window, repeat=100)
+        self.assertEqual(windowed, IntervalSet(
+            i & window for i in self.even if i.overlaps(window)))
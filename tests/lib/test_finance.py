@@ -2,13 +2,17 @@
 # This file is part of the Pycroft project and licensed under the terms of
 # the Apache License, Version 2.0. See the LICENSE file for details.
 import operator
+import os
 import pkgutil
+import time as time_
 import unittest
 from datetime import date, datetime, time, timedelta
 from decimal import Decimal
 from io import StringIO
 
 from factory import Iterator
+from mt940.models import Amount, Transaction as MT940Transaction
+from sqlalchemy import text
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
 from pycroft import config
@@ -17,18 +21,29 @@ from tests.factories import MembershipFactory, ConfigFactory
 
 from pycroft.helpers.interval import closed, closedopen, openclosed, single
 from pycroft.lib.finance import (
-    cleanup_description,
+    cleanup_description, CSVImportError,
     import_bank_account_activities_csv, simple_transaction,
     transferred_amount,
-    is_ordered, get_last_applied_membership_fee, estimate_balance)
+    is_ordered, get_last_applied_membership_fee, estimate_balance,
+    get_account_balance_discrepancies, repair_account_balances,
+    get_users_with_payment_in_default,
+    take_actions_for_payment_in_default_users,
+    post_transactions_for_membership_fee, process_transactions,
+    get_activity_matches, match_activities, MATCH_CONFIDENCE_USER_ID,
+    MATCH_CONFIDENCE_USER_ID_WITHOUT_DASH,
+    MATCH_CONFIDENCE_USER_ID_WITHOUT_SPACES, MATCH_CONFIDENCE_NAME,
+    MATCH_CONFIDENCE_AMBIGUOUS_NAME)
 from pycroft.lib.membership import make_member_of
+from pycroft.lib.user import encode_type2_user_id, status
 from pycroft.model import session
+from pycroft.model.logging import UserLogEntry
 from pycroft.model.finance import (
-    Account, BankAccount, BankAccountActivity, Transaction)
+    Account, AccountBalance, BankAccount, BankAccountActivity, MembershipFee,
+    Transaction)
 from pycroft.model.user import PropertyGroup, User, Membership
 from tests import FixtureDataTestBase, FactoryDataTestBase, UserFactory
 from tests.factories.finance import MembershipFeeFactory, TransactionFactory, \
-    AccountFactory
+    AccountFactory, BankAccountFactory
 from tests.fixtures.config import ConfigData, PropertyGroupData, PropertyData
 from tests.lib.finance_fixtures import (
     AccountData, BankAccountData, MembershipData, UserData,
@@ -99,6 +114,47 @@ class Test_010_BankAccount(FixtureDataTestBase):
         BankAccountActivity.q.delete()
         session.session.commit()
 
+    def import_test_csv(self, transform=lambda lines: lines,
+                        expected_balance=Decimal('43.42')):
+        data = pkgutil.get_data(__package__, "data_test_finance.csv")
+        lines = [line + '\n' for line in data.decode('utf-8').splitlines()]
+        import_bank_account_activities_csv(
+            StringIO(''.join(transform(lines))), expected_balance)
+
+    def test_0011_reimport_bank_account_csv(self):
+        self.import_test_csv()
+        count = BankAccountActivity.q.count()
+        # Importing the newest activity only adds nothing
+        self.import_test_csv(lambda lines: lines[:2])
+        self.import_test_csv()
+        self.assertEqual(BankAccountActivity.q.count(), count)
+
+    def test_0011_reimport_overlapping_bank_account_csv(self):
+        # The three oldest activities
+        self.import_test_csv(lambda lines: lines[:1] + lines[2:],
+                             expected_balance=Decimal('-6.58'))
+        # The two newest activities, one of which is already stored.  The
+        # expected balance covers every activity of the file and the stored
+        # ones before its first day, not only the inserted one.
+        self.import_test_csv(lambda lines: lines[:3])
+        self.assertEqual(BankAccountActivity.q.count(), 4)
+        with self.assertRaises(CSVImportError):
+            self.import_test_csv(lambda lines: lines[:3],
+                                 expected_balance=Decimal('9044.00'))
+
+    def test_0012_import_bank_account_csv_conflict(self):
+        self.import_test_csv()
+        # Both the database and the file have an activity on the same day
+        # which is missing in the other
+        with self.assertRaises(CSVImportError):
+            self.import_test_csv(lambda lines: [
+                line.replace('"Pauschalen"', '"Pauschale"') for line in lines
+            ])
+
+    def test_0013_import_unsorted_bank_account_csv(self):
+        with self.assertRaises(CSVImportError):
+            self.import_test_csv(lambda lines: lines[:1] + lines[:0:-1])
+
     def test_0020_get_last_applied_membership_fee(self):
         try:
             get_last_applied_membership_fee()
@@ -158,6 +214,27 @@ class Test_010_BankAccount(FixtureDataTestBase):
         Transaction.q.delete()
         session.session.commit()
 
+    def test_0040_repair_account_balances(self):
+        simple_transaction(
+            u"transaction", self.fee_account, self.user_account,
+            Decimal(90), self.author
+        )
+        self.assertEqual(get_account_balance_discrepancies(), [])
+
+        session.session.execute(
+            AccountBalance.__table__.update()
+            .where(AccountBalance.account_id == self.user_account.id)
+            .values(balance=Decimal(10))
+        )
+        expected = [(self.user_account.id, Decimal(10), Decimal(90))]
+        self.assertEqual(get_account_balance_discrepancies(), expected)
+
+        self.assertEqual(repair_account_balances(), expected)
+        self.assertEqual(get_account_balance_discrepancies(), [])
+        self.assertEqual(self.user_account.balance, Decimal(90))
+        Transaction.q.delete()
+        session.session.commit()
+
     def test_0050_cleanup_non_sepa_description(self):
         non_sepa_description = u"1234-0 Dummy, User, with " \
                                u"a- space at postition 28"
@@ -174,6 +251,37 @@ class Test_010_BankAccount(FixtureDataTestBase):
         self.assertEqual(cleanup_description(sepa_description),
                          clean_sepa_description)
 
+    def test_0070_process_transactions(self):
+        bank_account = BankAccount.q.filter(
+            BankAccount.iban == BankAccountData.dummy.iban
+        ).one()
+        statement = [
+            MT940Transaction(None, {
+                'amount': Amount(amount, 'C'),
+                'applicant_iban': 'DE61810400000000000001',
+                'applicant_bin': None,
+                'applicant_name': 'Dummy',
+                'purpose': purpose,
+                'end_to_end_reference': None,
+                'entry_date': date(2019, 1, day),
+                'date': date(2019, 1, day),
+            })
+            for amount, purpose, day in [('9.00', 'Fee', 2),
+                                         ('9.00', 'Fee', 3),
+                                         ('4.50', 'Half fee', 3)]
+        ]
+
+        new, old = process_transactions(bank_account, statement)
+        self.assertEqual((len(new), len(old)), (3, 0))
+        session.session.add_all(new[:2])
+        session.session.flush()
+
+        new, old = process_transactions(bank_account, statement)
+        self.assertEqual([a.reference for a in new], ['Half fee'])
+        self.assertEqual([(a.amount, a.posted_on) for a in old],
+                         [(Decimal('9.00'), date(2019, 1, 2)),
+                          (Decimal('9.00'), date(2019, 1, 3))])
+
 
 # TODO: Rework tests for new membership fee implementation
 '''
@@ -405,3 +513,289 @@ class BalanceEstimationTestCase(FactoryDataTestBase):
         end_date = last_day_of_month(session.utcnow().date())
 
         self.assertEquals(0.00, estimate_balance(self.user, end_date))
+
+
+class PaymentInDefaultTestCase(FactoryDataTestBase):
+    def create_factories(self):
+        ConfigFactory.create(
+            payment_in_default_group__granted=frozenset(['payment_in_default']))
+        today = session.utcnow().date()
+        MembershipFeeFactory.create(begins_on=today - timedelta(days=365),
+                                    ends_on=today)
+
+        self.users = {}
+        for name, days_in_default in [('new', 20), ('terminate', 70),
+                                      ('grace', 5), ('paid', None),
+                                      ('recently_ended', 30)]:
+            user = UserFactory.create()
+            MembershipFactory.create(
+                user=user, group=config.member_group,
+                begins_at=session.utcnow() - timedelta(days=365))
+            if days_in_default is not None:
+                TransactionFactory.create(
+                    valid_on=today - timedelta(days=days_in_default),
+                    splits__account=Iterator(
+                        [user.account, config.membership_fee_account]))
+            self.users[name] = user
+
+        MembershipFactory.create(
+            user=self.users['terminate'], group=config.payment_in_default_group,
+            begins_at=session.utcnow() - timedelta(days=50))
+        MembershipFactory.create(
+            user=self.users['recently_ended'],
+            group=config.payment_in_default_group,
+            begins_at=session.utcnow() - timedelta(days=15),
+            ends_at=session.utcnow() - timedelta(days=2))
+
+    def test_users_with_payment_in_default(self):
+        users_pid_membership, users_membership_terminated = \
+            get_users_with_payment_in_default()
+        self.assertEqual(users_pid_membership, {self.users['new']})
+        self.assertEqual(users_membership_terminated,
+                         {self.users['terminate']})
+
+    def test_settled_balance_resets_days_in_default(self):
+        today = session.utcnow().date()
+        TransactionFactory.create(
+            valid_on=today - timedelta(days=10),
+            splits__account=Iterator(
+                [config.membership_fee_account, self.users['new'].account]))
+        TransactionFactory.create(
+            valid_on=today - timedelta(days=3),
+            splits__account=Iterator(
+                [self.users['new'].account, config.membership_fee_account]))
+        users_pid_membership, _ = get_users_with_payment_in_default()
+        self.assertEqual(users_pid_membership, set())
+        self.assertEqual(self.users['new'].account.in_default_days, 3)
+
+    def test_no_fee(self):
+        MembershipFee.q.delete()
+        with self.assertRaises(ValueError):
+            get_users_with_payment_in_default()
+
+    def test_take_actions(self):
+        processor = UserFactory.create()
+        new, terminate = self.users['new'], self.users['terminate']
+        actions = take_actions_for_payment_in_default_users(
+            # `terminate` already is in the payment in default group
+            users_pid_membership=[new, terminate],
+            # `processor` is not a member
+            users_membership_terminated=[terminate, processor],
+            processor=processor)
+        self.assertEqual(actions.added_to_pid_group, [new.id])
+        self.assertEqual(actions.moved_out, [terminate.id])
+        # Users must not be added twice
+        self.assertEqual(take_actions_for_payment_in_default_users(
+            [new], [], processor), ([], []))
+
+        self.assertTrue(new.member_of(config.payment_in_default_group))
+        self.assertTrue(new.member_of(config.member_group))
+        self.assertFalse(terminate.member_of(
+            config.member_group,
+            single(session.utcnow() + timedelta(seconds=1))))
+        self.assertIsNone(terminate.room)
+        self.assertFalse(terminate.hosts)
+        self.assertIn("Mitgliedschaftsende wegen Zahlungsrückstand.",
+                      [e.message for e in UserLogEntry.q.filter_by(
+                          user=terminate)])
+
+
+class MembershipFeePostingTestCase(FactoryDataTestBase):
+    def create_factories(self):
+        ConfigFactory.create()
+        self.fee = MembershipFeeFactory.create()
+        self.processor = UserFactory.create()
+        self.members = UserFactory.create_batch(2)
+        for user in self.members:
+            MembershipFactory.create(
+                user=user, group=config.member_group,
+                begins_at=session.utcnow() - timedelta(days=365))
+
+    def test_post_transactions(self):
+        expected = {(user.id, user.name) for user in self.members}
+        simulated = post_transactions_for_membership_fee(
+            self.fee, self.processor, simulate=True)
+        self.assertEqual({(u['id'], u['name']) for u in simulated}, expected)
+        self.assertEqual(Transaction.q.count(), 0)
+
+        posted = post_transactions_for_membership_fee(self.fee, self.processor)
+        self.assertEqual({(u['id'], u['name']) for u in posted}, expected)
+        session.session.expire_all()
+        for user in self.members:
+            self.assertEqual(user.account.balance, self.fee.regular_fee)
+            self.assertEqual(len(user.account.splits), 1)
+            transaction = user.account.splits[0].transaction
+            self.assertEqual(transaction.valid_on, self.fee.ends_on)
+            self.assertEqual(transaction.author, self.processor)
+            self.assertEqual({split.account for split in transaction.splits},
+                             {user.account, config.membership_fee_account})
+        self.assertEqual(config.membership_fee_account.balance,
+                         -2 * self.fee.regular_fee)
+        self.assertEqual(get_account_balance_discrepancies(), [])
+
+        # Fees are only posted once
+        self.assertEqual(post_transactions_for_membership_fee(
+            self.fee, self.processor), [])
+        # The deferred check of the splits must pass
+        session.session.flush()
+        session.session.execute("SET CONSTRAINTS ALL IMMEDIATE")
+
+    def test_post_transactions_updates_status(self):
+        user = self.members[0]
+        self.assertTrue(status(user).account_balanced)
+        post_transactions_for_membership_fee(self.fee, self.processor)
+        self.assertFalse(status(user).account_balanced)
+
+
+class ActivityMatchingTestCase(FactoryDataTestBase):
+    def create_factories(self):
+        self.bank_account = BankAccountFactory.create()
+        self.user = UserFactory.create(id=12345, name="Hans Wurst")
+        self.namesakes = UserFactory.create_batch(2, name="Doppel Name")
+
+    def create_activity(self, reference):
+        activity = BankAccountActivity(
+            bank_account=self.bank_account, amount=5, reference=reference,
+            other_account_number="", other_routing_number="", other_name="",
+            imported_at=session.utcnow(), posted_on=date(2019, 1, 1),
+            valid_on=date(2019, 1, 1))
+        session.session.add(activity)
+        return activity
+
+    def test_get_activity_matches(self):
+        user_id = encode_type2_user_id(self.user.id)
+        activities = {
+            'id': self.create_activity("Beitrag {}".format(user_id)),
+            'no_dash': self.create_activity(
+                "Beitrag {}".format(user_id.replace('-', ''))),
+            'spaces': self.create_activity(
+                "Beitrag 1 2 3 4 5 - {} {}".format(*user_id[-2:])),
+            'name': self.create_activity("gerok38/hans wurst"),
+            'ambiguous': self.create_activity("gerok38/Doppel Name"),
+            'unknown': self.create_activity("Miete"),
+        }
+        session.session.flush()
+        matches = get_activity_matches()
+        self.assertEqual({name for name, activity in activities.items()
+                          if activity in matches},
+                         {'id', 'no_dash', 'spaces', 'name', 'ambiguous'})
+        self.assertEqual(matches[activities['id']],
+                         (self.user, MATCH_CONFIDENCE_USER_ID))
+        self.assertEqual(matches[activities['no_dash']],
+                         (self.user, MATCH_CONFIDENCE_USER_ID_WITHOUT_DASH))
+        self.assertEqual(matches[activities['spaces']],
+                         (self.user, MATCH_CONFIDENCE_USER_ID_WITHOUT_SPACES))
+        self.assertEqual(matches[activities['name']],
+                         (self.user, MATCH_CONFIDENCE_NAME))
+        self.assertEqual(matches[activities['ambiguous']],
+                         (self.namesakes[0], MATCH_CONFIDENCE_AMBIGUOUS_NAME))
+        self.assertEqual(match_activities()[activities['id']], self.user)
+
+
+@unittest.skipUnless(os.environ.get('PYCROFT_BENCHMARK'),
+                     "set PYCROFT_BENCHMARK to run benchmarks")
+class BankAccountCSVImportBenchmark(FixtureDataTestBase):
+    datasets = [AccountData, BankAccountData]
+    row_count = int(os.environ.get('PYCROFT_BENCHMARK_CSV_ROWS', 30000))
+
+    def generate_csv(self):
+        yield ('"Auftragskonto";"Buchungstag";"Valutadatum";"Buchungstext";'
+               '"Verwendungszweck";"Beguenstigter/Zahlungspflichtiger";'
+               '"Kontonummer";"BLZ";"Betrag";"Waehrung";"Info"\n')
+        last_day = date(2019, 12, 31)
+        for i in range(self.row_count):
+            day = (last_day - timedelta(days=i * 365 // self.row_count))
+            yield ('"{account}";"{day:%d.%m.%y}";"{day:%d.%m.%y}";'
+                   '"UEBERWEISUNGSGUTSCHRIFT";"Beitrag {i}";"Mitglied {i}";'
+                   '"{i:010d}";"85050300";"{amount},00";"EUR";'
+                   '"Umsatz gebucht"\n'
+                   .format(account=BankAccountData.dummy.account_number,
+                           day=day, i=i, amount=i % 10))
+
+    def test_import_bank_account_activities_csv(self):
+        expected_balance = Decimal(sum(i % 10 for i in range(self.row_count)))
+        for run in ("initial", "repeated"):
+            start = time_.perf_counter()
+            import_bank_account_activities_csv(
+                StringIO(''.join(self.generate_csv())), expected_balance)
+            elapsed = time_.perf_counter() - start
+            print("{} import of {} CSV rows: {:.2f}s"
+                  .format(run, self.row_count, elapsed))
+        self.assertEqual(BankAccountActivity.q.count(), self.row_count)
+
+
+def create_members_with_unpaid_fees(count, group, fee_account):
+    """Bulk-insert members who owe a fee booked up to 90 days ago.
+
+    This is much faster than the factories and thus suited for creating
+    benchmark data.
+    """
+    session.session.execute(text("""
+        WITH numbered AS (
+          SELECT i, nextval('account_id_seq') AS account_id,
+                    nextval('transaction_id_seq') AS transaction_id
+          FROM generate_series(1, :count) i
+        ), accounts AS (
+          INSERT INTO account (id, name, type, legacy)
+          SELECT account_id, 'Benchmark ' || i, 'USER_ASSET', false
+          FROM numbered
+        ), users AS (
+          INSERT INTO "user" (login, name, registered_at, account_id)
+          SELECT 'benchmark' || i, 'Benchmark ' || i,
+                 current_timestamp - interval '1 year', account_id
+          FROM numbered
+          RETURNING id
+        ), memberships AS (
+          INSERT INTO membership (begins_at, group_id, user_id)
+          SELECT current_timestamp - interval '1 year', :group_id, id
+          FROM users
+        ), transactions AS (
+          INSERT INTO "transaction" (id, description, valid_on, confirmed)
+          SELECT transaction_id, 'Benchmark fee', current_date - i % 90, true
+          FROM numbered
+        )
+        INSERT INTO split (amount, account_id, transaction_id)
+        SELECT 500, account_id, transaction_id FROM numbered
+        UNION ALL
+        SELECT -500, :fee_account_id, transaction_id FROM numbered
+    """), {'count': count, 'group_id': group.id,
+           'fee_account_id': fee_account.id})
+
+
+@unittest.skipUnless(os.environ.get('PYCROFT_BENCHMARK'),
+                     "set PYCROFT_BENCHMARK to run benchmarks")
+class PaymentInDefaultBenchmark(FactoryDataTestBase):
+    user_count = int(os.environ.get('PYCROFT_BENCHMARK_USERS', 10000))
+
+    def create_factories(self):
+        ConfigFactory.create()
+        today = session.utcnow().date()
+        MembershipFeeFactory.create(begins_on=today - timedelta(days=365),
+                                    ends_on=today)
+        create_members_with_unpaid_fees(self.user_count, config.member_group,
+                                        config.membership_fee_account)
+
+    def test_post_transactions_for_membership_fee(self):
+        next_month = last_day_of_month(session.utcnow().date()) + timedelta(1)
+        fee = MembershipFeeFactory.create(
+            begins_on=next_month, ends_on=last_day_of_month(next_month))
+        start = time_.perf_counter()
+        affected_users = post_transactions_for_membership_fee(
+            fee, User.q.first())
+        session.session.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        elapsed = time_.perf_counter() - start
+        print("post_transactions_for_membership_fee() for {} users: {:.2f}s"
+              .format(self.user_count, elapsed))
+        self.assertEqual(len(affected_users), self.user_count)
+
+    def test_get_users_with_payment_in_default(self):
+        start = time_.perf_counter()
+        users_pid_membership, users_membership_terminated = \
+            get_users_with_payment_in_default()
+        elapsed = time_.perf_counter() - start
+        print("get_users_with_payment_in_default() for {} users: {:.2f}s"
+              .format(self.user_count, elapsed))
+        # Fees are booked 0 to 89 days ago, the deadlines are 14 and 62 days
+        self.assertEqual(
+            len(users_pid_membership) + len(users_membership_terminated),
+            sum(1 for i in range(1, self.user_count + 1) if i % 90 >= 14))
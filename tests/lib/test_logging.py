@@ -3,10 +3,11 @@
 # the Apache License, Version 2.0. See the LICENSE file for details.
 from datetime import timedelta
 
-from pycroft.lib.logging import log_user_event, log_room_event
+from pycroft.lib.logging import log_user_event, log_user_events, \
+    log_room_event
 from pycroft.model import session
 from pycroft.model.facilities import Room
-from pycroft.model.logging import RoomLogEntry, LogEntry
+from pycroft.model.logging import RoomLogEntry, LogEntry, UserLogEntry
 from pycroft.model.user import User
 from tests import FixtureDataTestBase
 from tests.fixtures.dummy.facilities import RoomData
@@ -41,6 +42,21 @@ class Test_010_UserLogEntry(LogTestBase):
         session.session.commit()
         self.assertIsNone(LogEntry.q.get(user_log_entry.id))
 
+    def test_0020_create_user_log_entries(self):
+        messages = ["first message", "second message"]
+        count = log_user_events(((self.user.id, m) for m in messages),
+                                author=self.user)
+        self.assertEqual(count, 2)
+        entries = UserLogEntry.q.filter(
+            UserLogEntry.message.in_(messages)
+        ).order_by(UserLogEntry.id).all()
+        self.assertEqual([e.message for e in entries], messages)
+        for entry in entries:
+            self.assertEqual(entry.user, self.user)
+            self.assertEqual(entry.author, self.user)
+            self.assertAlmostEqual(entry.created_at, session.utcnow(),
+                                   delta=timedelta(seconds=5))
+
 class Test_020_RoomLogEntry(LogTestBase):
     datasets = [RoomData, RoomLogEntryData]
 
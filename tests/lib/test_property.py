@@ -3,12 +3,16 @@
 # the Apache License, Version 2.0. See the LICENSE file for details.
 from datetime import timedelta
 
-from pycroft.helpers.interval import IntervalSet ,UnboundedInterval, closed
+from pycroft.helpers.interval import IntervalSet ,UnboundedInterval, closed, \
+    single
 from pycroft.lib.membership import grant_property, deny_property, \
-    remove_property, make_member_of, remove_member_of
+    remove_property, make_member_of, remove_member_of, make_members_of, \
+    remove_members_of, evaluate_properties, property_pivot
 from pycroft.model.user import Membership, Property, PropertyGroup, User
 from pycroft.model import session
-from tests import FixtureDataTestBase
+from tests import FactoryDataTestBase, FixtureDataTestBase
+from tests.factories import MembershipFactory, PropertyGroupFactory, \
+    UserFactory
 from tests.fixtures.dummy.property import PropertyGroupData, PropertyData
 from tests.fixtures.dummy.user import UserData
 
@@ -85,6 +89,28 @@ class Test_030_Membership(FixtureDataTestBase):
         self.assertMembershipIntervalsEqual(IntervalSet(
             (closed(t0, t1), closed(t4, t5))))
 
+    def test_bulk_adding_joins_memberships(self):
+        t0 = session.utcnow()
+        t1 = t0 + timedelta(hours=1)
+        t2 = t0 + timedelta(hours=2)
+        self.add_membership(closed(t0, t2))
+        make_members_of([self.user], self.group, self.processor, t1)
+        session.session.commit()
+        self.assertMembershipIntervalsEqual(IntervalSet(closed(t0, None)))
+
+    def test_bulk_removing_memberships(self):
+        t0 = session.utcnow()
+        t1 = t0 + timedelta(hours=1)
+        t2 = t0 + timedelta(hours=2)
+        self.add_membership(closed(t0, None))
+        self.assertEqual(remove_members_of([self.user], [self.group],
+                                           self.processor, t1), 1)
+        session.session.commit()
+        self.assertMembershipIntervalsEqual(IntervalSet(closed(t0, t1)))
+        # There is no active membership at t2 anymore
+        self.assertEqual(remove_members_of([self.user], [self.group],
+                                           self.processor, t2), 0)
+
 
 class Test_040_Property(FixtureDataTestBase):
     datasets = [PropertyGroupData, PropertyData]
@@ -134,3 +160,92 @@ class Test_040_Property(FixtureDataTestBase):
     def test_0035_remove_wrong_property(self):
         self.assertRaises(ValueError, remove_property, self.group,
                           "non_existent_property")
+
+
+class EvaluatePropertiesTest(FactoryDataTestBase):
+    def create_factories(self):
+        self.now = session.utcnow()
+        self.users = UserFactory.create_batch(3)
+        granting = PropertyGroupFactory(granted={'network_access', 'ldap'})
+        denying = PropertyGroupFactory(denied={'network_access'})
+        for user in self.users[:2]:
+            MembershipFactory(user=user, group=granting,
+                              begins_at=self.now - timedelta(days=1))
+        MembershipFactory(user=self.users[1], group=denying,
+                          begins_at=self.now - timedelta(days=1),
+                          ends_at=self.now - timedelta(hours=1))
+
+    def evaluate(self, when=None):
+        return evaluate_properties([u.id for u in self.users],
+                                   ['network_access', 'ldap', 'violation'],
+                                   when)
+
+    def test_evaluate_properties(self):
+        first, second, third = self.users
+        self.assertEqual(self.evaluate(), {
+            first.id: {'network_access', 'ldap'},
+            second.id: {'network_access', 'ldap'},
+            third.id: frozenset(),
+        })
+
+    def test_denied_property(self):
+        second = self.users[1]
+        properties = self.evaluate(single(self.now - timedelta(hours=2)))
+        self.assertEqual(properties[second.id], {'ldap'})
+
+    def test_matches_has_property(self):
+        when = single(self.now - timedelta(hours=2))
+        for user_id, properties in self.evaluate(when).items():
+            user = User.q.get(user_id)
+            for name in ('network_access', 'ldap', 'violation'):
+                self.assertEqual(name in properties,
+                                 user.has_property(name, when))
+
+    def test_no_users(self):
+        self.assertEqual(evaluate_properties([], ['network_access']), {})
+
+
+class PropertyPivotTest(FactoryDataTestBase):
+    names = ['network_access', 'ldap', 'violation']
+
+    def create_factories(self):
+        self.now = session.utcnow()
+        self.users = UserFactory.create_batch(3)
+        self.granting = PropertyGroupFactory(
+            granted={'network_access', 'ldap'})
+        denying = PropertyGroupFactory(granted={'violation'},
+                                       denied={'network_access'})
+        for user in self.users[:2]:
+            MembershipFactory(user=user, group=self.granting,
+                              begins_at=self.now - timedelta(days=1))
+        MembershipFactory(user=self.users[1], group=denying,
+                          begins_at=self.now - timedelta(days=1))
+
+    def pivot(self, when=None):
+        pivot = property_pivot(self.names, when,
+                               groups={'granting': self.granting})
+        return {row.user_id: row for row in session.session.execute(
+            pivot.select().where(
+                pivot.c.user_id.in_(u.id for u in self.users)))}
+
+    def test_matches_evaluate_properties(self):
+        rows = self.pivot()
+        for user_id, properties in evaluate_properties(
+                [u.id for u in self.users], self.names).items():
+            if not properties:
+                self.assertNotIn(user_id, rows)
+                continue
+            for name in self.names:
+                self.assertEqual(rows[user_id][name], name in properties)
+
+    def test_group_columns(self):
+        first, second, third = self.users
+        rows = self.pivot()
+        self.assertEqual(set(rows), {first.id, second.id})
+        self.assertTrue(rows[first.id].granting)
+        self.assertTrue(rows[second.id].granting)
+        self.assertFalse(rows[second.id].network_access)
+        self.assertTrue(rows[second.id].violation)
+
+    def test_no_active_memberships(self):
+        self.assertEqual(self.pivot(single(self.now - timedelta(days=2))), {})
@@ -1 +1,419 @@
+import os
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, select
+
+from pycroft import config
+from pycroft.helpers.interval import single
+from pycroft.lib.traffic import apply_traffic_limit, buildings_traffic_series, \
+    create_traffic_partitions, delete_old_traffic_data, \
+    drop_old_traffic_partitions, get_ip_traffic, \
+    get_users_with_highest_traffic, \
+    ingest_pmacct_traffic, refresh_traffic_leaderboards, \
+    subnets_traffic_series, traffic_retention_limit, \
+    user_traffic_series, users_traffic_series, TrafficSeries
+from pycroft.lib.user import traffic_history
+from pycroft.model import session
+from pycroft.model.traffic import TrafficDailyUser, TrafficLeaderboard, \
+    TrafficVolume, pmacct_traffic_egress
+from pycroft.model.logging import UserLogEntry
+from pycroft.model.user import Membership, User
+from tests import FactoryDataTestBase
+from tests.factories import ConfigFactory, MembershipFactory, UserFactory, \
+    UserWithHostFactory
+
 # TODO: Tests for traffic history
+
+
+class IngestPMAcctTrafficTest(FactoryDataTestBase):
+    ip = '141.30.228.39'
+
+    def create_factories(self):
+        self.user = UserWithHostFactory(host__interface__ip__str_address=self.ip)
+
+    def test_ingest(self):
+        day = datetime(2018, 3, 15, tzinfo=timezone.utc)
+        records = [('Egress', self.ip, day + timedelta(hours=h), 100, 1)
+                   for h in range(24)]
+        records += [('Ingress', self.ip, day, 1000, 10),
+                    ('Ingress', '1.1.1.1', day, 1000, 10)]
+        self.assertEqual(ingest_pmacct_traffic(records), 2)
+        volumes = {v.type: (v.amount, v.packets, v.user)
+                   for v in TrafficVolume.q}
+        self.assertEqual(volumes, {'Egress': (2400, 24, self.user),
+                                   'Ingress': (1000, 10, self.user)})
+
+    def test_invalid_direction(self):
+        with self.assertRaises(ValueError):
+            ingest_pmacct_traffic([('Sideways', self.ip, datetime.now(), 1, 1)])
+
+
+class TrafficForDaysTest(FactoryDataTestBase):
+    ip = '141.30.228.39'
+    other_ip = '141.30.228.40'
+
+    def create_factories(self):
+        self.user = UserWithHostFactory(host__interface__ip__str_address=self.ip)
+        self.other_user = UserWithHostFactory(
+            host__interface__ip__str_address=self.other_ip)
+
+    def setUp(self):
+        super().setUp()
+        now = session.utcnow()
+        ingest_pmacct_traffic([
+            ('Egress', self.ip, now, 100, 1),
+            ('Ingress', self.ip, now - timedelta(days=2), 1000, 1),
+            ('Ingress', self.ip, now - timedelta(days=10), 100000, 1),
+            ('Egress', self.other_ip, now, 10, 1),
+        ])
+
+    def test_traffic_for_days(self):
+        self.assertEqual(self.user.traffic_for_days(7), 1100)
+        self.assertEqual(self.user.traffic_for_days(1), 100)
+        self.assertEqual(self.user.traffic_for_days(30), 101100)
+
+    def test_traffic_for_days_expression(self):
+        self.assertEqual(
+            session.session.query(User.traffic_for_days(7))
+            .filter(User.id == self.other_user.id).scalar(), 10)
+
+    def test_traffic_history(self):
+        now = session.utcnow()
+        history = traffic_history(self.user.id, now - timedelta(days=3), now)
+        self.assertEqual([(e.ingress, e.egress) for e in history],
+                         [(None, None), (1000, None), (None, None),
+                          (None, 100)])
+        self.assertEqual(history[-1].timestamp.date(), now.date())
+
+    def test_users_with_highest_traffic(self):
+        self.assertEqual(
+            [(u.id, u.traffic_for_days)
+             for u in get_users_with_highest_traffic(7, 20)],
+            [(self.user.id, 1100), (self.other_user.id, 10)])
+        self.assertEqual(
+            [u.id for u in get_users_with_highest_traffic(7, 1)],
+            [self.user.id])
+
+    def test_traffic_leaderboards(self):
+        self.assertEqual(refresh_traffic_leaderboards(), 6)
+        self.assertEqual(
+            [(entry.days, entry.rank, entry.user, entry.amount)
+             for entry in TrafficLeaderboard.q.order_by(
+                TrafficLeaderboard.days, TrafficLeaderboard.rank)],
+            [(1, 1, self.user, 100), (1, 2, self.other_user, 10),
+             (7, 1, self.user, 1100), (7, 2, self.other_user, 10),
+             (30, 1, self.user, 101100), (30, 2, self.other_user, 10)])
+        # the leaderboard is read instead of the rollup
+        session.session.execute(TrafficDailyUser.__table__.delete())
+        self.assertEqual(
+            [(u.id, u.name, u.traffic_for_days)
+             for u in get_users_with_highest_traffic(7, 1)],
+            [(self.user.id, self.user.name, 1100)])
+        self.assertEqual(refresh_traffic_leaderboards(), 0)
+        self.assertEqual(get_users_with_highest_traffic(7, 20), [])
+
+    def test_stale_traffic_leaderboard(self):
+        refresh_traffic_leaderboards()
+        session.session.execute(
+            TrafficLeaderboard.__table__.update().values(
+                refreshed_at=session.utcnow() - timedelta(hours=1)))
+        session.session.execute(
+            TrafficDailyUser.__table__.delete()
+            .where(TrafficDailyUser.user_id == self.user.id))
+        # the stale leaderboard is ignored in favour of the rollup
+        self.assertEqual(
+            [(u.id, u.traffic_for_days)
+             for u in get_users_with_highest_traffic(7, 1)],
+            [(self.other_user.id, 10)])
+
+
+class TrafficLimitTest(FactoryDataTestBase):
+    ips = ['141.30.228.39', '141.30.228.40', '141.30.228.41']
+
+    def create_factories(self):
+        ConfigFactory.create()
+        self.processor = UserFactory.create()
+        self.users = [UserWithHostFactory(host__interface__ip__str_address=ip)
+                      for ip in self.ips]
+
+    def setUp(self):
+        super().setUp()
+        self.heavy, self.recovered, self.light = self.users
+        now = session.utcnow()
+        MembershipFactory.create(
+            user=self.recovered, group=config.traffic_limit_exceeded_group,
+            begins_at=now - timedelta(days=3))
+        ingest_pmacct_traffic([
+            ('Egress', self.ips[0], now, 800, 1),
+            ('Ingress', self.ips[0], now - timedelta(days=6), 800, 1),
+            ('Ingress', self.ips[1], now - timedelta(days=7), 2000, 1),
+            ('Egress', self.ips[2], now, 1000, 1),
+        ])
+
+    def members(self):
+        when = single(session.utcnow() + timedelta(seconds=1))
+        return {user for user in self.users
+                if user.member_of(config.traffic_limit_exceeded_group, when)}
+
+    def test_apply_traffic_limit(self):
+        actions = apply_traffic_limit(1000, days=7, processor=self.processor)
+        self.assertEqual(actions, (
+            [self.heavy.id], [self.recovered.id]
+        ))
+        self.assertEqual(self.members(), {self.heavy})
+
+        actions = apply_traffic_limit(1000, days=7, processor=self.processor)
+        self.assertEqual(actions, ([], []))
+        self.assertEqual(self.members(), {self.heavy})
+        for user, message in ((self.heavy, "exceeded."),
+                              (self.recovered, "no longer exceeded")):
+            messages = [e.message for e in UserLogEntry.q.filter_by(
+                user=user, author=self.processor)]
+            self.assertEqual(len(messages), 2)
+            self.assertEqual(sum(message in m for m in messages), 1)
+
+    def test_membership_without_begin(self):
+        membership = MembershipFactory.create(
+            user=self.heavy, group=config.traffic_limit_exceeded_group)
+        session.session.flush()
+        session.session.execute(
+            Membership.__table__.update()
+            .where(Membership.id == membership.id).values(begins_at=None))
+        actions = apply_traffic_limit(1000, days=7, processor=self.processor)
+        self.assertEqual(actions, ([], [self.recovered.id]))
+        self.assertEqual(self.members(), {self.heavy})
+
+
+class TrafficSeriesTest(FactoryDataTestBase):
+    ip = '141.30.228.39'
+    other_ip = '141.30.228.40'
+
+    def create_factories(self):
+        self.user = UserWithHostFactory(host__interface__ip__str_address=self.ip)
+        self.other_user = UserWithHostFactory(
+            host__interface__ip__str_address=self.other_ip,
+            room=self.user.room)
+
+    def setUp(self):
+        super().setUp()
+        self.now = session.utcnow()
+        self.start = self.now - timedelta(days=2)
+        ingest_pmacct_traffic([
+            ('Egress', self.ip, self.now, 100, 1),
+            ('Ingress', self.ip, self.now - timedelta(days=2), 1000, 1),
+            ('Ingress', self.ip, self.now - timedelta(days=10), 100000, 1),
+            ('Egress', self.other_ip, self.now, 10, 1),
+        ])
+
+    def assert_series(self, series, ingress, egress):
+        self.assertEqual([t.date() for t in series.timestamps],
+                         [(self.start + timedelta(days=d)).date()
+                          for d in range(3)])
+        self.assertEqual(series.ingress, ingress)
+        self.assertEqual(series.egress, egress)
+
+    def test_user_traffic_series(self):
+        self.assert_series(
+            user_traffic_series(self.user.id, self.start, self.now),
+            [1000, 0, 0], [0, 0, 100])
+
+    def test_empty_user_traffic_series(self):
+        empty = TrafficSeries([], [], [])
+        self.assertEqual(user_traffic_series(self.user.id, self.now,
+                                             self.start), empty)
+        unknown_id = max(self.user.id, self.other_user.id) + 1
+        self.assertEqual(user_traffic_series(unknown_id, self.start, self.now),
+                         empty)
+
+    def test_users_traffic_series(self):
+        series = dict(users_traffic_series(
+            [self.user.id, self.other_user.id], self.start, self.now))
+        self.assertEqual(set(series), {self.user.id, self.other_user.id})
+        self.assert_series(series[self.other_user.id], [0, 0, 0], [0, 0, 10])
+
+    def test_buildings_traffic_series(self):
+        building = self.user.room.building
+        (building_id, series), = buildings_traffic_series(
+            [building.id], self.start, self.now)
+        self.assertEqual(building_id, building.id)
+        self.assert_series(series, [1000, 0, 0], [0, 0, 110])
+
+    def test_subnets_traffic_series(self):
+        subnet = self.user.hosts[0].interfaces[0].ips[0].subnet
+        series = dict(subnets_traffic_series([subnet.id], self.start,
+                                             self.now))
+        self.assert_series(series[subnet.id], [1000, 0, 0], [0, 0, 100])
+
+
+class IPTrafficTest(FactoryDataTestBase):
+    ip = '141.30.228.39'
+
+    def create_factories(self):
+        self.user = UserWithHostFactory(host__interface__ip__str_address=self.ip)
+        self.other_user = UserWithHostFactory(
+            host__interface__ip__str_address='141.30.228.40')
+
+    def test_ip_traffic(self):
+        now = session.utcnow()
+        ingest_pmacct_traffic([
+            ('Egress', self.ip, now, 100, 1),
+            ('Egress', self.ip, now - timedelta(days=1), 10, 1),
+            ('Ingress', self.ip, now - timedelta(days=10), 1000, 1),
+            ('Egress', '141.30.228.40', now, 1, 1),
+        ])
+        interface = self.user.hosts[0].interfaces[0]
+        row, = get_ip_traffic(self.user.id, now - timedelta(days=1), now)
+        self.assertEqual(
+            (row.host_id, row.interface_id, row.ip_id, str(row.address)),
+            (interface.host.id, interface.id, interface.ips[0].id, self.ip))
+        self.assertEqual((row.ingress, row.egress), (0, 110))
+
+    def test_no_traffic(self):
+        now = session.utcnow()
+        row, = get_ip_traffic(self.user.id, now, now)
+        self.assertEqual((row.ingress, row.egress), (0, 0))
+
+
+class TrafficRetentionTest(FactoryDataTestBase):
+    ip = '141.30.228.39'
+
+    def create_factories(self):
+        self.user = UserWithHostFactory(host__interface__ip__str_address=self.ip)
+
+    def test_create_partitions(self):
+        self.assertEqual(create_traffic_partitions(days_ahead=3), 4)
+        self.assertEqual(create_traffic_partitions(days_ahead=3), 0)
+
+    def test_drop_old_traffic_data(self):
+        now = session.utcnow()
+        ingest_pmacct_traffic([('Egress', self.ip, now - timedelta(days=d), 1, 1)
+                               for d in list(range(10)) + [30]])
+        session.session.execute(select([func.traffic_volume_create_partitions(
+            (now - timedelta(days=9)).date(), now.date())]))
+        self.assertEqual(TrafficVolume.q.count(), 11)
+
+        before = traffic_retention_limit(keep_days=7)
+        self.assertEqual(before, (now - timedelta(days=6)).date())
+        self.assertEqual(drop_old_traffic_partitions(before), 3)
+        self.assertEqual(TrafficVolume.q.count(), 8)
+        self.assertEqual(TrafficDailyUser.q.count(), 11)
+
+        # the rollup outlives the raw data
+        self.assertEqual(delete_old_traffic_data(before, batch_size=2), 1)
+        self.assertEqual(TrafficVolume.q.count(), 7)
+        self.assertEqual(delete_old_traffic_data(before, batch_size=2), 0)
+        self.assertEqual(TrafficDailyUser.q.count(), 11)
+
+        rollup_before = traffic_retention_limit(keep_days=30)
+        self.assertEqual(
+            delete_old_traffic_data(before, rollup_before, batch_size=2), 1)
+        self.assertEqual(
+            delete_old_traffic_data(before, rollup_before, batch_size=2), 0)
+        self.assertEqual(TrafficDailyUser.q.count(), 10)
+        self.assertEqual(self.user.traffic_for_days(30), 10)
+
+
+@unittest.skipUnless(os.environ.get('PYCROFT_BENCHMARK'),
+                     "set PYCROFT_BENCHMARK to run benchmarks")
+class IngestPMAcctTrafficBenchmark(FactoryDataTestBase):
+    ip = '141.30.228.39'
+    record_count = int(os.environ.get('PYCROFT_BENCHMARK_TRAFFIC_ROWS', 20000))
+
+    def create_factories(self):
+        UserWithHostFactory(host__interface__ip__str_address=self.ip)
+
+    def records(self):
+        start = datetime(2018, 3, 15, tzinfo=timezone.utc)
+        for i in range(self.record_count):
+            yield ('Egress', self.ip, start + timedelta(minutes=i), 100, 1)
+
+    def test_ingest_compared_to_view(self):
+        start = time.perf_counter()
+        session.session.execute(pmacct_traffic_egress.table.insert(), [
+            {'ip_src': ip, 'stamp_inserted': stamp, 'stamp_updated': stamp,
+             'bytes': bytes_, 'packets': packets}
+            for _, ip, stamp, bytes_, packets in self.records()
+        ])
+        view_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ingest_pmacct_traffic(self.records())
+        staging_elapsed = time.perf_counter() - start
+        print("{} pmacct records: {:.2f}s through the view, "
+              "{:.2f}s through the staging table"
+              .format(self.record_count, view_elapsed, staging_elapsed))
+        self.assertEqual(sum(v.amount for v in TrafficVolume.q),
+                         2 * 100 * self.record_count)
+
+
+@unittest.skipUnless(os.environ.get('PYCROFT_BENCHMARK'),
+                     "set PYCROFT_BENCHMARK to run benchmarks")
+class TrafficHistoryBenchmark(FactoryDataTestBase):
+    user_count = int(os.environ.get('PYCROFT_BENCHMARK_USERS', 100))
+    day_count = int(os.environ.get('PYCROFT_BENCHMARK_TRAFFIC_DAYS', 730))
+
+    # `traffic_history()` as it used to be, joining on the truncated
+    # timestamps of `traffic_volume`
+    date_trunc_function = """
+        CREATE FUNCTION pg_temp.traffic_history_date_trunc(arg_user_id integer, arg_start timestamptz, arg_end timestamptz)
+         RETURNS TABLE("timestamp" timestamptz, ingress numeric, egress numeric)
+         LANGUAGE sql STABLE
+        AS $$
+        WITH anon_3 AS
+        (SELECT sum(traffic_volume.amount) AS amount, day, CAST(traffic_volume.type AS TEXT) AS type
+        FROM generate_series(date_trunc('day', arg_start), date_trunc('day', arg_end), '1 day') AS day LEFT OUTER JOIN traffic_volume ON date_trunc('day', traffic_volume.timestamp) = day AND traffic_volume.user_id = arg_user_id GROUP BY day, type),
+        anon_1 AS
+        (SELECT anon_3.amount AS amount, anon_3.day, anon_3.type AS type
+        FROM anon_3
+        WHERE anon_3.type = 'Ingress' OR anon_3.type IS NULL),
+        anon_2 AS
+        (SELECT anon_3.amount AS amount, anon_3.day, anon_3.type AS type
+        FROM anon_3
+        WHERE anon_3.type = 'Egress' OR anon_3.type IS NULL)
+         SELECT coalesce(anon_1.day, anon_2.day) AS timestamp, anon_1.amount AS ingress, anon_2.amount AS egress
+        FROM anon_1 FULL OUTER JOIN anon_2 ON anon_1.day = anon_2.day ORDER BY timestamp
+        $$
+    """
+
+    def create_factories(self):
+        self.users = UserWithHostFactory.create_batch(self.user_count)
+
+    def setUp(self):
+        super().setUp()
+        session.session.execute("""
+            INSERT INTO traffic_volume (type, ip_id, "timestamp", amount, packets, user_id)
+            SELECT type, ip.id, date_trunc('day', now()) - day * interval '1 day',
+                   (random() * 1e9)::bigint, 1000, host.owner_id
+            FROM ip
+            JOIN interface ON ip.interface_id = interface.id
+            JOIN host ON interface.host_id = host.id,
+            generate_series(0, :days - 1) AS day,
+            unnest(ARRAY['Ingress', 'Egress']::traffic_direction[]) AS type
+        """, {'days': self.day_count})
+        session.session.execute(self.date_trunc_function)
+        session.session.execute("ANALYZE traffic_volume")
+        session.session.execute("ANALYZE traffic_daily_user")
+
+    def run_histories(self, function):
+        now = session.utcnow()
+        results = []
+        start = time.perf_counter()
+        for user in self.users:
+            results.append(session.session.execute(
+                "SELECT * FROM {}(:user_id, :start, :end)".format(function),
+                {'user_id': user.id, 'start': now - timedelta(days=30),
+                 'end': now}
+            ).fetchall())
+        return time.perf_counter() - start, results
+
+    def test_traffic_history_compared_to_date_trunc_join(self):
+        old_elapsed, old_results = self.run_histories(
+            'pg_temp.traffic_history_date_trunc')
+        new_elapsed, new_results = self.run_histories('traffic_history')
+        print("30 day traffic history of {} users with {} days of traffic: "
+              "{:.2f}s joining on date_trunc, {:.2f}s with the rollup"
+              .format(self.user_count, self.day_count, old_elapsed,
+                      new_elapsed))
+        self.assertEqual(new_results, old_results)
@@ -7,10 +7,12 @@ from datetime import timedelta
 from pycroft import config
 from pycroft.helpers.interval import closedopen
 from pycroft.lib import user as UserHelper
+from pycroft.lib.membership import make_members_of
 from pycroft.model import (
     user, facilities, session, host)
 from pycroft.model.port import PatchPort
-from tests import FixtureDataTestBase
+from tests import FactoryDataTestBase, FixtureDataTestBase
+from tests.factories import ConfigFactory, MembershipFactory, UserFactory
 from tests.fixtures import network_access
 from tests.fixtures.config import ConfigData, PropertyData
 from tests.fixtures.dummy.facilities import BuildingData, RoomData
@@ -204,6 +206,38 @@ class Test_030_User_Move_Out_And_Back_In(FixtureDataTestBase):
         self.assertTrue(new_user.member_of(config.member_group))
         self.assertTrue(new_user.member_of(config.network_access_group))
 
+    def test_0040_move_out_users(self):
+        test_building = facilities.Building.q.first()
+        new_users = []
+        for i, mac in enumerate(["12:11:11:11:11:12", "12:11:11:11:11:13"]):
+            new_user, _ = UserHelper.create_user(
+                u"Hans", u"hans{}".format(i), u"hans{}@hans.de".format(i),
+                "1990-01-01", processor=self.processing_user,
+                groups=[config.member_group])
+            UserHelper.move_in(new_user, building_id=test_building.id,
+                               level=1, room_number="1", mac=mac,
+                               processor=self.processing_user)
+            new_users.append(new_user)
+        session.session.commit()
+
+        out_time = session.utcnow()
+        self.assertEqual(UserHelper.move_out_users(
+            new_users, comment="Bulk", processor=self.processing_user,
+            when=out_time), 2)
+        session.session.commit()
+
+        for new_user, mac in zip(new_users, ["12:11:11:11:11:12",
+                                             "12:11:11:11:11:13"]):
+            for membership in new_user.memberships:
+                self.assertIsNotNone(membership.ends_at)
+                self.assertLessEqual(membership.ends_at, out_time)
+            self.assertFalse(new_user.hosts)
+            self.assertIsNone(new_user.room)
+            self.assertIsNone(new_user.birthdate)
+            self.assertTrue(any(
+                mac in entry.message and "Comment: Bulk" in entry.message
+                for entry in new_user.log_entries))
+
 
 class Test_040_User_Edit_Name(FixtureDataTestBase):
     datasets = (ConfigData, BuildingData, RoomData, UserData)
@@ -281,3 +315,53 @@ class UserWithNetworkAccessTestCase(FixtureDataTestBase):
 
         self.assertEqual(unblocked_user.log_entries[0].author, unblocked_user)
         self.assert_violation_membership(unblocked_user, subinterval=blocked_during)
+
+
+class StatusQueryTest(FactoryDataTestBase):
+    def create_factories(self):
+        self.config = ConfigFactory()
+        self.member, self.other = UserFactory.create_batch(2)
+        MembershipFactory(user=self.member, group=self.config.member_group)
+
+    def test_status_query_matches_status(self):
+        rows = {row.User: row for row in UserHelper.status_query().filter(
+            user.User.id.in_([self.member.id, self.other.id]))}
+        self.assertEqual(set(rows), {self.member, self.other})
+        for row_user, row in rows.items():
+            status = UserHelper.status(row_user)
+            for column in UserHelper.UserStatus._fields:
+                self.assertEqual(getattr(row, column), getattr(status, column),
+                                 column)
+        self.assertTrue(rows[self.member].member)
+        self.assertTrue(rows[self.member].network_access)
+        self.assertFalse(rows[self.other].member)
+        self.assertFalse(rows[self.other].traffic_exceeded)
+
+    def test_status_is_cached(self):
+        status = UserHelper.status(self.other)
+        self.assertIs(UserHelper.status(self.other), status)
+        self.assertFalse(status.member)
+
+    def test_status_invalidated_by_membership(self):
+        self.assertFalse(UserHelper.status(self.other).member)
+        MembershipFactory(user=self.other, group=self.config.member_group)
+        session.session.flush()
+        status = UserHelper.status(self.other)
+        self.assertTrue(status.member)
+        self.assertTrue(status.network_access)
+
+    def test_status_sees_pending_changes(self):
+        self.assertFalse(UserHelper.status(self.other).wifi_access)
+        self.other.wifi_passwd_hash = '{CRYPT}unusable'
+        self.assertTrue(UserHelper.status(self.other).wifi_access)
+        self.assertFalse(UserHelper.status(self.other).member)
+        session.session.add(user.Membership(
+            user=self.other, group=self.config.member_group,
+            begins_at=session.utcnow()))
+        self.assertTrue(UserHelper.status(self.other).member)
+
+    def test_status_invalidated_by_bulk_membership(self):
+        self.assertFalse(UserHelper.status(self.other).traffic_exceeded)
+        make_members_of([self.other], self.config.traffic_limit_exceeded_group,
+                        self.member, session.utcnow())
+        self.assertTrue(UserHelper.status(self.other).traffic_exceeded)
@@ -6,7 +6,8 @@ from sqlalchemy.dialects import postgresql
 
 from pycroft.model.ddl import DropConstraint, CreateFunction, DropFunction, \
     Function, View, CreateView, DropView, Rule, CreateRule, ConstraintTrigger, \
-    CreateConstraintTrigger, Trigger, CreateTrigger
+    CreateConstraintTrigger, Trigger, CreateTrigger, Partition, \
+    CreatePartition, DropPartition
 
 from sqlalchemy.sql import sqltypes
 import sqlalchemy.dialects.postgresql.base as postgresql_base
@@ -115,6 +116,18 @@ class TriggerTest(DDLTest):
                          'do_foo()',
                          literal_compile(stmt))
 
+    def test_create_statement_trigger_with_transition_tables(self):
+        table = create_table("test")
+        trigger = Trigger("test_trigger", table, ("UPDATE",), "do_foo()",
+                          for_each="STATEMENT",
+                          referencing={'NEW': 'new_rows', 'OLD': 'old_rows'})
+        stmt = CreateTrigger(trigger)
+        self.assertEqual('CREATE TRIGGER test_trigger AFTER UPDATE ON test '
+                         'REFERENCING OLD TABLE AS old_rows '
+                         'NEW TABLE AS new_rows '
+                         'FOR EACH STATEMENT EXECUTE PROCEDURE do_foo()',
+                         literal_compile(stmt))
+
 
 class RuleTest(DDLTest):
     def test_create_rule(self):
@@ -255,3 +268,27 @@ class ViewTest(DDLTest):
         stmt = DropView(view, cascade=True)
         self.assertEqual('DROP VIEW view CASCADE',
                          literal_compile(stmt))
+
+
+class PartitionTest(DDLTest):
+    def test_create_partition(self):
+        table = create_table("table")
+        partition = Partition("table_1", table, "FOR VALUES FROM (1) TO (2)")
+        stmt = CreatePartition(partition)
+        self.assertEqual('CREATE TABLE table_1 PARTITION OF "table" '
+                         'FOR VALUES FROM (1) TO (2)',
+                         literal_compile(stmt))
+
+    def test_create_default_partition(self):
+        table = create_table("table")
+        stmt = CreatePartition(Partition("table_default", table))
+        self.assertEqual('CREATE TABLE table_default PARTITION OF "table" '
+                         'DEFAULT',
+                         literal_compile(stmt))
+
+    def test_drop_partition_if_exists(self):
+        table = create_table("table")
+        stmt = DropPartition(Partition("table_default", table),
+                             if_exists=True)
+        self.assertEqual('DROP TABLE IF EXISTS table_default',
+                         literal_compile(stmt))
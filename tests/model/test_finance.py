@@ -6,7 +6,7 @@ from datetime import datetime
 from sqlalchemy.exc import IntegrityError
 
 from pycroft.model.finance import (
-    Account, BankAccount, BankAccountActivity, IllegalTransactionError)
+    Account, AccountBalance, BankAccount, BankAccountActivity, IllegalTransactionError)
 from pycroft.model.user import User
 from tests import FixtureDataTestBase, PostgreSQLTestCase
 from pycroft.model import finance, session
@@ -125,6 +125,56 @@ class TestTransactionSplits(FinanceModelTest):
         self.assertRaises(IllegalTransactionError, session.session.commit)
 
 
+class TestAccountBalance(FinanceModelTest):
+    datasets = (AccountData, UserData)
+
+    def setUp(self):
+        super(TestAccountBalance, self).setUp()
+        self.transfer = self.create_transaction()
+        self.asset_split = self.create_split(self.transfer,
+                                             self.asset_account, 100)
+        self.revenue_split = self.create_split(self.transfer,
+                                               self.revenue_account, -100)
+        session.session.add_all([self.transfer, self.asset_split,
+                                 self.revenue_split])
+        session.session.flush()
+
+    def cached_balance(self, account):
+        return session.session.query(AccountBalance.balance).filter_by(
+            account_id=account.id).scalar()
+
+    def test_insert(self):
+        self.assertEqual(self.cached_balance(self.asset_account), 100)
+        self.assertEqual(self.cached_balance(self.revenue_account), -100)
+        self.assertEqual(self.asset_account.balance, 100)
+        self.assertIsNone(self.cached_balance(self.liability_account))
+        self.assertEqual(self.liability_account.balance, 0)
+
+    def test_update_amount(self):
+        self.asset_split.amount = 30
+        self.revenue_split.amount = -30
+        self.assertEqual(self.asset_account.balance, 30)
+        self.assertEqual(self.revenue_account.balance, -30)
+
+    def test_update_account(self):
+        self.asset_split.account = self.liability_account
+        self.assertEqual(self.asset_account.balance, 0)
+        self.assertEqual(self.liability_account.balance, 100)
+
+    def test_delete(self):
+        session.session.delete(self.transfer)
+        session.session.flush()
+        self.assertEqual(self.asset_account.balance, 0)
+        self.assertEqual(self.revenue_account.balance, 0)
+
+    def test_balance_expression(self):
+        balances = dict(session.session.query(Account.id, Account.balance))
+        self.assertEqual(balances[self.asset_account.id], 100)
+        self.assertEqual(balances[self.liability_account.id], 0)
+        self.assertEqual(
+            Account.q.filter(Account.balance > 0).all(), [self.asset_account])
+
+
 class TestBankAccountActivity(FinanceModelTest, PostgreSQLTestCase):
     datasets = (AccountData, BankAccountData, UserData)
 
@@ -3,8 +3,14 @@
 # the Apache License, Version 2.0. See the LICENSE file for details.
 from datetime import datetime, timedelta
 
+from sqlalchemy import select
+
+from pycroft.helpers.interval import IntervalSet, closed, closedopen, \
+    openclosed, single
+from pycroft.lib.membership import refresh_materialized_properties, \
+    remove_members_of
 from pycroft.model import session, user
-from pycroft.model.property import current_property
+from pycroft.model.property import current_property, MaterializedCurrentProperty
 from pycroft.model.user import Group, Membership, PropertyGroup
 from tests import FixtureDataTestBase, FactoryDataTestBase
 from tests.factories.property import MembershipFactory, PropertyGroupFactory
@@ -406,7 +412,9 @@ class TestGroup(PropertyDataTestBase):
         self.assertEqual(query.all(), [self.user])
 
 
-class CurrentPropertyViewTest(FactoryDataTestBase):
+class CurrentPropertyDataMixin:
+    """Create users with memberships in groups granting and denying the
+    ``login`` and ``mail`` properties at different times."""
     def setUp(self):
         super().setUp()
         property_group_data = {
@@ -445,6 +453,8 @@ class CurrentPropertyViewTest(FactoryDataTestBase):
                                      begins_at=start, ends_at=end)
         session.session.commit()
 
+
+class CurrentPropertyViewTest(CurrentPropertyDataMixin, FactoryDataTestBase):
     def test_current_properties_of_user(self):
         rows = (session.session.query(current_property.table.c.property_name)
                 .add_columns(user.User.login.label('login'))
@@ -474,3 +484,107 @@ class CurrentPropertyViewTest(FactoryDataTestBase):
         # This checks that the violator's 'login' property is in the view as well
         # when ignoring the `denied` column
         self.assertIn(('login', self.users['violator'].login), rows)
+
+
+class MaterializedCurrentPropertyTest(CurrentPropertyDataMixin,
+                                      FactoryDataTestBase):
+    def view_rows(self):
+        view = current_property.table
+        return {tuple(row) for row in session.session.execute(
+            select([view.c.user_id, view.c.property_name, view.c.denied]))}
+
+    def assert_materialized_matches_view(self):
+        table = MaterializedCurrentProperty.__table__
+        materialized = session.session.execute(
+            select([table.c.user_id, table.c.property_name, table.c.denied])
+        ).fetchall()
+        self.assertEqual({tuple(row) for row in materialized},
+                         self.view_rows())
+
+    def test_initially_in_sync(self):
+        self.assert_materialized_matches_view()
+        self.assertEqual(
+            {p.property_name for p in self.users['violator'].materialized_properties},
+            {'mail'},
+        )
+
+    def test_membership_changes_are_applied(self):
+        membership = Membership.q.filter_by(user=self.users['violator'],
+                                            group=self.groups['violation']).one()
+        membership.ends_at = session.utcnow() - timedelta(hours=1)
+        session.session.flush()
+        self.assert_materialized_matches_view()
+
+        session.session.delete(Membership.q.filter_by(
+            user=self.users['active'], group=self.groups['active']).one())
+        session.session.flush()
+        self.assert_materialized_matches_view()
+
+    def test_property_changes_are_applied(self):
+        self.groups['mail_only'].property_grants['traffic'] = True
+        self.groups['violation'].property_grants['mail'] = False
+        session.session.flush()
+        self.assert_materialized_matches_view()
+
+        del self.groups['violation'].property_grants['login']
+        session.session.flush()
+        self.assert_materialized_matches_view()
+
+    def test_refresh_restores_sync(self):
+        session.session.execute(MaterializedCurrentProperty.__table__.delete())
+        self.assertEqual(refresh_materialized_properties(),
+                         len(self.view_rows()))
+        self.assert_materialized_matches_view()
+        self.assertEqual(refresh_materialized_properties(), 0)
+
+
+class PropertyIntervalIndexTest(FactoryDataTestBase):
+    def create_factories(self):
+        self.now = session.utcnow()
+        self.user = UserFactory()
+        self.processor = UserFactory()
+        self.granting = PropertyGroupFactory(granted={'network_access'})
+        self.denying = PropertyGroupFactory(denied={'network_access'})
+        MembershipFactory(user=self.user, group=self.granting,
+                          begins_at=self.now - timedelta(days=10))
+        MembershipFactory(user=self.user, group=self.denying,
+                          begins_at=self.now - timedelta(days=5),
+                          ends_at=self.now - timedelta(days=3))
+
+    def test_has_property(self):
+        index = self.user.property_index()
+        for days, expected in [(11, False), (10, True), (5, False),
+                               (4, False), (3, False), (2, True), (0, True)]:
+            when = self.now - timedelta(days=days)
+            self.assertEqual(index.has_property('network_access', when),
+                             expected)
+            self.assertEqual(self.user.has_property('network_access',
+                                                    single(when)), expected)
+        self.assertFalse(index.has_property('violation', self.now))
+
+    def test_intervals(self):
+        window = closed(self.now - timedelta(days=7), self.now)
+        self.assertEqual(
+            self.user.property_intervals('network_access', window),
+            IntervalSet([
+                closedopen(self.now - timedelta(days=7),
+                           self.now - timedelta(days=5)),
+                openclosed(self.now - timedelta(days=3), self.now),
+            ]))
+        self.assertEqual(self.user.property_intervals('violation', window),
+                         IntervalSet())
+
+    def test_cached_until_memberships_change(self):
+        index = self.user.property_index()
+        self.assertIs(self.user.property_index(), index)
+
+        MembershipFactory(user=self.user, group=self.denying,
+                          begins_at=self.now - timedelta(days=1))
+        self.assertIsNot(self.user.property_index(), index)
+        self.assertFalse(self.user.has_property('network_access'))
+
+    def test_invalidated_by_bulk_changes(self):
+        self.assertTrue(self.user.has_property('network_access'))
+        remove_members_of([self.user], [self.granting], self.processor,
+                          self.now - timedelta(days=1))
+        self.assertFalse(self.user.has_property('network_access'))
@@ -0,0 +1,51 @@
+# Copyright (c) 2019 The Pycroft Authors. See the AUTHORS file.
+# This file is part of the Pycroft project and licensed under the terms of
+# the Apache License, Version 2.0. See the LICENSE file for details.
+from pycroft import config
+from pycroft.model import session
+from pycroft.model.session import transaction_cache, utcnow_cache_info
+from tests import FactoryDataTestBase
+from tests.factories import ConfigFactory, PropertyGroupFactory
+
+
+class ConfigCacheTest(FactoryDataTestBase):
+    def create_factories(self):
+        self.config = ConfigFactory.create()
+
+    def test_config_is_cached(self):
+        self.assertEqual(config.id, self.config.id)
+        self.assertIs(transaction_cache()['config'], self.config)
+
+    def test_cache_invalidated_on_config_write(self):
+        config.member_group = PropertyGroupFactory.create()
+        session.session.flush()
+        self.assertNotIn('config', transaction_cache())
+        self.assertEqual(config.member_group, self.config.member_group)
+
+    def test_cache_reset_after_commit(self):
+        self.assertEqual(config.id, self.config.id)
+        session.session.commit()
+        self.assertNotIn('config', transaction_cache())
+
+    def test_cache_reset_after_rollback(self):
+        self.assertEqual(config.id, self.config.id)
+        session.session.rollback()
+        self.assertNotIn('config', transaction_cache())
+
+
+class UtcnowCacheTest(FactoryDataTestBase):
+    def test_timestamp_cached_per_transaction(self):
+        before = utcnow_cache_info()
+        now = session.utcnow()
+        self.assertEqual(session.utcnow(), now)
+        self.assertEqual(session.utcnow(), now)
+        after = utcnow_cache_info()
+        self.assertEqual(after.misses - before.misses, 1)
+        self.assertEqual(after.hits - before.hits, 2)
+
+    def test_cache_reset_after_commit(self):
+        session.utcnow()
+        session.session.commit()
+        misses = utcnow_cache_info().misses
+        session.utcnow()
+        self.assertEqual(utcnow_cache_info().misses, misses + 1)
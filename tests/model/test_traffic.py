@@ -1,6 +1,8 @@
+from sqlalchemy import func, select
+
 from pycroft.model import session
-from pycroft.model.traffic import TrafficVolume, pmacct_traffic_egress, \
-    pmacct_traffic_ingress
+from pycroft.model.traffic import TrafficDailyUser, TrafficVolume, \
+    pmacct_traffic_egress, pmacct_traffic_ingress, pmacct_traffic_staging
 from tests import FactoryDataTestBase
 from tests.factories import UserWithHostFactory
 
@@ -92,3 +94,147 @@ class PMAcctViewTest(FactoryDataTestBase):
         self.assertEqual(str(vol.timestamp), '2018-03-15 00:00:00+00:00')
         self.assertEqual(vol.packets, sum(x[1] for x in data))
         self.assertEqual(vol.amount, sum(x[2] for x in data))
+
+
+class PMAcctStagingTest(FactoryDataTestBase):
+    ip = '141.30.228.39'
+
+    def create_factories(self):
+        self.user = UserWithHostFactory(host__interface__ip__str_address=self.ip)
+
+    def stage(self, stamp, ip_src=None, ip_dst=None, bytes=1024, packets=20):
+        session.session.execute(pmacct_traffic_staging.insert().values(
+            bytes=bytes, packets=packets, stamp_inserted=stamp,
+            stamp_updated=stamp, ip_src=ip_src, ip_dst=ip_dst))
+
+    def merge(self):
+        return session.session.execute(
+            select([func.pmacct_traffic_merge_staging()])).scalar()
+
+    def test_merge_aggregates_per_day_and_direction(self):
+        self.stage('2018-03-15 00:15:00', ip_src=self.ip, packets=200)
+        self.stage('2018-03-15 23:59:00', ip_src=self.ip, bytes=7055)
+        self.stage('2018-03-15 10:15:00', ip_dst=self.ip, bytes=500)
+        self.stage('2018-03-16 10:15:00', ip_dst=self.ip)
+        self.stage('2018-03-16 10:15:00', ip_dst='1.1.1.1')
+        self.assertEqual(self.merge(), 3)
+        self.assertEqual(
+            session.session.query(pmacct_traffic_staging).count(), 0)
+
+        volumes = {(v.type, str(v.timestamp)): (v.amount, v.packets, v.user)
+                   for v in TrafficVolume.q}
+        self.assertEqual(volumes, {
+            ('Egress', '2018-03-15 00:00:00+00:00'): (8079, 220, self.user),
+            ('Ingress', '2018-03-15 00:00:00+00:00'): (500, 20, self.user),
+            ('Ingress', '2018-03-16 00:00:00+00:00'): (1024, 20, self.user),
+        })
+
+    def test_merge_adds_to_existing_volume(self):
+        self.stage('2018-03-15 00:15:00', ip_src=self.ip)
+        self.merge()
+        self.stage('2018-03-15 10:15:00', ip_src=self.ip)
+        self.assertEqual(self.merge(), 1)
+        volume = TrafficVolume.q.one()
+        self.assertEqual((volume.amount, volume.packets), (2048, 40))
+
+
+class TrafficDailyUserTest(FactoryDataTestBase):
+    ip = '141.30.228.39'
+
+    def create_factories(self):
+        self.user = UserWithHostFactory(host__interface__ip__str_address=self.ip)
+
+    def stage(self, stamp, ip_src=None, ip_dst=None, bytes=1024, packets=20):
+        session.session.execute(pmacct_traffic_staging.insert().values(
+            bytes=bytes, packets=packets, stamp_inserted=stamp,
+            stamp_updated=stamp, ip_src=ip_src, ip_dst=ip_dst))
+
+    def rollup(self):
+        return {(str(r.day), r.type): (r.amount, r.packets)
+                for r in TrafficDailyUser.q.filter_by(user_id=self.user.id)}
+
+    def test_rollup_follows_merged_traffic(self):
+        self.stage('2018-03-15 00:15:00', ip_src=self.ip)
+        self.stage('2018-03-15 10:15:00', ip_dst=self.ip, bytes=500)
+        self.stage('2018-03-16 10:15:00', ip_dst=self.ip)
+        session.session.execute(select([func.pmacct_traffic_merge_staging()]))
+        self.stage('2018-03-15 23:59:00', ip_src=self.ip, bytes=7055)
+        session.session.execute(select([func.pmacct_traffic_merge_staging()]))
+        self.assertEqual(self.rollup(), {
+            ('2018-03-15', 'Egress'): (8079, 40),
+            ('2018-03-15', 'Ingress'): (500, 20),
+            ('2018-03-16', 'Ingress'): (1024, 20),
+        })
+
+    def test_rollup_follows_updates_and_deletes(self):
+        self.stage('2018-03-15 00:15:00', ip_src=self.ip)
+        self.stage('2018-03-16 00:15:00', ip_src=self.ip)
+        session.session.execute(select([func.pmacct_traffic_merge_staging()]))
+        session.session.execute(
+            TrafficVolume.__table__.update()
+            .where(TrafficVolume.timestamp < '2018-03-16')
+            .values(amount=TrafficVolume.amount * 2))
+        self.assertEqual(self.rollup(), {
+            ('2018-03-15', 'Egress'): (2048, 20),
+            ('2018-03-16', 'Egress'): (1024, 20),
+        })
+        session.session.execute(
+            TrafficVolume.__table__.delete()
+            .where(TrafficVolume.timestamp >= '2018-03-16'))
+        self.assertEqual(self.rollup(), {('2018-03-15', 'Egress'): (2048, 20)})
+
+
+class TrafficVolumePartitionTest(FactoryDataTestBase):
+    ip = '141.30.228.39'
+
+    def create_factories(self):
+        self.user = UserWithHostFactory(host__interface__ip__str_address=self.ip)
+
+    def setUp(self):
+        super().setUp()
+        for stamp in ('2018-03-14 10:00:00', '2018-03-15 10:00:00',
+                      '2018-03-16 10:00:00'):
+            session.session.execute(pmacct_traffic_staging.insert().values(
+                bytes=1024, packets=20, stamp_inserted=stamp,
+                stamp_updated=stamp, ip_src=self.ip))
+        session.session.execute(select([func.pmacct_traffic_merge_staging()]))
+
+    def execute(self, function, *args):
+        return session.session.execute(
+            select([getattr(func, function)(*args)])).scalar()
+
+    def partition_count(self, name):
+        return session.session.execute(
+            'SELECT count(*) FROM {}'.format(name)).scalar()
+
+    def test_create_partitions_moves_default_rows(self):
+        self.assertEqual(self.partition_count('traffic_volume_default'), 3)
+        self.assertEqual(self.execute('traffic_volume_create_partitions',
+                                      '2018-03-15', '2018-03-17'), 3)
+        self.assertEqual(self.execute('traffic_volume_create_partitions',
+                                      '2018-03-15', '2018-03-17'), 0)
+        self.assertEqual(self.partition_count('traffic_volume_default'), 1)
+        self.assertEqual(self.partition_count('traffic_volume_20180315'), 1)
+        self.assertEqual(self.partition_count('traffic_volume_20180317'), 0)
+        self.assertEqual(TrafficVolume.q.count(), 3)
+        self.assertEqual(TrafficDailyUser.q.count(), 3)
+
+        session.session.execute(
+            pmacct_traffic_staging.insert().values(
+                bytes=1024, packets=20, stamp_inserted='2018-03-15 11:00:00',
+                ip_src=self.ip))
+        self.execute('pmacct_traffic_merge_staging')
+        self.assertEqual(self.partition_count('traffic_volume_20180315'), 1)
+        self.assertEqual(
+            TrafficDailyUser.q.filter_by(day='2018-03-15').one().amount, 2048)
+
+    def test_drop_partitions(self):
+        self.execute('traffic_volume_create_partitions',
+                     '2018-03-15', '2018-03-16')
+        self.assertEqual(
+            self.execute('traffic_volume_drop_partitions', '2018-03-16'), 1)
+        # neither the default partition nor the rollup are touched
+        self.assertEqual(
+            sorted(str(v.timestamp) for v in TrafficVolume.q),
+            ['2018-03-14 00:00:00+00:00', '2018-03-16 00:00:00+00:00'])
+        self.assertEqual(TrafficDailyUser.q.count(), 3)
@@ -0,0 +1,47 @@
+import csv
+from datetime import date, datetime, timedelta, timezone
+from io import StringIO
+
+from pycroft.lib.traffic import ingest_pmacct_traffic
+from pycroft.model import session
+from scripts.traffic_export import CSVWriter, days_between, export_days
+from tests import FactoryDataTestBase
+from tests.factories import UserWithHostFactory
+
+
+class TrafficExportTest(FactoryDataTestBase):
+    ip = '141.30.228.39'
+
+    def create_factories(self):
+        self.user = UserWithHostFactory(host__interface__ip__str_address=self.ip)
+
+    def test_days_between(self):
+        self.assertEqual(days_between(date(2019, 2, 27), date(2019, 3, 1)),
+                         [date(2019, 2, 27), date(2019, 2, 28),
+                          date(2019, 3, 1)])
+
+    def test_export_csv(self):
+        day = datetime(2019, 3, 15, tzinfo=timezone.utc)
+        ingest_pmacct_traffic([
+            ('Egress', self.ip, day, 100, 1),
+            ('Ingress', self.ip, day, 10, 1),
+            ('Egress', '141.30.228.40', day, 1, 1),
+            ('Ingress', self.ip, day + timedelta(days=1), 1000, 10),
+            ('Ingress', self.ip, day + timedelta(days=2), 1, 1),
+        ])
+
+        output = StringIO()
+        count = export_days(session.session.connection(),
+                            days_between(day.date(), day.date() + timedelta(1)),
+                            CSVWriter(output), batch_size=2)
+        self.assertEqual(count, 3)
+
+        header, *rows = csv.reader(StringIO(output.getvalue()))
+        self.assertEqual(header, ['timestamp', 'type', 'address', 'user_id',
+                                  'amount', 'packets'])
+        self.assertEqual(rows[:2], [
+            [day.isoformat(), 'Ingress', self.ip, str(self.user.id), '10', '1'],
+            [day.isoformat(), 'Egress', self.ip, str(self.user.id), '100', '1'],
+        ])
+        self.assertEqual(rows[2][1:], ['Ingress', self.ip, str(self.user.id),
+                                       '1000', '10'])
@@ -12,6 +12,8 @@
 from operator import and_
 
 from collections import defaultdict
+from datetime import timedelta
+
 from flask import (Blueprint, flash, jsonify, render_template, url_for,
                    redirect, request, abort)
 from flask_login import current_user
@@ -25,6 +27,7 @@ from pycroft.helpers.net import sort_ports
 from pycroft.lib.facilities import get_overcrowded_rooms, create_room, edit_room, RoomAlreadyExistsException
 from pycroft.lib.infrastructure import create_patch_port, edit_patch_port, delete_patch_port, \
     PatchPortAlreadyExistsException
+from pycroft.lib.traffic import buildings_traffic_series
 from pycroft.model import session
 from pycroft.model.facilities import Room, Site, Building
 from pycroft.model.port import PatchPort
@@ -92,6 +95,24 @@ def building_show(building_id=None, building_shortname=None):
         page_title=u"Wohnheim " + building.short_name, rooms=rooms_list)
 
 
+@bp.route('/building/<int:building_id>/traffic/json')
+@bp.route('/building/<int:building_id>/traffic/json/<int:days>')
+def building_traffic_json(building_id, days=7):
+    """Return the daily traffic of the inhabitants of a building as columns.
+
+    The result has the keys ``timestamps``, ``ingress`` and ``egress``, which
+    are lists of equal length.
+    """
+    building = Building.q.get(building_id)
+    if building is None or days < 1:
+        abort(404)
+
+    end = session.utcnow()
+    series = dict(buildings_traffic_series(
+        [building.id], end - timedelta(days=days - 1), end))
+    return jsonify(items=series[building.id]._asdict())
+
+
 # ToDo: Review this!
 @bp.route('/building/<int:building_id>/levels/')
 @bp.route('/building/<building_shortname>/levels/')
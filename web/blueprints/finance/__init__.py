@@ -32,7 +32,8 @@ from pycroft.lib import finance
 from pycroft.lib.finance import get_typed_splits, \
     end_payment_in_default_memberships, \
     post_transactions_for_membership_fee, build_transactions_query, \
-    match_activities, take_actions_for_payment_in_default_users
+    match_activities, get_activity_matches, \
+    take_actions_for_payment_in_default_users
 from pycroft.lib.user import encode_type2_user_id
 from pycroft.model.finance import (
     BankAccount, BankAccountActivity, Split, MembershipFee, MT940Error)
@@ -381,18 +382,21 @@ def bank_account_activities_match():
         #("Field-Name",BooleanField('Text')),
     ]
 
-    matching = match_activities()
+    matching = get_activity_matches()
 
     matched_activities = {}
-    for activity, user in matching.items():
+    for activity, (user, confidence) in matching.items():
         matched_activities[str(activity.id)] = {
             'purpose': activity.reference,
             'name': activity.other_name,
             'user': user,
-            'amount': activity.amount
+            'amount': activity.amount,
+            'confidence': confidence,
         }
-        FieldList.append((str(activity.id), BooleanField(str(activity.id),
-                                                         default=True)))
+        # Ambiguous matches have to be selected explicitly
+        FieldList.append((str(activity.id), BooleanField(
+            str(activity.id),
+            default=confidence >= finance.MATCH_CONFIDENCE_NAME)))
 
     class F(forms.ActivityMatchForm):
         pass
@@ -1083,12 +1087,15 @@ def handle_payments_in_default():
         users_pid_membership = form.new_pid_memberships.data
         users_membership_terminated = form.terminated_member_memberships.data
 
-        take_actions_for_payment_in_default_users(
+        actions = take_actions_for_payment_in_default_users(
             users_pid_membership=users_pid_membership,
             users_membership_terminated=users_membership_terminated,
             processor=current_user)
         session.commit()
-        flash("Zahlungsrückstände behandelt.", "success")
+        flash("Zahlungsrückstände behandelt: {} Nutzer zur Zahlungsrückstand-"
+              "Gruppe hinzugefügt, {} Nutzer ausgezogen."
+              .format(len(actions.added_to_pid_group),
+                      len(actions.moved_out)), "success")
         return redirect(url_for(".membership_fees"))
 
     form_args = {
@@ -1,5 +1,7 @@
 import re
 import traceback
+from datetime import timedelta
+from itertools import groupby
 
 from flask import Blueprint, flash, abort, redirect, url_for, render_template, \
     jsonify, request
@@ -9,6 +11,7 @@ from ipaddr import IPv4Address
 
 from pycroft.helpers.net import mac_regex, get_interface_manufacturer
 from pycroft.lib import host as lib_host
+from pycroft.lib.traffic import get_ip_traffic
 from pycroft.lib.net import get_subnets_for_room, get_unused_ips, \
     MacExistsException
 from pycroft.model import session
@@ -383,6 +386,42 @@ def user_hosts_json(user_id):
     return jsonify(items=list_items)
 
 
+@bp.route("/<int:user_id>/traffic")
+@bp.route("/<int:user_id>/traffic/<int:days>")
+def user_hosts_traffic_json(user_id, days=7):
+    if days < 1:
+        abort(404)
+    user = get_user_or_404(user_id)
+
+    end = session.utcnow()
+    rows = get_ip_traffic(user.id, end - timedelta(days=days - 1), end)
+
+    list_items = []
+    for (host_id, host_name), host_rows in groupby(
+            rows, key=lambda row: (row.host_id, row.host_name)):
+        interfaces = []
+        for (interface_id, mac), interface_rows in groupby(
+                host_rows, key=lambda row: (row.interface_id, row.mac)):
+            ips = [{'id': row.ip_id, 'address': str(row.address),
+                    'ingress': row.ingress, 'egress': row.egress}
+                   for row in interface_rows]
+            interfaces.append({
+                'id': interface_id,
+                'mac': str(mac),
+                'ingress': sum(ip['ingress'] for ip in ips),
+                'egress': sum(ip['egress'] for ip in ips),
+                'ips': ips,
+            })
+        list_items.append({
+            'id': host_id,
+            'name': host_name,
+            'ingress': sum(i['ingress'] for i in interfaces),
+            'egress': sum(i['egress'] for i in interfaces),
+            'interfaces': interfaces,
+        })
+    return jsonify(items=list_items)
+
+
 @bp.route("/interface-manufacturer/<string:mac>")
 def interface_manufacturer_json(mac):
     if not re.match(mac_regex, mac):
@@ -34,9 +34,10 @@ from pycroft.helpers.net import mac_regex, ip_regex, get_interface_manufacturer
 from pycroft.lib.logging import log_user_event
 from pycroft.lib.membership import make_member_of, remove_member_of
 from pycroft.lib.net import SubnetFullException, MacExistsException
-from pycroft.lib.traffic import get_users_with_highest_traffic
+from pycroft.lib.traffic import get_users_with_highest_traffic, \
+    user_traffic_series
 from pycroft.lib.user import encode_type1_user_id, encode_type2_user_id, \
-    traffic_history, generate_user_sheet, get_blocked_groups
+    generate_user_sheet, get_blocked_groups
 from pycroft.model import session
 from pycroft.model.facilities import Room
 from pycroft.model.finance import Split
@@ -519,12 +520,19 @@ def json_trafficdata(user_id, days=7):
         }
     }
     """
+    if days < 1:
+        abort(404)
+    user = get_user_or_404(user_id)
     interval = timedelta(days=days)
-    result = traffic_history(user_id, session.utcnow() - interval + timedelta(days=1), session.utcnow())
+    series = user_traffic_series(
+        user.id, session.utcnow() - interval + timedelta(days=1),
+        session.utcnow())
 
     return jsonify(
         items={
-            'traffic': [e.__dict__ for e in result]
+            'traffic': [{'timestamp': timestamp, 'ingress': ingress,
+                         'egress': egress}
+                        for timestamp, ingress, egress in zip(*series)]
         }
     )
 